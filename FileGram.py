@@ -4,21 +4,36 @@ import logging
 import uuid
 import datetime
 import io
+import hashlib
+import json
+import re
+import sqlite3
 import time
 import asyncio
 import threading
-import subprocess  # Nuevo para usar FFmpeg y para ejecutar archivos
+import queue
+import concurrent.futures
+import functools
+import heapq
+import math
+import itertools
+import bisect
+import tarfile
+import fnmatch
+import subprocess  # Para ejecutar archivos
 import platform
 import socket
+from array import array
+from collections import OrderedDict, namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import psutil
 import mss
-import mss.tools
 import requests
-from PIL import Image
-import pyautogui
+from PIL import Image, ImageDraw
 from pyrogram.types import InputMediaPhoto
 
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
+from pyrogram.errors import FloodWait, BadRequest
 from pyrogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -55,53 +70,551 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ----------------------------------------------------------------
+# Ejecutores para sacar el trabajo bloqueante del bucle de asyncio
+
+IO_WORKERS = 8                                   # Hilos para E/S (disco, red, subprocesos)
+CPU_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # Procesos para trabajo de CPU (miniaturas, gráficas)
+
+class ManagedExecutor:
+    """
+    Envoltorio de un pool de hilos o procesos que se crea bajo demanda y
+    lleva métricas de profundidad de cola. Los contadores solo se tocan desde el bucle.
+    """
+
+    def __init__(self, name: str, factory, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self._factory = factory
+        self._pool = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = self._factory(max_workers=self.max_workers)
+        return self._pool
+
+    @property
+    def queued(self) -> int:
+        """Trabajos esperando a que quede libre un worker."""
+        return max(0, self.in_flight - self.max_workers)
+
+    async def run(self, func, *args, **kwargs):
+        """Ejecuta func(*args, **kwargs) en el pool y espera su resultado sin bloquear el bucle."""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        self.submitted += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return await loop.run_in_executor(self._get_pool(), call)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> str:
+        return (
+            f"{self.max_workers} workers, en curso {self.in_flight} (cola {self.queued}, pico {self.peak_in_flight}), "
+            f"completados {self.completed}, errores {self.failed}"
+        )
+
+IO_POOL = ManagedExecutor("io", ThreadPoolExecutor, IO_WORKERS)
+# En Windows los procesos arrancan con 'spawn' y reimportan este módulo: importarlo no debe
+# tocar el disco (los almacenes se abren en open_stores(), llamado desde main()).
+CPU_POOL = ManagedExecutor("cpu", ProcessPoolExecutor, CPU_WORKERS)
+
+# ----------------------------------------------------------------
+# Registro acotado de rutas: cada ruta recibe un ID corto y estable para callback_data
+
+PATH_REGISTRY_MAX = 5000        # Máximo de rutas recordadas por registro
+PATH_REGISTRY_TTL = 12 * 3600   # Segundos sin uso tras los que una ruta caduca
+
+_ID_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+class PathRegistry:
+    """
+    Asocia cada ruta a un ID corto (contador en base 36), siempre el mismo para la misma ruta.
+    Las entradas se expulsan por LRU al superar 'max_size' o por TTL si no se usan.
+    Los IDs nunca se reutilizan, así que un botón antiguo caducado no apunta a otra ruta.
+    Con 'weigh' (función valor -> peso) se expulsa además mientras la suma supere 'max_weight'.
+    """
+
+    def __init__(self, max_size: int = PATH_REGISTRY_MAX, ttl: float = PATH_REGISTRY_TTL,
+                 weigh=None, max_weight: int = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.weigh = weigh
+        self.max_weight = max_weight
+        self.weight = 0
+        self._weights = {}           # {id: peso} si hay 'weigh'
+        self._by_id = OrderedDict()  # {id: (ruta, último uso)} en orden LRU
+        self._by_path = {}           # {ruta: id}
+        self._counter = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _new_id(self) -> str:
+        self._counter += 1
+        n = self._counter
+        digits = []
+        while n:
+            n, rem = divmod(n, 36)
+            digits.append(_ID_ALPHABET[rem])
+        return "".join(reversed(digits))
+
+    def _overweight(self) -> bool:
+        # La entrada más reciente se conserva aunque pese más que el límite por sí sola
+        return self.max_weight is not None and self.weight > self.max_weight and len(self._by_id) > 1
+
+    def _evict(self, now: float):
+        while self._by_id:
+            key, (path, last_used) = next(iter(self._by_id.items()))
+            if len(self._by_id) <= self.max_size and now - last_used < self.ttl and not self._overweight():
+                break
+            del self._by_id[key]
+            del self._by_path[path]
+            self.weight -= self._weights.pop(key, 0)
+            self.evictions += 1
+
+    def register(self, path: str) -> str:
+        """Devuelve el ID de la ruta, creándolo si no existe."""
+        now = time.monotonic()
+        key = self._by_path.get(path)
+        if key is None:
+            key = self._new_id()
+            self._by_path[path] = key
+            if self.weigh is not None:
+                self._weights[key] = self.weigh(path)
+                self.weight += self._weights[key]
+        self._by_id[key] = (path, now)
+        self._by_id.move_to_end(key)
+        self._evict(now)
+        return key
+
+    def get(self, key: str):
+        """Devuelve la ruta asociada al ID o None si no existe o ha caducado."""
+        now = time.monotonic()
+        item = self._by_id.get(key)
+        if item is None or now - item[1] >= self.ttl:
+            self.misses += 1
+            self._evict(now)
+            return None
+        self.hits += 1
+        self._by_id[key] = (item[0], now)
+        self._by_id.move_to_end(key)
+        return item[0]
+
+    def discard(self, key: str):
+        """Olvida el ID (por ejemplo, tras eliminar el archivo)."""
+        item = self._by_id.pop(key, None)
+        if item is not None:
+            self._by_path.pop(item[0], None)
+            self.weight -= self._weights.pop(key, 0)
+
+    def stats(self) -> str:
+        weight = f" (peso {self.weight}/{self.max_weight})" if self.max_weight is not None else ""
+        return (
+            f"{len(self._by_id)}/{self.max_size} rutas{weight}, "
+            f"aciertos {self.hits}, fallos {self.misses}, expulsiones {self.evictions}"
+        )
+
 # Diccionarios globales para mapear IDs a rutas y mensajes
-FILE_MAP = {}
-FOLDER_MAP = {}
+FILE_MAP = PathRegistry()
+FOLDER_MAP = PathRegistry()
 CURRENT_MENU = {}       # {chat_id: message id} => mensaje actual del menú principal
-NAV_MESSAGES = {}       # {chat_id: [message ids]} => mensajes de navegación
 CANCEL_FLAGS = {}       # {identifier: threading.Event}
 CURRENT_NAV_STATE = {}  # {chat_id: current path} => ruta actual (unidad o carpeta)
 SCREENSHOT_TASKS = {}
+SCREEN_STATS = {}       # {chat_id: contadores de la pantalla en vivo}
 FILE_MESSAGES = {}
+DEDUP_OFFERS = {}       # {doc_key: (copia local existente, ruta destino)} => ofertas de enlace/copia
+BACKGROUND_TASKS = set()  # Tareas lanzadas en segundo plano (referencia fuerte hasta que terminan)
+
+def _background_done(task: asyncio.Task):
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error en una tarea en segundo plano: {task.exception()}")
+
+def spawn_background(coro) -> asyncio.Task:
+    """Lanza una corrutina en segundo plano guardando su tarea hasta que termine."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+
+# ----------------------------------------------------------------
+# Planificador de salida: toda llamada a Telegram pasa por aquí para respetar los límites
+
+PRIORITY_INTERACTIVE = 0  # Respuestas directas a una pulsación del usuario
+PRIORITY_BULK = 1         # Listados, miniaturas, envíos de archivos y borrados
+PRIORITY_PROGRESS = 2     # Ediciones de progreso y de pantalla (se pueden descartar)
+
+OUTBOUND_GLOBAL_RATE = 25.0    # Operaciones por segundo en total
+OUTBOUND_CHAT_RATE = 1.0       # Operaciones por segundo sostenidas por chat
+OUTBOUND_CHAT_BURST = 5        # Ráfaga permitida por chat
+OUTBOUND_MAX_RETRIES = 3       # Reintentos tras un FloodWait
+OUTBOUND_MAX_FLOOD_WAIT = 300  # Un FloodWait más largo se propaga como error
+
+class TokenBucket:
+    """Cubo de tokens clásico con la posibilidad de bloquearse durante un FloodWait."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Segundos que faltan para poder consumir un token."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class _OutboundJob:
+    __slots__ = ("chat_id", "factory", "priority", "key", "future", "attempts")
+
+    def __init__(self, chat_id, factory, priority, key, future):
+        self.chat_id = chat_id
+        self.factory = factory
+        self.priority = priority
+        self.key = key
+        self.future = future
+        self.attempts = 0
 
+class OutboundScheduler:
+    """
+    Cola de salida con prioridades y cubos de tokens global y por chat.
+    Un worker decide cuándo arranca cada llamada, pero la llamada corre en su propia tarea
+    para que una subida larga no bloquee al resto. Los trabajos con la misma 'key' se
+    fusionan: si aún no ha empezado, el anterior se descarta (útil para ediciones de progreso),
+    y nunca hay dos en vuelo a la vez, así que una edición antigua no pisa a otra más reciente.
+    Ante un FloodWait se bloquea el chat el tiempo indicado y se reintenta.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._pending_keys = {}  # {key: _OutboundJob aún no iniciado}
+        self._running_keys = set()  # Claves con una llamada en vuelo
+        self._tasks = set()      # Tareas de las llamadas en vuelo (referencia fuerte)
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self._chats = {}         # {chat_id: TokenBucket}
+        self._wakeup = None
+        self._worker = None
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.retried = 0
+        self.failed = 0
+        self.flood_waits = 0
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    def _push(self, job: _OutboundJob):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        heapq.heappush(self._heap, (job.priority, next(self._seq), job))
+        self._wakeup.set()
+
+    async def call(self, chat_id, factory, priority: int = PRIORITY_INTERACTIVE, key=None):
+        """Encola factory() (que devuelve la corrutina de la llamada) y espera su resultado."""
+        job = _OutboundJob(chat_id, factory, priority, key, asyncio.get_running_loop().create_future())
+        if key is not None:
+            previous = self._pending_keys.get(key)
+            if previous is not None and not previous.future.done():
+                previous.future.set_result(None)
+                self.dropped += 1
+            self._pending_keys[key] = job
+        self.queued += 1
+        self._push(job)
+        return await job.future
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for _, _, job in self._heap if not job.future.done())
+
+    def _next_ready(self, now: float):
+        """
+        Saca del heap el primer trabajo listo y devuelve (trabajo o None, espera mínima).
+        Los que no pueden salir aún (chat sin tokens o clave en vuelo) se apartan y se vuelven
+        a meter, así que un chat bloqueado no frena a los demás.
+        """
+        global_wait = self._global.delay(now)
+        if global_wait > 0:
+            return None, global_wait
+        min_wait = None
+        found = None
+        deferred = []
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            job = item[2]
+            if job.future.done():  # Descartado por otro más reciente o cancelado por quien esperaba
+                continue
+            if job.key is not None and job.key in self._running_keys:
+                deferred.append(item)  # Espera a que termine la llamada anterior con la misma clave
+                continue
+            wait = self._bucket(job.chat_id).delay(now)
+            if wait <= 0:
+                found = item
+                break
+            deferred.append(item)
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        for item in deferred:
+            heapq.heappush(self._heap, item)
+        return found, 0.0 if found is not None else min_wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            item, wait = self._next_ready(now)
+            if item is None:
+                # Se espera al token (o a un trabajo nuevo, que puede adelantarse); sin espera
+                # conocida, hasta que llegue un trabajo o termine una llamada con clave
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job = item[2]
+            self._global.take(now)
+            self._bucket(job.chat_id).take(now)
+            if job.key is not None and self._pending_keys.get(job.key) is job:
+                del self._pending_keys[job.key]
+            if job.key is not None:
+                self._running_keys.add(job.key)
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job: _OutboundJob):
+        try:
+            await self._attempt(job)
+        finally:
+            if job.key is not None:
+                self._running_keys.discard(job.key)
+                if self._wakeup is not None:
+                    self._wakeup.set()
+
+    async def _attempt(self, job: _OutboundJob):
+        try:
+            result = await job.factory()
+        except FloodWait as e:
+            wait = float(getattr(e, "value", 0) or 1)
+            self.flood_waits += 1
+            self._bucket(job.chat_id).block(wait)
+            superseded = job.key is not None and job.key in self._pending_keys
+            if superseded:
+                self.dropped += 1
+                if not job.future.done():
+                    job.future.set_result(None)
+            elif job.attempts < OUTBOUND_MAX_RETRIES and wait <= OUTBOUND_MAX_FLOOD_WAIT:
+                logger.warning(f"FloodWait de {wait:.0f}s en el chat {job.chat_id}; se reintentará")
+                job.attempts += 1
+                self.retried += 1
+                if job.key is not None:
+                    self._pending_keys[job.key] = job
+                self._push(job)
+            else:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        except BaseException as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        self.sent += 1
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def stats(self) -> str:
+        return (
+            f"en cola {self.depth}, encolados {self.queued}, enviados {self.sent}, descartados {self.dropped}, "
+            f"reintentos {self.retried} (FloodWait {self.flood_waits}), errores {self.failed}"
+        )
+
+OUTBOUND = OutboundScheduler()
+
+def _outbound_chat_id(method, args, kwargs):
+    """Deduce el chat de una llamada: argumento chat_id, mensaje/callback dueño del método o primer argumento."""
+    if "chat_id" in kwargs:
+        return kwargs["chat_id"]
+    owner = getattr(method, "__self__", None)
+    if isinstance(owner, Message):
+        return owner.chat.id
+    if isinstance(owner, CallbackQuery):
+        return owner.message.chat.id if owner.message else None
+    return args[0] if args else None
+
+async def outbound(method, *args, priority: int = PRIORITY_INTERACTIVE, key=None, **kwargs):
+    """
+    Ejecuta una llamada a la API de Telegram (p. ej. client.send_message o message.reply)
+    a través del planificador de salida y devuelve su resultado.
+    Si la llamada se descarta por otra más reciente con la misma 'key', devuelve None.
+    """
+    chat_id = _outbound_chat_id(method, args, kwargs)
+    return await OUTBOUND.call(chat_id, lambda: method(*args, **kwargs), priority=priority, key=key)
+
+async def timed_outbound(method, *args, priority: int = PRIORITY_INTERACTIVE, key=None, **kwargs):
+    """
+    Como outbound(), pero devuelve (resultado, segundos) midiendo solo la llamada en sí,
+    sin la espera en la cola del planificador (tras un FloodWait, solo el último intento).
+    """
+    started = []
 
+    async def call():
+        started.append(time.monotonic())
+        return await method(*args, **kwargs)
+
+    chat_id = _outbound_chat_id(method, args, kwargs)
+    result = await OUTBOUND.call(chat_id, call, priority=priority, key=key)
+    return result, (time.monotonic() - started[-1]) if started else 0.0
+
+# ----------------------------------------------------------------
+# Ciclo de vida de los mensajes de navegación
+
+NAV_MESSAGES_MAX = 2000             # Mensajes recordados por chat (los más antiguos se olvidan)
+NAV_MESSAGE_MAX_AGE = 47 * 3600     # Telegram no deja borrar mensajes de más de 48 h: se olvidan antes
+NAV_DELETE_BATCH = 100              # IDs por llamada a delete_messages (límite de Telegram)
+
+class MessageLifecycle:
+    """
+    Registra los mensajes de navegación de cada chat en una cola acotada con la hora de envío
+    y los borra en segundo plano, en lotes de NAV_DELETE_BATCH, a través de la cola de salida
+    con prioridad baja. Quien pide la limpieza no espera a que termine.
+    """
+
+    def __init__(self):
+        self._tracked = {}  # {chat_id: deque([(message_id, instante)])}
+        self._pending = OrderedDict()  # {chat_id: [message ids]} pendientes de borrar
+        self._wakeup = None
+        self._task = None
+        self._client = None
+        self.deleted = 0
+        self.batches = 0
+        self.expired = 0
+        self.forgotten = 0
+        self.failed = 0
+
+    def record(self, chat_id: int, message_id: int):
+        tracked = self._tracked.get(chat_id)
+        if tracked is None:
+            tracked = self._tracked[chat_id] = deque(maxlen=NAV_MESSAGES_MAX)
+        if len(tracked) == tracked.maxlen:
+            self.forgotten += 1
+        tracked.append((message_id, time.time()))
+        self._expire(tracked)
+
+    def _expire(self, tracked: deque):
+        limit = time.time() - NAV_MESSAGE_MAX_AGE
+        while tracked and tracked[0][1] < limit:
+            tracked.popleft()
+            self.expired += 1
+
+    def clear(self, client: Client, chat_id: int):
+        """Programa el borrado de los mensajes registrados del chat y vuelve de inmediato."""
+        tracked = self._tracked.pop(chat_id, None)
+        if not tracked:
+            return
+        self._expire(tracked)
+        self._pending.setdefault(chat_id, []).extend(message_id for message_id, _ in tracked)
+        self._client = client
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                chat_id, message_ids = next(iter(self._pending.items()))
+                batch = message_ids[:NAV_DELETE_BATCH]
+                del message_ids[:NAV_DELETE_BATCH]
+                if not message_ids:
+                    del self._pending[chat_id]
+                try:
+                    await outbound(self._client.delete_messages, chat_id, batch, priority=PRIORITY_BULK)
+                    self.deleted += len(batch)
+                    self.batches += 1
+                except Exception as e:
+                    self.failed += len(batch)
+                    logger.warning(f"Error borrando mensajes de navegación: {e}")
+
+    def stats(self) -> str:
+        tracked = sum(len(t) for t in self._tracked.values())
+        pending = sum(len(ids) for ids in self._pending.values())
+        return (
+            f"registrados {tracked}, pendientes de borrar {pending}, borrados {self.deleted} en {self.batches} lotes, "
+            f"caducados {self.expired}, olvidados {self.forgotten}, fallidos {self.failed}"
+        )
+
+NAV_LIFECYCLE = MessageLifecycle()
 
 def record_nav_message(chat_id: int, message_id: int):
     """Registra el id de un mensaje enviado para navegación en el chat."""
-    if chat_id not in NAV_MESSAGES:
-        NAV_MESSAGES[chat_id] = []
-    NAV_MESSAGES[chat_id].append(message_id)
+    NAV_LIFECYCLE.record(chat_id, message_id)
 
-async def clear_nav_messages(client: Client, chat_id: int):
-    """Borra todos los mensajes de navegación registrados en el chat."""
-    if chat_id in NAV_MESSAGES and NAV_MESSAGES[chat_id]:
-        try:
-            await client.delete_messages(chat_id, NAV_MESSAGES[chat_id])
-        except Exception as e:
-            logger.warning(f"Error borrando mensajes de navegación: {e}")
-        NAV_MESSAGES[chat_id] = []
+def clear_nav_messages(client: Client, chat_id: int):
+    """Programa el borrado de los mensajes de navegación del chat (en segundo plano) y reinicia su estado."""
+    NAV_LIFECYCLE.clear(client, chat_id)
     CURRENT_MENU[chat_id] = None
     CURRENT_NAV_STATE[chat_id] = None
 
-def get_system_info():
-    """Recopila información del sistema y la retorna en un formato bonito."""
-    os_info = platform.platform()
-    hostname = socket.gethostname()
-    
+SYSINFO_REFRESH = 60        # Segundos entre refrescos de los datos locales del sistema
+SYSINFO_IP_REFRESH = 1800   # Segundos entre consultas de la IP pública
+
+def collect_local_info() -> dict:
+    """Recopila los datos locales del sistema (sin red)."""
     # Obtener direcciones IP locales de cada interfaz (IPv4)
     local_ips = []
     for interface_name, interface_addresses in psutil.net_if_addrs().items():
         for addr in interface_addresses:
             if addr.family == socket.AF_INET:
                 local_ips.append(f"   • {interface_name}: {addr.address}")
-    
-    # Obtener IP pública (utilizando ipify)
-    try:
-        public_ip = requests.get("https://api.ipify.org", timeout=5).text
-    except Exception:
-        public_ip = "N/A"
-    
+
     # Información del procesador (incluyendo frecuencia si es posible)
     processor = platform.processor()
     try:
@@ -109,23 +622,352 @@ def get_system_info():
         processor += f" ({freq:.0f} MHz)"
     except Exception:
         pass
-    
+
     # Memoria RAM total
     try:
         ram = psutil.virtual_memory().total
         ram_str = f"{ram / (1024 ** 3):.1f} GB"
     except Exception:
         ram_str = "N/A"
-    
-    info = (
-        f"🖥️ Sistema: {os_info}\n"
-        f"🏷️ Host: {hostname}\n"
-        f"🌐 IP Pública: {public_ip}\n"
-        f"📡 IPs Locales:\n" + "\n".join(local_ips) + "\n"
-        f"⚙️ Procesador: {processor}\n"
-        f"💾 RAM: {ram_str}"
-    )
-    return info
+
+    return {
+        "os_info": platform.platform(),
+        "hostname": socket.gethostname(),
+        "local_ips": local_ips,
+        "processor": processor,
+        "ram": ram_str,
+    }
+
+def fetch_public_ip() -> str:
+    """Obtiene la IP pública (utilizando ipify)."""
+    try:
+        return requests.get("https://api.ipify.org", timeout=5).text
+    except Exception:
+        return "N/A"
+
+def format_age(seconds: float) -> str:
+    """Convierte una antigüedad en segundos en un texto corto."""
+    seconds = int(max(0, seconds))
+    if seconds < 60:
+        return f"{seconds} s"
+    if seconds < 3600:
+        return f"{seconds // 60} min"
+    return f"{seconds // 3600} h {seconds % 3600 // 60} min"
+
+class SystemInfoService:
+    """
+    Mantiene en segundo plano una instantánea de la información del sistema:
+    los datos locales cada SYSINFO_REFRESH segundos y la IP pública cada SYSINFO_IP_REFRESH.
+    El panel principal se sirve de la instantánea sin esperar a la red.
+    """
+
+    def __init__(self):
+        self.local = None
+        self.local_at = None
+        self.public_ip = None
+        self.public_ip_at = None
+        self._tasks = []
+
+    async def refresh_local(self):
+        self.local = await IO_POOL.run(collect_local_info)
+        self.local_at = time.time()
+
+    async def refresh_public_ip(self):
+        self.public_ip = await IO_POOL.run(fetch_public_ip)
+        self.public_ip_at = time.time()
+
+    async def _periodic(self, refresh, interval: float, name: str):
+        while True:
+            try:
+                await refresh()
+            except Exception as e:
+                logger.warning(f"Error refrescando {name}: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self):
+        """Arranca los refrescos periódicos (idempotente)."""
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._periodic(self.refresh_local, SYSINFO_REFRESH, "la información local")),
+            asyncio.create_task(self._periodic(self.refresh_public_ip, SYSINFO_IP_REFRESH, "la IP pública")),
+        ]
+
+    async def render(self) -> str:
+        """Información del sistema en un formato bonito, con la antigüedad de los datos."""
+        self.start()
+        if self.local is None:
+            await self.refresh_local()
+        local = self.local
+        public_ip = self.public_ip if self.public_ip is not None else "obteniendo..."
+        return (
+            f"🖥️ Sistema: {local['os_info']}\n"
+            f"🏷️ Host: {local['hostname']}\n"
+            f"🌐 IP Pública: {public_ip}\n"
+            f"📡 IPs Locales:\n" + "\n".join(local["local_ips"]) + "\n"
+            f"⚙️ Procesador: {local['processor']}\n"
+            f"💾 RAM: {local['ram']}\n"
+            f"🕒 Datos de hace {format_age(time.time() - self.local_at)}"
+        )
+
+SYSINFO = SystemInfoService()
+
+# ----------------------------------------------------------------
+# Instantáneas de procesos con psutil (ordenables y paginadas)
+
+PROCESS_CACHE_TTL = 5.0      # Segundos durante los que se reutiliza una instantánea (paginar no vuelve a medir)
+PROCESS_CPU_SAMPLE = 0.5     # Separación mínima entre las dos muestras de CPU
+PROCESS_PRIME_MAX_AGE = 30.0 # Si la muestra anterior es más vieja, se vuelve a cebar
+PROCESSES_PER_PAGE = 15
+PROCESS_SORT_KEYS = {"cpu": "CPU", "mem": "RAM", "io": "E/S"}
+
+ProcessInfo = namedtuple("ProcessInfo", ["pid", "name", "cpu", "rss", "io_rate"])
+
+class ProcessSnapshotter:
+    """
+    Toma instantáneas de procesos con psutil.process_iter leyendo los atributos de cada
+    proceso dentro de oneshot(). Los objetos Process se conservan entre llamadas, así que
+    cpu_percent() mide contra la muestra anterior; si no hay una muestra previa útil se
+    ceba y se espera PROCESS_CPU_SAMPLE segundos. La E/S se da como tasa (bytes/s).
+    Es bloqueante: se llama desde IO_POOL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = {}    # {pid: psutil.Process}
+        self._io_prev = {}  # {pid: bytes de E/S acumulados en la muestra anterior}
+        self._sampled_at = 0.0
+        self._snapshot = None
+        self._taken_at = 0.0
+        self._cpu_count = psutil.cpu_count() or 1
+        self.hits = 0
+        self.misses = 0
+
+    def _prime(self):
+        procs = {}
+        for proc in psutil.process_iter():
+            try:
+                proc.cpu_percent(None)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            procs[proc.pid] = proc
+        self._procs = procs
+        self._sampled_at = time.monotonic()
+
+    def snapshot(self):
+        """Lista de ProcessInfo, reutilizada durante PROCESS_CACHE_TTL segundos."""
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is not None and now - self._taken_at < PROCESS_CACHE_TTL:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            age = now - self._sampled_at
+            if not self._procs or age > PROCESS_PRIME_MAX_AGE:
+                self._prime()
+                age = 0.0
+            if age < PROCESS_CPU_SAMPLE:
+                time.sleep(PROCESS_CPU_SAMPLE - age)
+            elapsed = time.monotonic() - self._sampled_at
+            rows = []
+            procs = {}
+            io_now = {}
+            for proc in psutil.process_iter():
+                previous = self._procs.get(proc.pid)
+                if previous is not None and previous == proc:  # Mismo pid y misma hora de creación
+                    proc = previous
+                try:
+                    with proc.oneshot():
+                        name = proc.name()
+                        cpu = proc.cpu_percent(None) / self._cpu_count
+                        rss = proc.memory_info().rss
+                        try:
+                            counters = proc.io_counters()
+                            io_now[proc.pid] = counters.read_bytes + counters.write_bytes
+                        except (psutil.AccessDenied, AttributeError):
+                            pass
+                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                    continue
+                procs[proc.pid] = proc
+                io_rate = 0.0
+                if proc.pid in io_now and proc.pid in self._io_prev and elapsed > 0:
+                    io_rate = max(0.0, (io_now[proc.pid] - self._io_prev[proc.pid]) / elapsed)
+                rows.append(ProcessInfo(proc.pid, name, cpu, rss, io_rate))
+            self._procs = procs
+            self._io_prev = io_now
+            self._sampled_at = time.monotonic()
+            self._snapshot = rows
+            self._taken_at = self._sampled_at
+            return rows
+
+    def sorted_snapshot(self, sort: str):
+        rows = self.snapshot()
+        key = {"cpu": lambda p: p.cpu, "mem": lambda p: p.rss, "io": lambda p: p.io_rate}.get(sort, lambda p: p.cpu)
+        return sorted(rows, key=key, reverse=True)
+
+    def stats(self) -> str:
+        return f"procesos seguidos {len(self._procs)}, aciertos de caché {self.hits}, fallos {self.misses}"
+
+PROCESSES = ProcessSnapshotter()
+
+# ----------------------------------------------------------------
+# Historial de recursos en búferes circulares y gráfica de la última hora
+
+RESOURCE_SAMPLE_INTERVAL = 5.0    # Segundos entre muestras (solo contadores globales, sin recorrer procesos)
+RESOURCE_HISTORY_SECONDS = 3600   # Ventana de historial guardada
+RESOURCE_TOP_PROCESSES = 5        # Procesos con más CPU mostrados junto a la gráfica
+
+class RingBuffer:
+    """Búfer circular de tamaño fijo respaldado por un array de floats."""
+
+    __slots__ = ("_data", "_index", "_count")
+
+    def __init__(self, capacity: int):
+        self._data = array("d", bytes(8 * capacity))
+        self._count = 0
+        self._index = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value: float):
+        self._data[self._index] = value
+        self._index = (self._index + 1) % len(self._data)
+        self._count = min(self._count + 1, len(self._data))
+
+    def values(self) -> list:
+        """Valores en orden cronológico (del más antiguo al más reciente)."""
+        if self._count < len(self._data):
+            return self._data[:self._count].tolist()
+        return (self._data[self._index:] + self._data[:self._index]).tolist()
+
+class ResourceSampler:
+    """
+    Muestreador de fondo de CPU, memoria, disco y red (tasas a partir de contadores).
+    Cada muestra son cuatro llamadas globales de psutil; los procesos no se recorren aquí,
+    sino solo cuando se piden (/chart, lista de procesos). Todo se guarda en búferes
+    circulares, así que la memoria usada es fija.
+    """
+
+    SERIES = ("time", "cpu", "mem", "disk_read", "disk_write", "net_sent", "net_recv")
+
+    def __init__(self, interval: float = RESOURCE_SAMPLE_INTERVAL, history: float = RESOURCE_HISTORY_SECONDS):
+        self.interval = interval
+        self.capacity = max(2, int(history / interval))
+        self.series = {name: RingBuffer(self.capacity) for name in self.SERIES}
+        self._lock = threading.Lock()
+        self._previous = None  # (instante, disco, red)
+        self._task = None
+
+    def sample(self):
+        """Toma una muestra (bloqueante, se ejecuta en IO_POOL)."""
+        now = time.time()
+        cpu = psutil.cpu_percent(None)
+        mem = psutil.virtual_memory().percent
+        disk = psutil.disk_io_counters()
+        net = psutil.net_io_counters()
+        rates = [0.0, 0.0, 0.0, 0.0]
+        if self._previous is not None:
+            prev_time, prev_disk, prev_net = self._previous
+            elapsed = max(now - prev_time, 1e-6)
+            if disk and prev_disk:
+                rates[0] = max(0.0, (disk.read_bytes - prev_disk.read_bytes) / elapsed)
+                rates[1] = max(0.0, (disk.write_bytes - prev_disk.write_bytes) / elapsed)
+            rates[2] = max(0.0, (net.bytes_sent - prev_net.bytes_sent) / elapsed)
+            rates[3] = max(0.0, (net.bytes_recv - prev_net.bytes_recv) / elapsed)
+        self._previous = (now, disk, net)
+        with self._lock:
+            for name, value in zip(self.SERIES, (now, cpu, mem, *rates)):
+                self.series[name].append(value)
+
+    def export(self) -> dict:
+        """Copia de los datos como listas (se puede enviar al pool de procesos)."""
+        with self._lock:
+            data = {name: ring.values() for name, ring in self.series.items()}
+        return data
+
+    async def _run(self):
+        while True:
+            try:
+                await IO_POOL.run(self.sample)
+            except Exception as e:
+                logger.warning(f"Error muestreando recursos: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stats(self) -> str:
+        return f"{len(self.series['time'])}/{self.capacity} muestras cada {self.interval:.0f} s"
+
+RESOURCES = ResourceSampler()
+
+def render_resource_chart(data: dict, width: int = 900, panel_height: int = 150) -> bytes:
+    """
+    Dibuja con PIL las series de la última hora (CPU y RAM en %, disco y red en MB/s)
+    como una imagen PNG de cuatro paneles. Se ejecuta en el pool de procesos.
+    """
+    panels = [
+        ("CPU %", [(data["cpu"], (220, 60, 60))], 100.0),
+        ("RAM %", [(data["mem"], (60, 120, 220))], 100.0),
+        ("Disco MB/s (lectura / escritura)", [
+            ([v / 1024 ** 2 for v in data["disk_read"]], (40, 160, 80)),
+            ([v / 1024 ** 2 for v in data["disk_write"]], (230, 140, 30)),
+        ], None),
+        ("Red MB/s (envío / recepción)", [
+            ([v / 1024 ** 2 for v in data["net_sent"]], (150, 70, 200)),
+            ([v / 1024 ** 2 for v in data["net_recv"]], (30, 170, 190)),
+        ], None),
+    ]
+    margin = 40
+    img = Image.new("RGB", (width, panel_height * len(panels)), "white")
+    draw = ImageDraw.Draw(img)
+    times = data["time"]
+    end = times[-1] if times else time.time()
+    start = end - RESOURCE_HISTORY_SECONDS
+    plot_width = width - 2 * margin
+    for index, (title, lines, fixed_max) in enumerate(panels):
+        top = index * panel_height + 20
+        bottom = (index + 1) * panel_height - 10
+        peak = fixed_max or max([max(values, default=0.0) for values, _ in lines] + [0.1])
+        draw.rectangle([margin, top, width - margin, bottom], outline=(200, 200, 200))
+        draw.text((margin, top - 16), f"{title} · máx. {peak:.1f}", fill="black")
+        for values, color in lines:
+            points = [
+                (margin + (t - start) / RESOURCE_HISTORY_SECONDS * plot_width,
+                 bottom - min(v, peak) / peak * (bottom - top))
+                for t, v in zip(times, values) if t >= start
+            ]
+            if len(points) > 1:
+                draw.line(points, fill=color, width=2)
+    bio = io.BytesIO()
+    img.save(bio, format="PNG", optimize=True)
+    return bio.getvalue()
+
+def render_process_page(rows, sort: str, page: int):
+    """Texto y teclado de una página de procesos ordenados."""
+    pages = max(1, (len(rows) + PROCESSES_PER_PAGE - 1) // PROCESSES_PER_PAGE)
+    page = min(max(page, 0), pages - 1)
+    start = page * PROCESSES_PER_PAGE
+    lines = [f"📋 Procesos activos: {len(rows)} · orden {PROCESS_SORT_KEYS[sort]} · página {page + 1}/{pages}", ""]
+    for n, proc in enumerate(rows[start:start + PROCESSES_PER_PAGE], start=start + 1):
+        lines.append(
+            f"{n}. {proc.name} (PID {proc.pid})\n"
+            f"    CPU {proc.cpu:.1f}% · RAM {format_size(proc.rss)} · E/S {format_size(proc.io_rate)}/s"
+        )
+    sort_row = [
+        InlineKeyboardButton(("✅ " if key == sort else "") + label, callback_data=f"procs|{key}|0")
+        for key, label in PROCESS_SORT_KEYS.items()
+    ]
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("◀️", callback_data=f"procs|{sort}|{page - 1}"))
+    nav_row.append(InlineKeyboardButton("🔄", callback_data=f"procs|{sort}|{page}"))
+    if page < pages - 1:
+        nav_row.append(InlineKeyboardButton("▶️", callback_data=f"procs|{sort}|{page + 1}"))
+    markup = InlineKeyboardMarkup([sort_row, nav_row, [InlineKeyboardButton("🏠 Inicio", callback_data="home")]])
+    return "\n".join(lines), markup
 
 def format_size(size):
     """Convierte tamaño en bytes a una representación legible."""
@@ -147,6 +989,647 @@ def list_drives():
         drives.append("/")
     return drives
 
+# ----------------------------------------------------------------
+# Instantáneas de directorios: una sola pasada de os.scandir por carpeta,
+# compartida por los handlers de unidades, carpetas y listados.
+
+DIR_CACHE_MAX = 128    # Número máximo de directorios guardados en caché
+DIR_CACHE_TTL = 60.0   # Segundos tras los que se revalida aunque no cambie el mtime
+
+FileEntry = namedtuple("FileEntry", ["name", "path", "size", "ctime", "mtime"])
+
+class DirSnapshot:
+    """Contenido de un directorio (subcarpetas y archivos con su stat) en un instante dado."""
+
+    def __init__(self, path: str, mtime: int, folders: list, files: list):
+        self.path = path
+        self.mtime = mtime
+        self.folders = folders  # [nombre]
+        self.files = files      # [FileEntry]
+        self.taken_at = time.monotonic()
+        self._extensions = None
+
+    def top_extensions(self):
+        """Extensiones más frecuentes de la carpeta, para los botones de filtro (se calculan una vez)."""
+        if self._extensions is None:
+            counts = {}
+            for f in self.files:
+                ext = os.path.splitext(f.name)[1].lower()
+                if ext and len(ext) <= 12:
+                    counts[ext] = counts.get(ext, 0) + 1
+            self._extensions = [ext for ext, _ in sorted(counts.items(), key=lambda item: -item[1])[:LISTING_TOP_EXTENSIONS]]
+        return self._extensions
+
+DIR_SNAPSHOTS = OrderedDict()  # {path: DirSnapshot} en orden LRU
+DIR_SNAPSHOTS_LOCK = threading.Lock()  # Las instantáneas se generan desde IO_POOL
+
+def scan_directory(path: str):
+    """
+    Recorre el directorio con os.scandir y devuelve (subcarpetas, archivos).
+    Se aprovechan el tipo y el stat que DirEntry ya trae en caché (en Windows sin syscalls extra).
+    """
+    folders = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    folders.append(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append(FileEntry(entry.name, entry.path, st.st_size, st.st_ctime, st.st_mtime))
+            except OSError:
+                continue
+    return folders, files
+
+def get_dir_snapshot(path: str) -> DirSnapshot:
+    """
+    Devuelve la instantánea del directorio, reutilizando la de caché si el mtime
+    del directorio no ha cambiado. Lanza OSError si no se puede acceder.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with DIR_SNAPSHOTS_LOCK:
+        snapshot = DIR_SNAPSHOTS.get(path)
+        if snapshot and snapshot.mtime == mtime and time.monotonic() - snapshot.taken_at < DIR_CACHE_TTL:
+            DIR_SNAPSHOTS.move_to_end(path)
+            return snapshot
+    folders, files = scan_directory(path)
+    snapshot = DirSnapshot(path, mtime, folders, files)
+    with DIR_SNAPSHOTS_LOCK:
+        DIR_SNAPSHOTS[path] = snapshot
+        DIR_SNAPSHOTS.move_to_end(path)
+        while len(DIR_SNAPSHOTS) > DIR_CACHE_MAX:
+            DIR_SNAPSHOTS.popitem(last=False)
+    return snapshot
+
+# ----------------------------------------------------------------
+# Listados de archivos: instantánea ordenada y filtrada, paginada por cursor
+
+LISTING_SORTS = {
+    # clave: (función de orden, descendente, etiqueta)
+    "ctime": (lambda f: (f.ctime, f.name), True, "📅 Creación"),
+    "mtime": (lambda f: (f.mtime, f.name), True, "🕒 Modificación"),
+    "size": (lambda f: (f.size, f.name), True, "📏 Tamaño"),
+    "name": (lambda f: (f.name.casefold(), f.name), False, "🔤 Nombre"),
+}
+LISTING_DEFAULT_SORT = "ctime"
+LISTING_PAGE_SIZES = (5, 10, 20)
+LISTING_DEFAULT_PAGE_SIZE = 10
+LISTING_DEFAULT_COMPACT = False  # Por defecto, miniaturas; el modo compacto se elige por chat con su botón
+LISTING_MAX = 300          # Listados recordados (cada uno referenciado por un cursor corto)
+LISTING_MAX_ENTRIES = 1000000  # Entradas (filtradas) sumando todos los listados recordados
+LISTING_TOPK_MIN = 2000    # Por debajo de este número de archivos se ordena todo de una vez
+LISTING_TOPK_RATIO = 8     # Orden parcial mientras se necesite menos de 1/8 del listado
+LISTING_TOP_EXTENSIONS = 4 # Extensiones ofrecidas como filtro rápido
+MEDIA_GROUP_MAX = 10       # Fotos por álbum admitidas por Telegram
+
+def match_pattern(name: str, pattern: str) -> bool:
+    """Filtro de listado: glob ('*.iso', 'IMG_*') o lista de extensiones ('jpg,png')."""
+    if not pattern:
+        return True
+    name = name.lower()
+    pattern = pattern.lower()
+    if any(ch in pattern for ch in "*?["):
+        return fnmatch.fnmatchcase(name, pattern)
+    extensions = {"." + ext.strip().lstrip(".") for ext in pattern.split(",") if ext.strip()}
+    return os.path.splitext(name)[1] in extensions
+
+class FileListing:
+    """
+    Listado de los archivos de una instantánea de directorio con un orden y un filtro.
+    Las páginas siempre salen de la misma instantánea, aunque la carpeta cambie entre tanto.
+    En directorios grandes las primeras páginas se sirven con una ordenación parcial
+    (heapq top-k) y solo se ordena todo cuando se avanza lo suficiente.
+    """
+
+    def __init__(self, snapshot: DirSnapshot, sort: str, pattern: str, page_size: int, compact: bool = False):
+        self.path = snapshot.path
+        self.sort = sort if sort in LISTING_SORTS else LISTING_DEFAULT_SORT
+        self.pattern = pattern
+        self.page_size = page_size
+        self.compact = compact
+        self.snapshot = snapshot  # Compartida con los demás listados de la misma carpeta
+        self.files = [f for f in snapshot.files if match_pattern(f.name, pattern)]
+        self._sorted = None  # Listado completo ordenado
+        self._top = []       # Prefijo ordenado (orden parcial)
+        self._lock = threading.Lock()
+
+    @property
+    def page_count(self) -> int:
+        return max(1, math.ceil(len(self.files) / self.page_size))
+
+    def _ordered(self, needed: int):
+        key, descending, _ = LISTING_SORTS[self.sort]
+        if self._sorted is not None or needed <= len(self._top):
+            return self._sorted if self._sorted is not None else self._top
+        if len(self.files) >= LISTING_TOPK_MIN and needed * LISTING_TOPK_RATIO <= len(self.files):
+            # Se pide el doble de lo necesario para que las páginas siguientes no repitan el trabajo
+            k = max(2 * needed, 2 * len(self._top))
+            select = heapq.nlargest if descending else heapq.nsmallest
+            self._top = select(k, self.files, key=key)
+            return self._top
+        self._sorted = sorted(self.files, key=key, reverse=descending)
+        self._top = []
+        return self._sorted
+
+    def page(self, number: int):
+        """Archivos de la página 'number' (desde 0); pensado para ejecutarse en IO_POOL."""
+        start = number * self.page_size
+        with self._lock:
+            return self._ordered(start + self.page_size)[start:start + self.page_size]
+
+    def entry(self, index: int):
+        """Archivo en la posición 'index' del orden del listado, o None."""
+        if not 0 <= index < len(self.files):
+            return None
+        with self._lock:
+            return self._ordered(index + 1)[index]
+
+    def top_extensions(self):
+        """Extensiones más frecuentes de la carpeta, para los botones de filtro."""
+        return self.snapshot.top_extensions()
+
+    def describe(self, page: int) -> str:
+        text = f"página {page + 1}/{self.page_count} · {len(self.files)} archivos · orden {LISTING_SORTS[self.sort][2]}"
+        if self.pattern:
+            text += f" · filtro {self.pattern}"
+        return text
+
+# {cursor: FileListing}; la memoria se acota por el total de entradas, no solo por número de listados
+LISTINGS = PathRegistry(max_size=LISTING_MAX, weigh=lambda listing: len(listing.files), max_weight=LISTING_MAX_ENTRIES)
+LISTING_PREFS = {}  # {chat_id: {"sort": orden, "page_size": tamaño de página}} => últimas opciones usadas
+
+# ----------------------------------------------------------------
+# Tamaño de carpetas: recorrido paralelo con agregados por directorio en caché
+
+FOLDER_SIZE_WORKERS = 4             # Subárboles medidos en paralelo
+FOLDER_SIZE_CACHE_MAX = 200000      # Directorios con agregado guardado como máximo
+FOLDER_SIZE_UPDATE_INTERVAL = 2.0   # Segundos entre actualizaciones de resultados parciales
+FOLDER_SIZE_MAX_LISTED = 30         # Subcarpetas mostradas (las más grandes)
+FOLDER_SIZE_CACHE_TTL = 6 * 3600    # Caducidad de seguridad; para datos al momento está el botón «Recalcular»
+FOLDER_SIZE_SPLIT_DIRS = 64         # Directorios que recorre cada tarea antes de repartir lo que le queda
+FOLDER_SIZE_SPLIT_PATHS = 16        # Directorios pendientes entregados a cada nueva tarea
+
+DirAggregate = namedtuple("DirAggregate", ["mtime", "taken_at", "own_bytes", "own_files", "children"])
+
+class FolderSizeService:
+    """
+    Calcula tamaños de carpetas. Por cada directorio se guarda, asociado a su mtime,
+    el total de sus archivos directos y la lista de subdirectorios, así que al repetir
+    una consulta solo se vuelven a listar los directorios modificados: el resto cuesta un stat.
+    Como escribir dentro de un archivo no toca el mtime de la carpeta, el agregado solo caduca
+    a los FOLDER_SIZE_CACHE_TTL segundos; «Recalcular» vuelve a listar el árbol entero.
+    El recorrido se reparte en trozos entre los hilos de un pool propio (sin acaparar IO_POOL),
+    de modo que una subcarpeta enorme la miden varios hilos a la vez.
+    """
+
+    def __init__(self):
+        self._cache = OrderedDict()  # {ruta: DirAggregate} en orden LRU
+        self._lock = threading.Lock()
+        self.pool = ManagedExecutor("sizes", ThreadPoolExecutor, FOLDER_SIZE_WORKERS)
+        self.listed = 0
+        self.reused = 0
+
+    def dir_info(self, path: str, refresh: bool = False) -> DirAggregate:
+        """Agregado de un directorio, recalculado si cambió su mtime, caducó o se pide 'refresh' (bloqueante)."""
+        mtime = os.stat(path).st_mtime_ns
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(path)
+            if not refresh and cached is not None and cached.mtime == mtime and now - cached.taken_at < FOLDER_SIZE_CACHE_TTL:
+                self._cache.move_to_end(path)
+                self.reused += 1
+                return cached
+        own_bytes = 0
+        own_files = 0
+        children = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        children.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        own_bytes += entry.stat(follow_symlinks=False).st_size
+                        own_files += 1
+                except OSError:
+                    continue
+        info = DirAggregate(mtime, now, own_bytes, own_files, tuple(children))
+        with self._lock:
+            self._cache[path] = info
+            self._cache.move_to_end(path)
+            self.listed += 1
+            while len(self._cache) > FOLDER_SIZE_CACHE_MAX:
+                self._cache.popitem(last=False)
+        return info
+
+    def walk_chunk(self, paths, refresh: bool = False):
+        """
+        Recorre como mucho FOLDER_SIZE_SPLIT_DIRS directorios partiendo de 'paths' (bloqueante).
+        Devuelve (bytes, archivos, directorios pendientes) para repartir el resto.
+        """
+        total_bytes = 0
+        total_files = 0
+        stack = list(paths)
+        walked = 0
+        while stack and walked < FOLDER_SIZE_SPLIT_DIRS:
+            try:
+                info = self.dir_info(stack.pop(), refresh)
+            except OSError:
+                continue
+            walked += 1
+            total_bytes += info.own_bytes
+            total_files += info.own_files
+            stack.extend(info.children)
+        return total_bytes, total_files, stack
+
+    async def tree_size(self, path: str, refresh: bool = False):
+        """Devuelve (bytes, archivos) del árbol bajo 'path', repartiendo los trozos entre los hilos del pool."""
+        total_bytes = 0
+        total_files = 0
+        pending = {asyncio.ensure_future(self.pool.run(self.walk_chunk, [path], refresh))}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for chunk in done:
+                    chunk_bytes, chunk_files, rest = chunk.result()
+                    total_bytes += chunk_bytes
+                    total_files += chunk_files
+                    for i in range(0, len(rest), FOLDER_SIZE_SPLIT_PATHS):
+                        batch = rest[i:i + FOLDER_SIZE_SPLIT_PATHS]
+                        pending.add(asyncio.ensure_future(self.pool.run(self.walk_chunk, batch, refresh)))
+        finally:
+            for chunk in pending:
+                chunk.cancel()
+        return total_bytes, total_files
+
+    async def subfolder_sizes(self, path: str, on_progress, refresh: bool = False):
+        """
+        Mide cada subcarpeta de 'path' en paralelo. Tras cada subcarpeta terminada se llama a
+        on_progress(resultados, hechas, total, archivos propios) con los resultados parciales.
+        Con 'refresh' se ignora la caché y se vuelve a listar todo el árbol.
+        Devuelve la lista final de (ruta, bytes, archivos).
+        """
+        info = await IO_POOL.run(self.dir_info, path, refresh)
+
+        async def measure(child):
+            return (child, *await self.tree_size(child, refresh))
+
+        results = []
+        pending = [asyncio.create_task(measure(child)) for child in info.children]
+        own = (info.own_bytes, info.own_files)
+        try:
+            for finished in asyncio.as_completed(pending):
+                results.append(await finished)
+                await on_progress(results, len(results), len(pending), own)
+        finally:
+            for task in pending:
+                task.cancel()
+        return results, own
+
+    def stats(self) -> str:
+        with self._lock:
+            cached = len(self._cache)
+        return f"{cached} directorios en caché, listados {self.listed}, reutilizados {self.reused}"
+
+FOLDER_SIZES = FolderSizeService()
+
+# ----------------------------------------------------------------
+# Carpetas como archivo tar generado al vuelo (sin ficheros temporales)
+
+ARCHIVE_VOLUME_SIZE = 1950 * 1024 * 1024  # Volúmenes por debajo del límite de 2 GB por archivo
+
+ArchiveMember = namedtuple("ArchiveMember", ["start", "header_size", "path", "arcname", "size", "mtime", "is_dir"])
+
+def tar_header(arcname: str, size: int, mtime: float, is_dir: bool) -> bytes:
+    """Cabecera tar (PAX, admite nombres largos y unicode) de una entrada; siempre la misma para los mismos datos."""
+    info = tarfile.TarInfo(arcname)
+    info.mtime = int(mtime)
+    if is_dir:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.size = size
+        info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8", errors="surrogateescape")
+
+class TarLayout:
+    """
+    Disposición de un tar virtual de una carpeta: recorre el árbol una vez con scandir y
+    calcula dónde empieza cada entrada, de modo que el tamaño total se conoce de antemano y
+    cualquier rango de bytes se puede generar bajo demanda. Solo se guardan los metadatos;
+    las cabeceras se regeneran al leer.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.name = os.path.basename(os.path.normpath(root)) or "archivo"
+        self.members = []
+        self.starts = []
+        self.files = 0
+        self.payload = 0
+        self._offset = 0
+        stack = [(root, self.name)]
+        while stack:
+            path, arcname = stack.pop()
+            try:
+                st = os.stat(path)
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                logger.warning(f"Omitiendo carpeta en el archivo {path}: {e}")
+                continue
+            self._add(path, arcname, 0, st.st_mtime, True)
+            subdirs = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, f"{arcname}/{entry.name}"))
+                    elif entry.is_file(follow_symlinks=False):
+                        est = entry.stat(follow_symlinks=False)
+                        self._add(entry.path, f"{arcname}/{entry.name}", est.st_size, est.st_mtime, False)
+                        self.files += 1
+                        self.payload += est.st_size
+                except OSError:
+                    continue
+            stack.extend(reversed(subdirs))
+        self.data_end = self._offset
+        # Dos bloques vacíos de fin de archivo, redondeando al tamaño de registro estándar
+        size = self.data_end + 2 * tarfile.BLOCKSIZE
+        self.size = size + (-size % tarfile.RECORDSIZE)
+
+    def _add(self, path: str, arcname: str, size: int, mtime: float, is_dir: bool):
+        header_size = len(tar_header(arcname, size, mtime, is_dir))
+        self.members.append(ArchiveMember(self._offset, header_size, path, arcname, size, mtime, is_dir))
+        self.starts.append(self._offset)
+        self._offset += header_size + size + (-size % tarfile.BLOCKSIZE)
+
+    def volumes(self, volume_size: int = ARCHIVE_VOLUME_SIZE):
+        """Lista de (inicio, fin, nombre) de cada volumen; un único volumen no lleva sufijo."""
+        count = max(1, math.ceil(self.size / volume_size))
+        if count == 1:
+            return [(0, self.size, f"{self.name}.tar")]
+        return [
+            (n * volume_size, min(self.size, (n + 1) * volume_size), f"{self.name}.tar.{n + 1:03d}")
+            for n in range(count)
+        ]
+
+class TarVolume(io.RawIOBase):
+    """
+    Vista de solo lectura y con seek sobre el rango [start, end) de un TarLayout. Pyrogram la
+    lee por trozos como si fuera un archivo; los datos salen directamente de los archivos originales.
+    """
+
+    def __init__(self, layout: TarLayout, start: int, end: int, name: str):
+        super().__init__()
+        self.layout = layout
+        self.start = start
+        self.length = end - start
+        self.name = name
+        self._pos = 0
+        self._fh = None
+        self._fh_path = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self._pos = max(0, min(offset, self.length))
+        return self._pos
+
+    def readinto(self, buffer):
+        want = min(len(buffer), self.length - self._pos)
+        view = memoryview(buffer)
+        filled = 0
+        while filled < want:
+            chunk = self._read_at(self.start + self._pos, want - filled)
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+            self._pos += len(chunk)
+        return filled
+
+    def _read_at(self, offset: int, limit: int) -> bytes:
+        """Bytes a partir de 'offset' (absoluto en el tar) sin cruzar el final de una entrada."""
+        layout = self.layout
+        if offset >= layout.data_end:
+            return bytes(min(limit, layout.size - offset))
+        i = bisect.bisect_right(layout.starts, offset) - 1
+        member = layout.members[i]
+        member_end = layout.starts[i + 1] if i + 1 < len(layout.starts) else layout.data_end
+        rel = offset - member.start
+        if rel < member.header_size:
+            header = tar_header(member.arcname, member.size, member.mtime, member.is_dir)
+            return header[rel:rel + limit]
+        rel -= member.header_size
+        if rel < member.size:
+            return self._file_bytes(member, rel, min(limit, member.size - rel))
+        return bytes(min(limit, member_end - offset))
+
+    def _file_bytes(self, member: ArchiveMember, offset: int, length: int) -> bytes:
+        try:
+            if self._fh_path != member.path:
+                self._release()
+                self._fh = open(member.path, "rb")
+                self._fh_path = member.path
+            self._fh.seek(offset)
+            data = self._fh.read(length)
+        except OSError as e:
+            logger.warning(f"No se pudo leer {member.path} para el archivo: {e}")
+            data = b""
+        # Si el archivo ha encogido desde el recorrido se rellena con ceros para mantener el tamaño
+        if len(data) < length:
+            data += bytes(length - len(data))
+        return data
+
+    def _release(self):
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = None
+        self._fh_path = None
+
+    def close(self):
+        # Pyrogram cierra el archivo al terminar cada intento; solo se suelta el descriptor
+        # abierto para que un reintento (por ejemplo tras un FloodWait) pueda volver a leer.
+        self._release()
+
+# ----------------------------------------------------------------
+# Transferencias reanudables: subida por partes de archivos grandes y descargas con diario
+
+UPLOAD_SINGLE_LIMIT = 2000 * 1024 * 1024  # Tamaño máximo que Telegram acepta en un solo archivo
+UPLOAD_PART_SIZE = ARCHIVE_VOLUME_SIZE    # Tamaño de cada parte de un archivo dividido
+MANIFEST_MAX_TEXT = 3800                  # Por encima, el manifiesto se envía como archivo .sha256
+
+class FileRange(io.RawIOBase):
+    """
+    Vista de solo lectura sobre el rango [start, end) de un archivo, sin copiarlo. Calcula el
+    SHA-256 del rango mientras Pyrogram lo lee secuencialmente; si la lectura no fue secuencial,
+    digest() devuelve None y hay que calcularlo aparte con compute_digest().
+    """
+
+    def __init__(self, path: str, start: int, end: int, name: str):
+        super().__init__()
+        self.path = path
+        self.start = start
+        self.length = end - start
+        self.name = name
+        self._pos = 0
+        self._fh = None
+        self._hash = hashlib.sha256()
+        self._hashed = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self._pos = max(0, min(offset, self.length))
+        return self._pos
+
+    def readinto(self, buffer):
+        want = min(len(buffer), self.length - self._pos)
+        if want <= 0:
+            return 0
+        if self._fh is None:
+            self._fh = open(self.path, "rb")
+        self._fh.seek(self.start + self._pos)
+        data = self._fh.read(want)
+        if len(data) < want:
+            raise IOError(f"El archivo {self.path} ha cambiado durante la subida")
+        memoryview(buffer)[:want] = data
+        if self._pos == self._hashed:
+            self._hash.update(data)
+            self._hashed += want
+        self._pos += want
+        return want
+
+    def digest(self):
+        return self._hash.hexdigest() if self._hashed == self.length else None
+
+    def compute_digest(self) -> str:
+        """SHA-256 del rango leyendo el archivo de nuevo (bloqueante)."""
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as fh:
+            fh.seek(self.start)
+            remaining = self.length
+            while remaining:
+                chunk = fh.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise IOError(f"El archivo {self.path} ha cambiado durante la subida")
+                digest.update(chunk)
+                remaining -= len(chunk)
+        return digest.hexdigest()
+
+    def close(self):
+        # Igual que TarVolume: se suelta el descriptor pero la vista sigue siendo reutilizable
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+class JournalStore:
+    """
+    Diarios JSON de transferencias en curso, uno por archivo '<id>.json' en 'directory'.
+    Se escriben de forma atómica para que un corte a mitad no deje un diario corrupto.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, journal_id: str) -> str:
+        return os.path.join(self.directory, f"{journal_id}.json")
+
+    def save(self, journal: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._path(journal["id"]) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(journal, fh, ensure_ascii=False)
+        os.replace(tmp, self._path(journal["id"]))
+
+    def load(self, journal_id: str):
+        try:
+            with open(self._path(journal_id), encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def remove(self, journal_id: str):
+        try:
+            os.remove(self._path(journal_id))
+        except FileNotFoundError:
+            pass
+
+    def all(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        journals = []
+        for name in names:
+            if name.endswith(".json"):
+                journal = self.load(name[:-5])
+                if journal is not None:
+                    journals.append(journal)
+        return journals
+
+DOWNLOAD_CHUNK = 1024 * 1024         # Tamaño de trozo de stream_media (offsets en trozos)
+DOWNLOAD_CHECKPOINT_CHUNKS = 16      # Trozos descargados entre cada anotación en el diario
+
+def split_parts(size: int, part_size: int = UPLOAD_PART_SIZE):
+    """Lista de (inicio, fin) de cada parte de un archivo de 'size' bytes."""
+    return [(start, min(size, start + part_size)) for start in range(0, size, part_size)]
+
+def render_manifest(journal: dict) -> str:
+    """Manifiesto de un archivo subido por partes: checksums y cómo reconstruirlo."""
+    name = journal["name"]
+    parts = journal["parts"]
+    part_names = [f"{name}.{n:03d}" for n in range(1, len(parts) + 1)]
+    quoted = [f'"{part_name}"' for part_name in part_names]
+    lines = [
+        f"📦 Manifiesto de {name}",
+        f"💾 {format_size(journal['size'])} en {len(parts)} partes de hasta {format_size(journal['part_size'])}",
+        "",
+        "🔐 SHA-256 de cada parte:",
+    ]
+    lines += [f"{part['sha256']}  {part_name}" for part, part_name in zip(parts, part_names)]
+    lines += [
+        "",
+        "🧩 Para reconstruirlo:",
+        f"Windows: copy /b {' + '.join(quoted)} \"{name}\"",
+        f"Linux/macOS: cat {' '.join(quoted)} > \"{name}\"",
+        "Para verificar las partes: sha256sum -c con las líneas de arriba (certutil -hashfile <parte> SHA256 en Windows).",
+    ]
+    return "\n".join(lines)
+
+def get_drives_usage():
+    """Devuelve [(unidad, total, libre)] con los tamaños ya formateados."""
+    result = []
+    for drive in list_drives():
+        try:
+            usage = shutil.disk_usage(drive)
+            total = format_size(usage.total)
+            free = format_size(usage.free)
+        except Exception:
+            total, free = "N/A", "N/A"
+        result.append((drive, total, free))
+    return result
+
 def is_image(file_path: str) -> bool:
     """Determina si el archivo es una imagen según su extensión."""
     ext = os.path.splitext(file_path)[1].lower()
@@ -163,47 +1646,804 @@ def is_openable(file_path: str) -> bool:
     return ext in [".exe", ".bat", ".cmd", ".jpeg", ".jpg", ".png", ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".mkv", ".avi"]
 
 def generate_thumbnail(file_path: str, size=(300, 300)):
-    """Genera una miniatura de la imagen y la retorna como BytesIO."""
+    """Genera una miniatura de la imagen y la retorna como bytes JPEG."""
     try:
         with Image.open(file_path) as im:
             im.thumbnail(size)
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
             bio = io.BytesIO()
             im.save(bio, format="JPEG", quality=95)
-            bio.seek(0)
-            return bio
+            return bio.getvalue()
     except Exception as e:
         logger.warning(f"Error generando miniatura para {file_path}: {e}")
         return None
 
-def generate_video_thumbnail(file_path: str, size=(300, 300)):
+FFMPEG_MAX_PROCS = 3    # Procesos de FFmpeg simultáneos como máximo
+FFMPEG_TIMEOUT = 15.0   # Segundos máximos por miniatura de vídeo
+FFMPEG_SEMAPHORE = asyncio.Semaphore(FFMPEG_MAX_PROCS)
+FFMPEG_STATS = {"runs": 0, "timeouts": 0, "errors": 0}
+
+async def _ffmpeg_frame(file_path: str, seek: str, size) -> bytes:
+    """Extrae un fotograma como JPEG por la salida estándar de FFmpeg, o devuelve None."""
+    command = [
+        "ffmpeg", "-nostdin", "-loglevel", "error",
+        "-ss", seek,  # Búsqueda en la entrada: salta al keyframe sin decodificar desde el inicio
+        "-i", file_path,
+        "-frames:v", "1", "-an", "-sn",
+        "-vf", f"scale={size[0]}:{size[1]}:force_original_aspect_ratio=decrease",
+        "-q:v", "31",  # Calidad baja
+        "-f", "image2pipe", "-vcodec", "mjpeg", "pipe:1",
+    ]
+    async with FFMPEG_SEMAPHORE:
+        FFMPEG_STATS["runs"] += 1
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), FFMPEG_TIMEOUT)
+        except asyncio.TimeoutError:
+            FFMPEG_STATS["timeouts"] += 1
+            raise
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    if proc.returncode != 0 or not stdout:
+        FFMPEG_STATS["errors"] += 1
+        logger.warning(f"FFmpeg no devolvió fotograma para {file_path}: {stderr.decode(errors='replace').strip()}")
+        return None
+    return stdout
+
+async def generate_video_thumbnail(file_path: str, size=(300, 300)):
+    """
+    Genera una miniatura para un video usando FFmpeg y la retorna como bytes JPEG.
+    Se extrae un fotograma a 1 segundo (o el primero si el vídeo es más corto) buscando
+    antes de abrir la entrada, y la imagen llega por una tubería: no hay archivos temporales.
+    Requiere que FFmpeg esté instalado en el sistema.
+    """
+    try:
+        for seek in ("00:00:01.000", "0"):
+            data = await _ffmpeg_frame(file_path, seek, size)
+            if data:
+                return data
+    except asyncio.TimeoutError:
+        logger.warning(f"FFmpeg superó {FFMPEG_TIMEOUT:.0f}s con {file_path}")
+    except Exception as e:
+        logger.warning(f"Error generando miniatura para video {file_path}: {e}")
+    return None
+
+SCREEN_MIN_INTERVAL = 2.0        # Segundos mínimos entre fotogramas de la pantalla en vivo
+SCREEN_MAX_INTERVAL = 30.0       # Intervalo máximo cuando la pantalla no cambia
+SCREEN_CHANGE_THRESHOLD = 1.5    # Diferencia media (0-255) a partir de la cual hay cambios
+SCREEN_SIGNATURE_SIZE = (64, 36) # Resolución de la huella usada para comparar fotogramas
+
+def frame_signature(img) -> bytes:
+    """Huella barata de un fotograma: versión reducida en escala de grises."""
+    return img.resize(SCREEN_SIGNATURE_SIZE, Image.BILINEAR, reducing_gap=2.0).convert("L").tobytes()
+
+def signature_difference(a: bytes, b: bytes) -> float:
+    """Diferencia media absoluta entre dos huellas (0 = idénticas)."""
+    if not a or not b or len(a) != len(b):
+        return 255.0
+    return sum(abs(x - y) for x, y in zip(a, b)) / len(a)
+
+def encode_screen_frame(img, previous_signature: bytes = None, threshold: float = SCREEN_CHANGE_THRESHOLD,
+                        quality: int = 95, scale: float = 1.0, image_format: str = "JPEG", bio: io.BytesIO = None):
+    """
+    Compara el fotograma con la huella anterior y, si ha cambiado, lo codifica.
+    Devuelve (imagen, huella, diferencia); si el cambio no supera el umbral no se codifica
+    nada e imagen es None. En ese caso se conserva la huella anterior, para que los cambios
+    lentos se acumulen hasta superar el umbral.
+    'scale', 'quality' e 'image_format' (JPEG o WEBP) controlan la codificación; si se pasa
+    'bio', se codifica en ese búfer (vaciándolo antes) en lugar de crear uno nuevo.
+    """
+    signature = frame_signature(img)
+    difference = signature_difference(previous_signature, signature)
+    if difference < threshold:
+        return None, previous_signature, difference
+    if scale < 1.0:
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    if bio is None:
+        bio = io.BytesIO()
+    else:
+        bio.seek(0)
+        bio.truncate()
+    if image_format == "WEBP":
+        img.save(bio, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(bio, format="JPEG", quality=quality)
+    return bio.getvalue(), signature, difference
+
+LIVE_FRAME_BUDGET = 250 * 1024   # Bytes objetivo por fotograma de la pantalla en vivo
+LIVE_FRAME_FORMAT = "JPEG"       # "JPEG" o "WEBP"
+LIVE_TARGET_UPLOAD = 2.0         # Segundos de subida deseados por fotograma
+LIVE_QUALITY_RANGE = (35, 90)    # Calidad mínima y máxima
+LIVE_QUALITY_SOFT_MIN = 60       # Por debajo de esta calidad se prefiere reducir la escala
+LIVE_MIN_SCALE = 0.25            # Factor de escala mínimo
+
+class AdaptiveFrameEncoder:
+    """
+    Elige escala y calidad de cada fotograma para ajustarse a un presupuesto de bytes.
+    El presupuesto efectivo es el menor entre LIVE_FRAME_BUDGET y lo que el enlace
+    medido puede subir en LIVE_TARGET_UPLOAD segundos. Al pasarse se baja primero la
+    calidad (hasta LIVE_QUALITY_SOFT_MIN) y luego la escala; al sobrar se hace al revés.
+    """
+
+    def __init__(self, budget: int = LIVE_FRAME_BUDGET, image_format: str = LIVE_FRAME_FORMAT):
+        self.budget = budget
+        self.image_format = image_format
+        self.quality = 80
+        self.scale = 1.0
+        self.throughput = None  # Bytes por segundo (media móvil)
+        self.last_size = 0
+
+    def effective_budget(self) -> float:
+        budget = self.budget
+        if self.throughput:
+            budget = min(budget, self.throughput * LIVE_TARGET_UPLOAD)
+        return max(budget, 16 * 1024)
+
+    def record(self, size: int, upload_seconds: float):
+        """Ajusta los parámetros a partir del tamaño y el tiempo de subida del último fotograma."""
+        self.last_size = size
+        if upload_seconds > 0:
+            sample = size / upload_seconds
+            self.throughput = sample if self.throughput is None else 0.7 * self.throughput + 0.3 * sample
+        ratio = size / self.effective_budget()
+        min_quality, max_quality = LIVE_QUALITY_RANGE
+        if ratio > 1.15:
+            if self.quality > LIVE_QUALITY_SOFT_MIN:
+                self.quality = max(LIVE_QUALITY_SOFT_MIN, self.quality - 10)
+            elif self.scale > LIVE_MIN_SCALE:
+                # El tamaño crece con el número de píxeles: se corrige con la raíz de la desviación
+                self.scale = max(LIVE_MIN_SCALE, self.scale * 0.95 / math.sqrt(ratio))
+            else:
+                self.quality = max(min_quality, self.quality - 10)
+        elif ratio < 0.6:
+            if self.quality < LIVE_QUALITY_SOFT_MIN:
+                self.quality = min(LIVE_QUALITY_SOFT_MIN, self.quality + 5)
+            elif self.scale < 1.0:
+                self.scale = min(1.0, self.scale * min(1.25, math.sqrt(0.8 / ratio)))
+            else:
+                self.quality = min(max_quality, self.quality + 5)
+
+    def describe(self) -> str:
+        return f"{format_size(self.last_size)} · {self.image_format} Q{self.quality} · {self.scale * 100:.0f}%"
+
+class CaptureWorker(threading.Thread):
+    """
+    Hilo de captura persistente. Es el único dueño del handle de mss (que no se puede
+    compartir entre hilos), así que se abre una sola vez, y atiende tanto la pantalla en vivo
+    como las capturas en alta calidad. Guarda el último fotograma en bruto para que una
+    captura pedida justo después de otra del mismo monitor no vuelva a capturar, y codifica
+    siempre sobre el mismo búfer en memoria en lugar de crear uno por captura.
+    Los píxeles BGRA de mss se decodifican directamente, sin pasar por la conversión a RGB de mss.
+    La codificación de PIL libera el GIL, así que no bloquea al bucle.
+    """
+
+    FRAME_REUSE_SECONDS = 0.5  # Antigüedad máxima de un fotograma reutilizable
+    CALL_TIMEOUT = 20.0        # Segundos máximos de espera por una petición al hilo de captura
+
+    def __init__(self):
+        super().__init__(name="capture-worker", daemon=True)
+        self._requests = queue.Queue()
+        self._latest = None  # (monitor, instante, ScreenShot)
+        self._buffer = io.BytesIO()  # Búfer de codificación reutilizado (solo lo toca este hilo)
+        self._start_lock = threading.Lock()
+        self._launched = False
+        self.grabs = 0
+        self.reused = 0
+
+    def run(self):
+        # El handle se abre con la primera petición y se vuelve a abrir tras un fallo: sin
+        # pantalla (p. ej. sin DISPLAY) cada petición recibe el error, pero el hilo sigue vivo
+        sct = None
+        try:
+            while True:
+                item = self._requests.get()
+                if item is None:
+                    break
+                func, args, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if sct is None:
+                        sct = mss.mss()
+                    future.set_result(func(sct, *args))
+                except BaseException as e:
+                    future.set_exception(e)
+                    self._latest = None
+                    if sct is not None:
+                        try:
+                            sct.close()
+                        except Exception:
+                            pass
+                        sct = None
+        finally:
+            if sct is not None:
+                sct.close()
+
+    async def call(self, func, *args):
+        """
+        Ejecuta func(sct, *args) en el hilo de captura y espera el resultado, como mucho
+        CALL_TIMEOUT segundos, para que un hilo atascado nunca retenga a un handler.
+        """
+        with self._start_lock:
+            if not self._launched:
+                self._launched = True
+                self.start()
+        if not self.is_alive():
+            raise RuntimeError("El hilo de captura no está en marcha")
+        future = concurrent.futures.Future()
+        self._requests.put((func, args, future))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"La captura no respondió en {self.CALL_TIMEOUT:.0f} s") from None
+
+    def stop(self):
+        if self._launched:
+            self._requests.put(None)
+
+    def _grab(self, sct, monitor_index: int, max_age: float = 0.0):
+        now = time.monotonic()
+        if self._latest and self._latest[0] == monitor_index and now - self._latest[1] <= max_age:
+            self.reused += 1
+            return self._latest[2]
+        shot = sct.grab(sct.monitors[monitor_index])
+        self._latest = (monitor_index, now, shot)
+        self.grabs += 1
+        return shot
+
+    @staticmethod
+    def _to_image(shot):
+        return Image.frombuffer("RGB", shot.size, shot.raw, "raw", "BGRX", 0, 1)
+
+    def _live_frame(self, sct, monitor_index, previous_signature, quality, scale, image_format):
+        img = self._to_image(self._grab(sct, monitor_index))
+        return encode_screen_frame(img, previous_signature, SCREEN_CHANGE_THRESHOLD, quality, scale, image_format,
+                                   self._buffer)
+
+    def _still(self, sct, monitor_index, quality):
+        img = self._to_image(self._grab(sct, monitor_index, self.FRAME_REUSE_SECONDS))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        img.save(self._buffer, format="JPEG", quality=quality)
+        return self._buffer.getvalue()
+
+    async def live_frame(self, monitor_index: int = 1, previous_signature: bytes = None,
+                         quality: int = 95, scale: float = 1.0, image_format: str = "JPEG"):
+        """Fotograma para la pantalla en vivo: (imagen o None si no cambió, huella, diferencia)."""
+        return await self.call(self._live_frame, monitor_index, previous_signature, quality, scale, image_format)
+
+    async def still(self, monitor_index: int = 1, quality: int = 95) -> bytes:
+        """Captura JPEG a resolución completa; monitor 0 = todos los monitores unidos."""
+        return await self.call(self._still, monitor_index, quality)
+
+    async def monitor_count(self) -> int:
+        return await self.call(lambda sct: len(sct.monitors) - 1)
+
+    def stats(self) -> str:
+        return f"capturas {self.grabs}, fotogramas reutilizados {self.reused}"
+
+CAPTURE = CaptureWorker()
+
+# ----------------------------------------------------------------
+# Caché persistente de miniaturas en disco
+
+THUMB_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Presupuesto total en disco para miniaturas
+
+class ThumbnailCache:
+    """
+    Caché en disco de miniaturas JPEG direccionada por contenido: la clave es un hash de
+    ruta + tamaño + mtime del original + tamaño de la miniatura, así que un archivo
+    modificado genera una clave nueva y la antigua acaba expulsada por LRU.
+    El orden LRU se guarda en el mtime de cada archivo para sobrevivir a reinicios.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = THUMB_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {clave: bytes en disco} en orden LRU
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    @staticmethod
+    def make_key(path: str, file_size: int, file_mtime: float, thumb_size=(300, 300)) -> str:
+        raw = f"{os.path.abspath(path)}|{file_size}|{file_mtime}|{thumb_size[0]}x{thumb_size[1]}"
+        return hashlib.sha1(raw.encode("utf-8", "surrogateescape")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".jpg")
+
+    def _load(self):
+        """Reconstruye el índice LRU a partir de los archivos ya presentes en disco."""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.name.endswith(".tmp"):
+                        # Restos de una escritura interrumpida (no se tocan las que pueden estar en curso)
+                        if time.time() - entry.stat().st_mtime > 3600:
+                            os.remove(entry.path)
+                    elif entry.name.endswith(".jpg"):
+                        st = entry.stat()
+                        found.append((st.st_mtime, entry.name[:-4], st.st_size))
+                except OSError:
+                    continue
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total += size
+        self._remove_files(self._trim())
+
+    def _trim(self):
+        """Expulsa entradas LRU hasta respetar el presupuesto. Debe llamarse con el lock."""
+        victims = []
+        while self._total > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            self.evictions += 1
+            victims.append(key)
+        return victims
+
+    def _remove_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key: str):
+        """Devuelve los bytes de la miniatura o None si no está en caché."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total -= size
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Guarda la miniatura de forma atómica y aplica el presupuesto de bytes."""
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Error guardando miniatura en caché: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total += len(data)
+            victims = self._trim()
+        self._remove_files(victims)
+
+    def stats(self) -> str:
+        with self._lock:
+            return (
+                f"{len(self._entries)} miniaturas, {format_size(self._total)}/{format_size(self.max_bytes)}, "
+                f"aciertos {self.hits}, fallos {self.misses}, expulsiones {self.evictions}"
+            )
+
+async def get_thumbnail(entry: FileEntry, size=(300, 300)):
+    """
+    Devuelve la miniatura (BytesIO) de una imagen o vídeo, sirviéndola desde la caché
+    en disco si el archivo no ha cambiado. Retorna None si no se pudo generar.
+    La decodificación de imágenes va al pool de procesos; FFmpeg corre como subproceso asíncrono.
+    """
+    key = ThumbnailCache.make_key(entry.path, entry.size, entry.mtime, size)
+    data = await IO_POOL.run(THUMB_CACHE.get, key)
+    if data is None:
+        if is_image(entry.path):
+            data = await CPU_POOL.run(generate_thumbnail, entry.path, size)
+        elif is_video(entry.path):
+            data = await generate_video_thumbnail(entry.path, size)
+        if not data:
+            return None
+        await IO_POOL.run(THUMB_CACHE.put, key, data)
+    return io.BytesIO(data)
+
+# ----------------------------------------------------------------
+# Caché de file_id de Telegram para reenviar archivos sin volver a subirlos
+
+FILE_ID_CACHE_MAX = 50000  # Entradas guardadas como máximo (se descartan las menos usadas)
+
+class FileIdCache:
+    """
+    Relaciona (tipo, ruta, tamaño, mtime) con el file_id que devolvió Telegram al subir el archivo,
+    persistido en SQLite. Si el archivo cambia, cambia la clave y la entrada vieja acaba expulsada.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, file_id TEXT NOT NULL, used REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(kind: str, path: str, size: int, mtime: float, extra: str = "") -> str:
+        return f"{kind}|{os.path.abspath(path)}|{size}|{mtime}|{extra}"
+
+    def get(self, key: str):
+        conn = self._connect()
+        row = conn.execute("SELECT file_id FROM file_ids WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        conn.execute("UPDATE file_ids SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, file_id: str):
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO file_ids (key, file_id, used) VALUES (?, ?, ?)", (key, file_id, time.time()))
+        conn.execute(
+            "DELETE FROM file_ids WHERE key IN (SELECT key FROM file_ids ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (FILE_ID_CACHE_MAX,),
+        )
+
+    def forget(self, key: str):
+        """Descarta un file_id que Telegram ha rechazado."""
+        self.rejected += 1
+        self._connect().execute("DELETE FROM file_ids WHERE key = ?", (key,))
+
+    def stats(self) -> str:
+        count = self._connect().execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+        return f"{count} file_id guardados, aciertos {self.hits}, fallos {self.misses}, rechazados {self.rejected}"
+
+def sent_file_id(message: Message):
+    """file_id del medio de un mensaje enviado, o None."""
+    for attr in ("document", "video", "photo", "audio", "animation"):
+        media = getattr(message, attr, None) if message is not None else None
+        if media is not None:
+            return media.file_id
+    return None
+
+# ----------------------------------------------------------------
+# Índice de archivos recibidos para no descargar dos veces el mismo contenido
+
+class ReceivedIndex:
+    """
+    Registro en SQLite de los archivos recibidos por el bot: file_unique_id de Telegram,
+    tamaño, ruta local, mtime y SHA-256 (calculado mientras se descarga). Una entrada solo
+    se considera válida si el archivo local sigue existiendo con el mismo tamaño y mtime.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.hits = 0
+        self.saved_bytes = 0
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS received (
+                path TEXT PRIMARY KEY, unique_id TEXT, size INTEGER NOT NULL,
+                mtime REAL NOT NULL, sha256 TEXT, received REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS received_unique ON received(unique_id, size);
+            CREATE INDEX IF NOT EXISTS received_sha ON received(sha256, size);
+        """)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, path: str, unique_id: str, sha256: str):
+        """Anota un archivo recibido (o enlazado/copiado a partir de otro) con su estado actual."""
+        st = os.stat(path)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO received (path, unique_id, size, mtime, sha256, received) VALUES (?, ?, ?, ?, ?, ?)",
+            (os.path.abspath(path), unique_id, st.st_size, st.st_mtime, sha256, time.time()),
+        )
+
+    def _valid(self, rows):
+        """Primera fila cuyo archivo no ha cambiado; las obsoletas se borran."""
+        conn = self._connect()
+        for path, size, mtime, sha256 in rows:
+            try:
+                st = os.stat(path)
+                if st.st_size == size and st.st_mtime == mtime:
+                    return path, sha256
+            except OSError:
+                pass
+            conn.execute("DELETE FROM received WHERE path = ?", (path,))
+        return None
+
+    def find(self, unique_id: str, size: int):
+        """Copia local de un archivo de Telegram ya recibido: (ruta, sha256) o None."""
+        rows = self._connect().execute(
+            "SELECT path, size, mtime, sha256 FROM received WHERE unique_id = ? AND size = ? ORDER BY received DESC",
+            (unique_id, size),
+        ).fetchall()
+        return self._valid(rows)
+
+    def find_content(self, sha256: str, size: int, exclude: str = None):
+        """Otro archivo local con el mismo contenido: (ruta, sha256) o None."""
+        rows = self._connect().execute(
+            "SELECT path, size, mtime, sha256 FROM received WHERE sha256 = ? AND size = ? AND path != ? ORDER BY received DESC",
+            (sha256, size, os.path.abspath(exclude) if exclude else ""),
+        ).fetchall()
+        return self._valid(rows)
+
+    def lookup(self, path: str):
+        """Entrada vigente de una ruta concreta: (unique_id, sha256) o None."""
+        row = self._connect().execute(
+            "SELECT path, size, mtime, sha256, unique_id FROM received WHERE path = ?", (os.path.abspath(path),)
+        ).fetchone()
+        if row is None or self._valid([row[:4]]) is None:
+            return None
+        return row[4], row[3]
+
+    def stats(self) -> str:
+        count = self._connect().execute("SELECT COUNT(*) FROM received").fetchone()[0]
+        return f"{count} archivos registrados, duplicados evitados {self.hits} ({format_size(self.saved_bytes)})"
+
+def link_or_copy(source: str, dest: str, mode: str) -> str:
+    """
+    Crea 'dest' a partir de la copia local 'source': enlace duro ("link") o copia ("copy").
+    Si el enlace no es posible (otra unidad, sistema de archivos sin soporte) se copia.
+    Devuelve el modo usado. Bloqueante.
+    """
+    tmp = dest + ".part"
+    if mode == "link":
+        try:
+            if os.path.exists(dest):
+                os.link(source, tmp)
+                os.replace(tmp, dest)
+            else:
+                os.link(source, dest)
+            return "link"
+        except OSError as e:
+            logger.info(f"No se pudo crear el enlace duro {dest} -> {source}, se copia: {e}")
+    shutil.copyfile(source, tmp)
+    shutil.copystat(source, tmp)
+    os.replace(tmp, dest)
+    return "copy"
+
+# ----------------------------------------------------------------
+# Índice local de archivos para /find (SQLite)
+
+INDEX_RESCAN_INTERVAL = 6 * 3600  # Segundos entre recorridos del índice
+INDEX_BATCH_DIRS = 500            # Directorios procesados por transacción
+INDEX_EXCLUDE_PATHS = {"/proc", "/sys", "/dev", "/run"}
+INDEX_EXCLUDE_NAMES = {"$Recycle.Bin", "System Volume Information"}
+FIND_PER_PAGE = 10
+
+class FileIndex:
     """
-    Genera una miniatura para un video usando FFmpeg y la retorna como BytesIO.
-    Se extrae un fotograma a 1 segundo, se escala a 'size' y se usa baja calidad (-q:v 31).
-    Requiere que FFmpeg esté instalado en el sistema.
+    Índice persistente de nombres de archivo en SQLite (con tamaño y mtime).
+    Un hilo de fondo recorre las unidades con os.scandir y solo vuelve a listar los
+    directorios cuyo mtime ha cambiado; los demás reutilizan sus subdirectorios guardados.
+    El tamaño/mtime de un archivo se actualiza cuando cambia su directorio.
+    Las búsquedas usan FTS5 con tokenizador trigram si SQLite lo soporta y, si no,
+    el índice sobre el nombre en minúsculas (búsqueda por prefijo).
     """
-    temp_thumb = f"{file_path}_thumb.jpg"
-    try:
-        command = [
-            "ffmpeg",
-            "-i", file_path,
-            "-ss", "00:00:01.000",
-            "-vframes", "1",
-            "-vf", f"scale={size[0]}:{size[1]}",
-            "-q:v", "31",  # Calidad baja
-            temp_thumb
-        ]
-        subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        with open(temp_thumb, "rb") as f:
-            data = f.read()
-        os.remove(temp_thumb)
-        bio = io.BytesIO(data)
-        bio.seek(0)
-        return bio
-    except Exception as e:
-        logger.warning(f"Error generando miniatura para video {file_path}: {e}")
-        if os.path.exists(temp_thumb):
-            os.remove(temp_thumb)
-        return None
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        self.trigram = False
+        self.scanning = False
+        self.last_scan = None      # (fin, segundos, directorios listados, directorios sin cambios)
+        self._init_db()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, parent INTEGER, mtime INTEGER, seen INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY, dir INTEGER NOT NULL, name TEXT NOT NULL,
+                name_lower TEXT NOT NULL, size INTEGER, mtime REAL
+            );
+            CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+            CREATE INDEX IF NOT EXISTS files_name ON files(name_lower);
+        """)
+        try:
+            conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                    name_lower, content='files', content_rowid='id', tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+                    INSERT INTO files_fts(rowid, name_lower) VALUES (new.id, new.name_lower);
+                END;
+                CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+                    INSERT INTO files_fts(files_fts, rowid, name_lower) VALUES ('delete', old.id, old.name_lower);
+                END;
+            """)
+            self.trigram = True
+        except sqlite3.OperationalError as e:
+            logger.info(f"SQLite sin FTS5/trigram, se usará búsqueda por prefijo: {e}")
+
+    def _excluded(self, path: str) -> bool:
+        return path in INDEX_EXCLUDE_PATHS or os.path.basename(path.rstrip("/\\")) in INDEX_EXCLUDE_NAMES
+
+    def crawl(self, roots):
+        """Recorre las raíces actualizando solo los directorios modificados (bloqueante)."""
+        conn = self._connect()
+        scan_id = time.time_ns()
+        started = time.monotonic()
+        listed = skipped = pending = 0
+        stack = [(root, None) for root in roots]
+        self.scanning = True
+        conn.execute("BEGIN")
+        try:
+            while stack and not self._stop.is_set():
+                path, parent_id = stack.pop()
+                if self._excluded(path):
+                    continue
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                row = conn.execute("SELECT id, mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+                if row and row[1] == mtime:
+                    dir_id = row[0]
+                    skipped += 1
+                    conn.execute("UPDATE dirs SET seen = ? WHERE id = ?", (scan_id, dir_id))
+                    stack.extend((child, dir_id) for (child,) in conn.execute("SELECT path FROM dirs WHERE parent = ?", (dir_id,)))
+                else:
+                    if row:
+                        dir_id = row[0]
+                        conn.execute("UPDATE dirs SET mtime = ?, seen = ?, parent = ? WHERE id = ?", (mtime, scan_id, parent_id, dir_id))
+                        conn.execute("DELETE FROM files WHERE dir = ?", (dir_id,))
+                    else:
+                        dir_id = conn.execute(
+                            "INSERT INTO dirs(path, parent, mtime, seen) VALUES (?, ?, ?, ?)", (path, parent_id, mtime, scan_id)
+                        ).lastrowid
+                    listed += 1
+                    files = []
+                    try:
+                        with os.scandir(path) as it:
+                            for entry in it:
+                                try:
+                                    if entry.is_dir(follow_symlinks=False):
+                                        stack.append((entry.path, dir_id))
+                                    elif entry.is_file(follow_symlinks=False):
+                                        st = entry.stat(follow_symlinks=False)
+                                        files.append((dir_id, entry.name, entry.name.lower(), st.st_size, st.st_mtime))
+                                except OSError:
+                                    continue
+                    except OSError:
+                        pass
+                    conn.executemany("INSERT INTO files(dir, name, name_lower, size, mtime) VALUES (?, ?, ?, ?, ?)", files)
+                pending += 1
+                if pending >= INDEX_BATCH_DIRS:
+                    conn.execute("COMMIT")
+                    conn.execute("BEGIN")
+                    pending = 0
+            if not self._stop.is_set():
+                # Directorios que no se han visto en este recorrido ya no existen
+                conn.execute("DELETE FROM files WHERE dir IN (SELECT id FROM dirs WHERE seen < ?)", (scan_id,))
+                conn.execute("DELETE FROM dirs WHERE seen < ?", (scan_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self.scanning = False
+        self.last_scan = (time.time(), time.monotonic() - started, listed, skipped)
+        logger.info(f"Índice actualizado: {listed} directorios listados, {skipped} sin cambios")
+
+    def _run(self, roots_factory):
+        while not self._stop.is_set():
+            try:
+                self.crawl(roots_factory())
+            except Exception as e:
+                logger.error(f"Error actualizando el índice de archivos: {e}")
+            self._stop.wait(INDEX_RESCAN_INTERVAL)
+
+    def start(self, roots_factory):
+        """Arranca el hilo de indexación en segundo plano (idempotente)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(roots_factory,), name="file-index", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def search(self, pattern: str, limit: int, offset: int = 0):
+        """
+        Busca archivos cuyo nombre contenga 'pattern' (o encaje con él si lleva comodines * ? []).
+        Devuelve una lista de (directorio, nombre, tamaño, mtime) con hasta 'limit' elementos.
+        El orden es fijo (nombre e id) para que las páginas no repitan ni salten resultados
+        mientras el rastreador escribe.
+        """
+        conn = self._connect()
+        needle = pattern.lower()
+        select = "SELECT d.path, f.name, f.size, f.mtime FROM files f JOIN dirs d ON d.id = f.dir"
+        if any(c in needle for c in "*?["):
+            literal = max(re.split(r"[*?\[\]]", needle), key=len)
+            if self.trigram and len(literal) >= 3:
+                sql = (f"{select} JOIN files_fts ON files_fts.rowid = f.id "
+                       f"WHERE files_fts MATCH ? AND f.name_lower GLOB ? ORDER BY f.name_lower, f.id LIMIT ? OFFSET ?")
+                params = (self._phrase(literal), needle, limit, offset)
+            else:
+                sql = f"{select} WHERE f.name_lower GLOB ? ORDER BY f.name_lower, f.id LIMIT ? OFFSET ?"
+                params = (needle, limit, offset)
+        elif self.trigram and len(needle) >= 3:
+            sql = f"{select} JOIN files_fts ON files_fts.rowid = f.id WHERE files_fts MATCH ? ORDER BY f.name_lower, f.id LIMIT ? OFFSET ?"
+            params = (self._phrase(needle), limit, offset)
+        else:
+            # Patrón corto o sin trigram: búsqueda por prefijo sobre el índice del nombre
+            sql = f"{select} WHERE f.name_lower >= ? AND f.name_lower < ? ORDER BY f.name_lower, f.id LIMIT ? OFFSET ?"
+            params = (needle, needle + "\uffff", limit, offset)
+        return conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _phrase(text: str) -> str:
+        return '"' + text.replace('"', '""') + '"'
+
+    def stats(self) -> str:
+        if self.scanning:
+            return "indexando..."
+        if self.last_scan is None:
+            return "sin recorrido completo todavía"
+        finished, seconds, listed, skipped = self.last_scan
+        return (
+            f"último recorrido hace {format_age(time.time() - finished)} ({seconds:.0f}s), "
+            f"{listed} directorios listados, {skipped} sin cambios, trigram {'sí' if self.trigram else 'no'}"
+        )
 
 def navigation_markup(current_folder_id: str = None):
     """
@@ -217,8 +2457,7 @@ def navigation_markup(current_folder_id: str = None):
         if folder_path:
             parent_path = os.path.dirname(folder_path)
             if parent_path and parent_path != folder_path:
-                parent_id = str(uuid.uuid4())
-                FOLDER_MAP[parent_id] = parent_path
+                parent_id = FOLDER_MAP.register(parent_path)
                 buttons.append(InlineKeyboardButton("⬅️ Atrás", callback_data=f"folder|{parent_id}"))
     buttons.append(InlineKeyboardButton("🏠 Inicio", callback_data="home"))
     return InlineKeyboardMarkup([buttons])
@@ -228,11 +2467,11 @@ async def update_menu(client: Client, chat_id: int, text: str, reply_markup: Inl
     """
     Actualiza el mensaje de menú actual del chat.
     Si ya existe, se edita; de lo contrario se envía un nuevo mensaje.
-    Además, registra el mensaje en NAV_MESSAGES.
+    Además, registra el mensaje como mensaje de navegación.
     """
     if chat_id in CURRENT_MENU and CURRENT_MENU[chat_id]:
         try:
-            await client.edit_message_text(
+            await outbound(client.edit_message_text,
                 chat_id=chat_id,
                 message_id=CURRENT_MENU[chat_id],
                 text=text,
@@ -240,7 +2479,7 @@ async def update_menu(client: Client, chat_id: int, text: str, reply_markup: Inl
             )
         except Exception as e:
             logger.warning(f"Error editando mensaje de menú: {e}")
-            msg = await client.send_message(
+            msg = await outbound(client.send_message,
                 chat_id=chat_id,
                 text=text,
                 reply_markup=reply_markup
@@ -248,7 +2487,7 @@ async def update_menu(client: Client, chat_id: int, text: str, reply_markup: Inl
             CURRENT_MENU[chat_id] = msg.id
             record_nav_message(chat_id, msg.id)
     else:
-        msg = await client.send_message(
+        msg = await outbound(client.send_message,
             chat_id=chat_id,
             text=text,
             reply_markup=reply_markup
@@ -259,19 +2498,14 @@ async def update_menu(client: Client, chat_id: int, text: str, reply_markup: Inl
 async def main_panel(client: Client, message: Message):
     """
     Envía (o actualiza) el panel principal de unidades.
-    Antes de mostrar el panel principal se borran todos los mensajes previos.
+    Antes de mostrar el panel principal se programa el borrado de los mensajes previos,
+    que se hace en segundo plano sin retrasar el panel.
     """
     chat_id = message.chat.id
-    await clear_nav_messages(client, chat_id)
-    drives = list_drives()
+    clear_nav_messages(client, chat_id)
+    drives = await IO_POOL.run(get_drives_usage)
     buttons = []
-    for drive in drives:
-        try:
-            usage = shutil.disk_usage(drive)
-            total = format_size(usage.total)
-            free = format_size(usage.free)
-        except Exception:
-            total, free = "N/A", "N/A"
+    for drive, total, free in drives:
         text_drive = f"💽 {drive}\nTotal: {total}\nLibre: {free}"
         buttons.append([InlineKeyboardButton(text_drive, callback_data=f"drive|{drive}")])
     # Botón adicional para listar procesos activos
@@ -281,8 +2515,8 @@ async def main_panel(client: Client, message: Message):
     buttons.append([InlineKeyboardButton("📸 Captura de pantalla de alta calidad", callback_data="upload_highres")])
 
     
-    # Obtener información del sistema
-    system_info = get_system_info()
+    # Información del sistema desde la instantánea refrescada en segundo plano
+    system_info = await SYSINFO.render()
     
     welcome_text = (
         "✨ ¡Bienvenido al Administrador de Archivos!\n\n" +
@@ -296,65 +2530,354 @@ async def main_panel(client: Client, message: Message):
 # Función para actualizar el texto de un mensaje (para el progreso)
 async def update_message_text(message: Message, text: str, reply_markup=None):
     try:
-        await message.edit_text(text, reply_markup=reply_markup)
+        await outbound(
+            message.edit_text, text, reply_markup=reply_markup,
+            priority=PRIORITY_PROGRESS, key=("edit", message.chat.id, message.id)
+        )
     except Exception as e:
         logger.error(f"Error al actualizar el mensaje: {e}")
 
-def make_upload_progress_hook(message: Message, loop, cancel_markup, cancel_flag, threshold: float = 5.0, min_interval: float = 3.0):
+class ProgressCoalescer:
     """
-    Función hook que actualiza el mensaje con una barra de progreso durante la subida.
-    Si se activa el flag de cancelación, lanza una excepción para interrumpir la subida.
+    Coalescedor de ediciones de progreso: por cada mensaje guarda solo el último estado,
+    mantiene como mucho una edición en vuelo, omite ediciones con el mismo texto y
+    siempre termina enviando el estado final. publish() se puede llamar desde cualquier hilo.
     """
+
+    def __init__(self):
+        self._states = {}  # {(chat_id, message_id): estado}
+        self.published = 0
+        self.edits = 0
+        self.skipped = 0
+
+    def publish(self, loop, message: Message, text: str, reply_markup=None):
+        """Registra un nuevo estado de progreso (seguro entre hilos)."""
+        loop.call_soon_threadsafe(self._update, message, text, reply_markup)
+
+    def _update(self, message: Message, text: str, reply_markup):
+        key = (message.chat.id, message.id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = {"message": message, "pending": None, "sent": None, "task": None, "closing": False}
+        if state["closing"]:
+            return
+        self.published += 1
+        state["pending"] = (text, reply_markup)
+        if state["task"] is None:
+            state["task"] = asyncio.create_task(self._flush(key, state))
+
+    async def _flush(self, key, state):
+        try:
+            while state["pending"] is not None:
+                text, reply_markup = state["pending"]
+                state["pending"] = None
+                if text == state["sent"]:
+                    self.skipped += 1
+                    continue
+                await update_message_text(state["message"], text, reply_markup=reply_markup)
+                state["sent"] = text
+                self.edits += 1
+        finally:
+            state["task"] = None
+            if state["closing"] and self._states.get(key) is state:
+                del self._states[key]
+
+    def finish(self, message: Message):
+        """No acepta más estados para el mensaje; el pendiente se envía y luego se olvida."""
+        key = (message.chat.id, message.id)
+        state = self._states.get(key)
+        if state is None:
+            return
+        state["closing"] = True
+        if state["task"] is None:
+            del self._states[key]
+
+    def discard(self, message: Message):
+        """Olvida el mensaje y cancela su edición en curso (por ejemplo, antes de borrarlo)."""
+        state = self._states.pop((message.chat.id, message.id), None)
+        if state is not None:
+            state["closing"] = True
+            if state["task"] is not None:
+                state["task"].cancel()
+
+    def stats(self) -> str:
+        return (
+            f"mensajes activos {len(self._states)}, estados {self.published}, "
+            f"ediciones {self.edits}, omitidas por texto igual {self.skipped}"
+        )
+
+PROGRESS = ProgressCoalescer()
+
+def _make_progress_hook(message: Message, loop, cancel_markup, cancel_flag, label: str, cancel_text: str,
+                        threshold: float, min_interval: float, transfer=None):
     last_percentage = [0.0]
     last_update_time = [0.0]
     total_segments = 17
 
     def hook(current: int, total: int):
-        try:
-            if cancel_flag.is_set():
-                raise Exception("Subida cancelada por el usuario.")
-            percentage = current / total * 100
-            now = time.time()
-            if (abs(percentage - last_percentage[0]) >= threshold or percentage >= 100) and \
-               (now - last_update_time[0] >= min_interval or percentage >= 100):
-                last_percentage[0] = percentage
-                last_update_time[0] = now
-                filled = int(total_segments * percentage / 100)
-                bar = "🟩" * filled + "⬜" * (total_segments - filled)
-                new_text = f"⏫ Subiendo: {percentage:.2f}%\n{bar}"
-                loop.call_soon_threadsafe(lambda: asyncio.create_task(update_message_text(message, new_text, reply_markup=cancel_markup)))
-        except Exception as e:
-            logger.error(f"Error en upload progress hook: {e}")
-            raise e  # Para interrumpir la subida
+        if cancel_flag.is_set():
+            raise Exception(cancel_text)
+        if transfer is not None:
+            transfer.update(current, total)
+        percentage = current / total * 100 if total else 100.0
+        now = time.time()
+        if (abs(percentage - last_percentage[0]) >= threshold or percentage >= 100) and \
+           (now - last_update_time[0] >= min_interval or percentage >= 100):
+            last_percentage[0] = percentage
+            last_update_time[0] = now
+            filled = int(total_segments * percentage / 100)
+            bar = "🟩" * filled + "⬜" * (total_segments - filled)
+            PROGRESS.publish(loop, message, f"{label}: {percentage:.2f}%\n{bar}", cancel_markup)
     return hook
 
-def make_download_progress_hook(message: Message, loop, cancel_markup, cancel_flag, threshold: float = 5.0, min_interval: float = 3.0):
+UPLOAD_CANCELLED = "Subida cancelada por el usuario."
+DOWNLOAD_CANCELLED = "Descarga cancelada por el usuario."
+
+def make_upload_progress_hook(message: Message, loop, cancel_markup, cancel_flag, threshold: float = 5.0, min_interval: float = 3.0,
+                              transfer=None):
+    """
+    Función hook que actualiza el mensaje con una barra de progreso durante la subida.
+    Si se activa el flag de cancelación, lanza una excepción para interrumpir la subida.
+    """
+    return _make_progress_hook(message, loop, cancel_markup, cancel_flag, "⏫ Subiendo",
+                               UPLOAD_CANCELLED, threshold, min_interval, transfer)
+
+def make_download_progress_hook(message: Message, loop, cancel_markup, cancel_flag, threshold: float = 5.0, min_interval: float = 3.0,
+                                transfer=None):
     """
     Función hook que actualiza el mensaje con una barra de progreso durante la descarga.
     Si se activa el flag de cancelación, lanza una excepción para interrumpir la descarga.
     """
-    last_percentage = [0.0]
-    last_update_time = [0.0]
-    total_segments = 17
+    return _make_progress_hook(message, loop, cancel_markup, cancel_flag, "⏳ Descargando",
+                               DOWNLOAD_CANCELLED, threshold, min_interval, transfer)
 
-    def hook(current: int, total: int):
+# ----------------------------------------------------------------
+# Cola de transferencias: concurrencia limitada, prioridades y vista /transfers
+
+TRANSFER_CONCURRENCY = 2                 # Transferencias simultáneas como máximo
+TRANSFER_PRIORITY_HIGH = 0               # Fotos y archivos pequeños: no esperan tras los grandes
+TRANSFER_PRIORITY_NORMAL = 1
+TRANSFER_SMALL_FILE = 20 * 1024 * 1024   # Por debajo de este tamaño la transferencia es prioritaria
+TRANSFER_SPEED_WINDOW = 10.0             # Segundos usados para calcular la velocidad
+
+def transfer_priority(size: int) -> int:
+    return TRANSFER_PRIORITY_HIGH if size and size < TRANSFER_SMALL_FILE else TRANSFER_PRIORITY_NORMAL
+
+class Transfer:
+    """
+    Estado de una subida o descarga. 'key' es la misma clave que usa CANCEL_FLAGS, y
+    'cancel_data' el callback del botón de cancelar ya existente para esa transferencia.
+    'resumed_from' son los bytes ya transferidos en una sesión anterior: cuentan para el
+    porcentaje, pero no para 'transferred' (lo movido de verdad en esta sesión).
+    """
+
+    def __init__(self, key: str, kind: str, name: str, total: int, cancel_flag: threading.Event,
+                 cancel_data: str, priority: int = None, resumed_from: int = 0):
+        self.key = key
+        self.kind = kind  # "upload" o "download"
+        self.name = name
+        self.total = total or 0
+        self.cancel_flag = cancel_flag
+        self.cancel_data = cancel_data
+        self.priority = transfer_priority(self.total) if priority is None else priority
+        self.cancel_text = UPLOAD_CANCELLED if kind == "upload" else DOWNLOAD_CANCELLED
+        self.state = "queued"
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.current = resumed_from
+        self.transferred = 0
+        self._samples = []  # [(instante, bytes)] dentro de la ventana de velocidad
+
+    def update(self, current: int, total: int):
+        """Llamado desde el hook de progreso (puede ejecutarse fuera del bucle de eventos)."""
+        now = time.monotonic()
+        if current > self.current:
+            self.transferred += current - self.current
+        self.current = current
+        if total:
+            self.total = total
+        samples = self._samples + [(now, current)]
+        while len(samples) > 2 and now - samples[0][0] > TRANSFER_SPEED_WINDOW:
+            samples.pop(0)
+        self._samples = samples
+
+    def speed(self) -> float:
+        """Bytes por segundo en la ventana reciente."""
+        samples = self._samples
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return 0.0
+        return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+
+    def describe(self) -> str:
+        icon = "⬆️" if self.kind == "upload" else "⬇️"
+        if self.state == "queued":
+            return f"{icon} {self.name} — 🕒 en cola desde hace {format_age(time.monotonic() - self.queued_at)}"
+        percent = self.current / self.total * 100 if self.total else 0.0
+        speed = self.speed()
+        if speed > 0 and self.total:
+            eta = f"ETA {format_age((self.total - self.current) / speed)}"
+        else:
+            eta = "ETA —"
+        return (f"{icon} {self.name} — {percent:.1f}% de {format_size(self.total)}, "
+                f"{format_size(speed)}/s, {eta}")
+
+class TransferManager:
+    """
+    Coordina todas las subidas y descargas: como mucho 'concurrency' a la vez y el resto
+    en cola por prioridad y, dentro de la misma prioridad, por orden de llegada.
+    """
+
+    def __init__(self, concurrency: int = TRANSFER_CONCURRENCY):
+        self.concurrency = concurrency
+        self._transfers = OrderedDict()  # {clave: Transfer} activas y en cola
+        self._queue = []                 # heap de (prioridad, secuencia, clave)
+        self._waiters = {}               # {clave: (secuencia, futuro que se resuelve al obtener turno)}
+        self._running = set()
+        self._seq = itertools.count()
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.bytes_done = 0
+
+    def active(self, key: str) -> bool:
+        return key in self._transfers
+
+    def position(self, key: str) -> int:
+        """Posición (desde 1) de una transferencia en la cola, 0 si no está esperando."""
+        waiting = sorted(item for item in self._queue if self._current_entry(item))
+        for n, item in enumerate(waiting, start=1):
+            if item[2] == key:
+                return n
+        return 0
+
+    def _current_entry(self, item) -> bool:
+        """
+        ¿Sigue vigente esta entrada del heap? Las de transferencias canceladas o terminadas se
+        quedan en el heap; la secuencia evita que una nueva con la misma clave salga por ellas.
+        """
+        _, seq, key = item
+        waiting = self._waiters.get(key)
+        return waiting is not None and waiting[0] == seq and not waiting[1].done()
+
+    def _start(self, transfer: Transfer):
+        transfer.state = "running"
+        transfer.started_at = time.monotonic()
+        self._running.add(transfer.key)
+
+    def _dispatch(self):
+        while len(self._running) < self.concurrency and self._queue:
+            item = heapq.heappop(self._queue)
+            if not self._current_entry(item):
+                continue
+            _, waiter = self._waiters.pop(item[2])
+            self._start(self._transfers[item[2]])
+            waiter.set_result(None)
+
+    def submit(self, transfer: Transfer, job) -> asyncio.Task:
+        """
+        Registra la transferencia y lanza 'job' (la corrutina que llama a run() y gestiona el
+        resultado) en segundo plano, para que el handler vuelva enseguida y no ocupe un worker
+        de Pyrogram mientras la transferencia espera en la cola.
+        """
+        self._transfers[transfer.key] = transfer
+
+        async def guarded():
+            try:
+                await job
+            finally:
+                # Si 'job' falló antes de llegar a run(), la transferencia no debe quedar registrada
+                if self._transfers.get(transfer.key) is transfer:
+                    self._transfers.pop(transfer.key, None)
+
+        return spawn_background(guarded())
+
+    async def run(self, transfer: Transfer, action, status_message: Message = None, markup=None):
+        """
+        Espera turno y ejecuta 'action()' (una corrutina). Si hay que esperar, lo indica
+        en 'status_message'. Cancelar mientras está en cola lanza la excepción de cancelación habitual.
+        Se llama desde la tarea lanzada con submit(), nunca directamente desde un handler.
+        """
+        self._transfers[transfer.key] = transfer
+        outcome = "failed"
         try:
-            if cancel_flag.is_set():
-                raise Exception("Descarga cancelada por el usuario.")
-            percentage = current / total * 100
-            now = time.time()
-            if (abs(percentage - last_percentage[0]) >= threshold or percentage >= 100) and \
-               (now - last_update_time[0] >= min_interval or percentage >= 100):
-                last_percentage[0] = percentage
-                last_update_time[0] = now
-                filled = int(total_segments * percentage / 100)
-                bar = "🟩" * filled + "⬜" * (total_segments - filled)
-                new_text = f"⏳ Descargando: {percentage:.2f}%\n{bar}"
-                loop.call_soon_threadsafe(lambda: asyncio.create_task(update_message_text(message, new_text, reply_markup=cancel_markup)))
-        except Exception as e:
-            logger.error(f"Error en download progress hook: {e}")
-            raise e
-    return hook
+            if len(self._running) < self.concurrency and not self._waiters:
+                self._start(transfer)
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                seq = next(self._seq)
+                self._waiters[transfer.key] = (seq, waiter)
+                heapq.heappush(self._queue, (transfer.priority, seq, transfer.key))
+                if status_message is not None:
+                    await update_message_text(
+                        status_message,
+                        f"🕒 En cola (posición {self.position(transfer.key)}). Consulta /transfers.",
+                        reply_markup=markup,
+                    )
+                await waiter
+            result = await action()
+            outcome = "completed"
+            return result
+        except Exception:
+            if transfer.cancel_flag.is_set():
+                outcome = "cancelled"
+            raise
+        finally:
+            self._release(transfer, outcome)
+
+    def _release(self, transfer: Transfer, outcome: str):
+        self._transfers.pop(transfer.key, None)
+        waiting = self._waiters.pop(transfer.key, None)
+        if waiting is not None and not waiting[1].done():
+            waiting[1].cancel()
+        self._running.discard(transfer.key)
+        self.bytes_done += transfer.transferred
+        if outcome == "completed":
+            self.completed += 1
+        elif outcome == "cancelled":
+            self.cancelled += 1
+        else:
+            self.failed += 1
+        self._dispatch()
+
+    def cancel(self, key: str) -> bool:
+        """Activa el flag de cancelación; si la transferencia estaba en cola, la saca de inmediato."""
+        transfer = self._transfers.get(key)
+        if transfer is None:
+            return False
+        transfer.cancel_flag.set()
+        waiting = self._waiters.pop(key, None)
+        if waiting is not None and not waiting[1].done():
+            waiting[1].set_exception(Exception(transfer.cancel_text))
+        return True
+
+    def render(self):
+        """Texto y teclado de la vista /transfers."""
+        running = [t for t in self._transfers.values() if t.state == "running"]
+        queued = sorted(
+            (t for t in self._transfers.values() if t.state == "queued"),
+            key=lambda t: self.position(t.key),
+        )
+        lines = [f"🚚 Transferencias: {len(running)}/{self.concurrency} activas, {len(queued)} en cola"]
+        buttons = []
+        for t in running:
+            lines.append(t.describe())
+        for n, t in enumerate(queued, start=1):
+            lines.append(f"#{n} {t.describe()}")
+        for t in running + queued:
+            buttons.append([InlineKeyboardButton(f"✖️ Cancelar {t.name[:40]}", callback_data=t.cancel_data)])
+        if not running and not queued:
+            lines.append("No hay transferencias en curso.")
+        buttons.append([InlineKeyboardButton("🔄 Actualizar", callback_data="transfers")])
+        return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+    def stats(self) -> str:
+        return (
+            f"activas {len(self._running)}/{self.concurrency}, en cola {len(self._waiters)}, "
+            f"completadas {self.completed}, canceladas {self.cancelled}, fallidas {self.failed}, "
+            f"{format_size(self.bytes_done)} transferidos"
+        )
+
+TRANSFERS = TransferManager()
 
 # ----------------------------------------------------------------
 # Instanciamos el cliente antes de definir los handlers con decoradores
@@ -363,7 +2886,9 @@ api_hash = "123456789"
 bot_token = "123456789"
 
 # Instanciamos el cliente con la ruta segura de sesión
-session_path = os.path.join(os.getenv("APPDATA"), "file_manager_bot")
+APP_DIR = os.getenv("APPDATA") or os.path.expanduser("~")
+session_path = os.path.join(APP_DIR, "file_manager_bot")
+DATA_DIR = os.path.join(APP_DIR, "file_manager_bot_data")  # Cachés persistentes del bot
 app = Client(
     session_path,
     api_id=api_id,
@@ -371,82 +2896,113 @@ app = Client(
     bot_token=bot_token
 )
 
+# Almacenes persistentes: se abren en open_stores() y no al importar, porque crearlos
+# toca el disco (limpia miniaturas, abre SQLite) y los workers de CPU_POOL reimportan el módulo
+THUMB_CACHE = None
+UPLOAD_JOURNALS = None
+DOWNLOAD_JOURNALS = None
+FILE_INDEX = None
+FILE_IDS = None
+RECEIVED = None
+FIND_QUERIES = PathRegistry(max_size=200)  # Búsquedas recientes, referenciadas desde los botones
+
 # ----------------------------------------------------------------
 
-@app.on_callback_query(filters.regex("^upload_highres$"))
+@app.on_callback_query(filters.regex(r"^upload_highres(\|\d+)?$"))
 @owner_only
 async def upload_highres_callback(client: Client, query: CallbackQuery):
     await query.answer()
     chat_id = query.message.chat.id
-    # Captura de pantalla en alta calidad usando mss y PIL
-    with mss.mss() as sct:
-        monitor = sct.monitors[1]  # Selecciona el monitor principal
-        sct_img = sct.grab(monitor)
-        img = Image.frombytes("RGB", sct_img.size, sct_img.rgb)
-        bio = io.BytesIO()
-        img.save(bio, format="JPEG", quality=95)  # Alta calidad JPEG
-        bio.seek(0)
-        bio.name = "captura_alta.jpg"  # Asigna un nombre al buffer
-    await client.send_document(
+    parts = query.data.split("|")
+    try:
+        monitors = await CAPTURE.monitor_count()
+        if len(parts) == 1 and monitors > 1:
+            # Con varios monitores se pregunta cuál capturar (0 = todos unidos)
+            buttons = [[InlineKeyboardButton(f"🖥️ Monitor {n}", callback_data=f"upload_highres|{n}")] for n in range(1, monitors + 1)]
+            buttons.append([InlineKeyboardButton("🖼️ Todos los monitores", callback_data="upload_highres|0")])
+            msg = await outbound(client.send_message, chat_id=chat_id, text="¿Qué pantalla quieres capturar?",
+                                 reply_markup=InlineKeyboardMarkup(buttons))
+            record_nav_message(chat_id, msg.id)
+            return
+        monitor_index = 1 if len(parts) == 1 else int(parts[1])
+        if monitor_index > monitors:
+            await outbound(client.send_message, chat_id=chat_id, text="❌ Ese monitor ya no está disponible.")
+            return
+        # Captura de pantalla en alta calidad (JPEG 95) desde el hilo de captura
+        data = await CAPTURE.still(monitor_index, 95)
+    except Exception as e:
+        logger.error(f"Error al capturar la pantalla: {e}")
+        await outbound(client.send_message, chat_id=chat_id, text=f"❌ No se pudo capturar la pantalla: {e}")
+        return
+    bio = io.BytesIO(data)
+    bio.name = "captura_alta.jpg"  # Asigna un nombre al buffer
+    await outbound(client.send_document,
         chat_id=chat_id,
         document=bio,
-        caption="📸 Captura de pantalla en alta calidad (documento)"
+        caption="📸 Captura de pantalla en alta calidad (documento)",
+        priority=PRIORITY_BULK
     )
 
 
-
-
 @app.on_callback_query(filters.regex("^list_processes$"))
 @owner_only
 async def list_processes_callback(client: Client, query: CallbackQuery):
     await query.answer()
+    chat_id = query.message.chat.id
     try:
-        # Ejecuta el comando "tasklist" y captura la salida en texto
-        result = subprocess.run("tasklist", shell=True, capture_output=True, text=True)
-        output = result.stdout
-        
-        # Si el mensaje es muy largo, se envía como archivo
-        if len(output) > 4000:
-            bio = io.BytesIO(output.encode())
-            bio.name = "processes.txt"
-            await client.send_document(
-                chat_id=query.message.chat.id,
-                document=bio,
-                caption="Procesos activos"
-            )
-        else:
-            await client.send_message(
-                chat_id=query.message.chat.id,
-                text=f"Procesos activos:\n\n{output}"
-            )
+        rows = await IO_POOL.run(PROCESSES.sorted_snapshot, "cpu")
+        text, markup = render_process_page(rows, "cpu", 0)
+        msg = await outbound(client.send_message, chat_id=chat_id, text=text, reply_markup=markup)
+        record_nav_message(chat_id, msg.id)
     except Exception as e:
-        await client.send_message(
-            chat_id=query.message.chat.id,
+        await outbound(client.send_message,
+            chat_id=chat_id,
             text=f"❌ Error al listar procesos: {e}"
         )
 
-async def screen_update_task(client: Client, chat_id: int, message_id: int):
-    try:
-        while True:
-            # Captura de pantalla usando mss
-            with mss.mss() as sct:
-                monitor = sct.monitors[1]  # Selecciona el monitor principal
-                sct_img = sct.grab(monitor)
-                bio = io.BytesIO(mss.tools.to_png(sct_img.rgb, sct_img.size))
-                bio.seek(0)
-            # Actualiza el mensaje con la foto y un botón "Eliminar pantalla"
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Eliminar pantalla", callback_data="stop_screen")]
-            ])
-            media = InputMediaPhoto(media=bio)
-            await client.edit_message_media(chat_id=chat_id, message_id=message_id, media=media, reply_markup=keyboard)
-            await asyncio.sleep(5)
-    except asyncio.CancelledError:
+@app.on_callback_query(filters.regex(r"^procs\|"))
+@owner_only
+async def processes_page_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    parts = query.data.split("|")
+    if len(parts) < 3 or parts[1] not in PROCESS_SORT_KEYS:
+        await outbound(query.edit_message_text, "❌ Parámetros inválidos.")
         return
+    _, sort, page_str = parts
+    try:
+        rows = await IO_POOL.run(PROCESSES.sorted_snapshot, sort)
+        text, markup = render_process_page(rows, sort, int(page_str))
+        await outbound(query.edit_message_text, text, reply_markup=markup)
     except Exception as e:
-        logger.error(f"Error en actualización de pantalla: {e}")
-        return
+        # Telegram rechaza la edición si el contenido no ha cambiado; no es un error real
+        if "MESSAGE_NOT_MODIFIED" not in str(e):
+            await outbound(query.edit_message_text, f"❌ Error al listar procesos: {e}")
 
+@app.on_message(filters.command("chart"))
+@owner_only
+async def chart_handler(client: Client, message: Message):
+    chat_id = message.chat.id
+    data = RESOURCES.export()
+    if len(data["time"]) < 2:
+        msg = await outbound(message.reply, "⏳ Aún no hay suficientes muestras. Inténtalo en unos segundos.")
+        record_nav_message(chat_id, msg.id)
+        return
+    png = await CPU_POOL.run(render_resource_chart, data)
+    bio = io.BytesIO(png)
+    bio.name = "recursos.png"
+    caption = f"📈 Recursos de los últimos {format_age(data['time'][-1] - data['time'][0])}"
+    # Los procesos solo se miden al pedir la gráfica: el muestreador de fondo no los recorre
+    try:
+        rows = await IO_POOL.run(PROCESSES.sorted_snapshot, "cpu")
+    except Exception as e:
+        logger.warning(f"Error listando procesos para /chart: {e}")
+        rows = []
+    if rows:
+        caption += "\n\n🔥 Procesos con más CPU ahora:\n" + "\n".join(
+            f"• {proc.name}: {proc.cpu:.1f}%" for proc in rows[:RESOURCE_TOP_PROCESSES]
+        )
+    msg = await outbound(client.send_photo, chat_id=chat_id, photo=bio, caption=caption, priority=PRIORITY_BULK)
+    record_nav_message(chat_id, msg.id)
 
 @app.on_callback_query(filters.regex("^show_screen$"))
 @owner_only
@@ -457,44 +3013,81 @@ async def show_screen_callback(client: Client, query: CallbackQuery):
     if chat_id in SCREENSHOT_TASKS:
         await query.answer("La pantalla ya se está mostrando en tiempo real. Detén la actualización para volver a iniciarla.", show_alert=True)
         return
-    # Captura la pantalla e inicia el proceso
-    screenshot = pyautogui.screenshot()
-    bio = io.BytesIO()
-    screenshot.save(bio, format="JPEG", quality=95)
-    bio.seek(0)
+    # Captura la pantalla e inicia el proceso; el primer fotograma ya pasa por el codificador adaptativo
+    encoder = AdaptiveFrameEncoder()
+    try:
+        data, signature, _ = await CAPTURE.live_frame(
+            1, quality=encoder.quality, scale=encoder.scale, image_format=encoder.image_format
+        )
+    except Exception as e:
+        logger.error(f"Error al capturar la pantalla: {e}")
+        await outbound(client.send_message, chat_id=chat_id, text=f"❌ No se pudo capturar la pantalla: {e}")
+        return
+    bio = io.BytesIO(data)
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("Eliminar pantalla", callback_data="stop_screen")]
     ])
-    msg = await client.send_photo(chat_id, photo=bio, caption="⏳ Capturando pantalla...", reply_markup=keyboard)
+    msg, upload_seconds = await timed_outbound(client.send_photo, chat_id, photo=bio, caption="⏳ Capturando pantalla...",
+                                               reply_markup=keyboard)
+    encoder.record(len(data), upload_seconds)
     record_nav_message(chat_id, msg.id)
-    task = asyncio.create_task(screen_update_task(client, chat_id, msg.id))
+    task = asyncio.create_task(screen_update_task(client, chat_id, msg.id, signature, encoder))
     SCREENSHOT_TASKS[chat_id] = task
 
 
-async def screen_update_task(client: Client, chat_id: int, message_id: int):
+async def screen_update_task(client: Client, chat_id: int, message_id: int, signature: bytes = None,
+                             encoder: AdaptiveFrameEncoder = None):
+    """
+    Mantiene actualizada la pantalla en el mensaje. Los fotogramas sin cambios no se suben,
+    y el intervalo se adapta: crece mientras la pantalla está quieta y, con actividad,
+    vuelve al mínimo sin bajar del doble del último tiempo de subida.
+    """
+    encoder = encoder or AdaptiveFrameEncoder()
+    stats = SCREEN_STATS[chat_id] = {
+        "captured": 1, "sent": 1, "skipped": 0, "interval": SCREEN_MIN_INTERVAL, "encoder": encoder
+    }
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Eliminar pantalla", callback_data="stop_screen")]
+    ])
+    interval = SCREEN_MIN_INTERVAL
     try:
         while True:
-            with mss.mss() as sct:
-                monitor = sct.monitors[1]  # Selecciona el monitor principal
-                sct_img = sct.grab(monitor)
-                # Convertir la imagen capturada a una imagen PIL
-                from PIL import Image
-                img = Image.frombytes("RGB", sct_img.size, sct_img.rgb)
-                # Guardar la imagen en un objeto BytesIO en formato JPEG con alta calidad
-                bio = io.BytesIO()
-                img.save(bio, format="JPEG", quality=95)
-                bio.seek(0)
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Eliminar pantalla", callback_data="stop_screen")]
-            ])
-            media = InputMediaPhoto(media=bio)
-            await client.edit_message_media(chat_id=chat_id, message_id=message_id, media=media, reply_markup=keyboard)
-            await asyncio.sleep(5)
+            await asyncio.sleep(interval)
+            # Captura, comparación y codificación fuera del bucle, en el hilo de captura
+            data, signature, _ = await CAPTURE.live_frame(
+                1, signature, quality=encoder.quality, scale=encoder.scale, image_format=encoder.image_format
+            )
+            stats["captured"] += 1
+            if data is None:
+                stats["skipped"] += 1
+                interval = min(SCREEN_MAX_INTERVAL, interval * 1.5)
+            else:
+                caption = (
+                    f"🖥️ Pantalla en tiempo real\n"
+                    f"📸 Capturas: {stats['captured']} · Enviadas: {stats['sent'] + 1} · Omitidas: {stats['skipped']}\n"
+                    f"📦 {format_size(len(data))} · {encoder.image_format} Q{encoder.quality} · {encoder.scale * 100:.0f}%"
+                )
+                media = InputMediaPhoto(media=io.BytesIO(data), caption=caption)
+                # Solo cuenta la subida: la espera en la cola de salida no dice nada del enlace
+                _, upload_seconds = await timed_outbound(
+                    client.edit_message_media, chat_id=chat_id, message_id=message_id, media=media, reply_markup=keyboard,
+                    priority=PRIORITY_PROGRESS, key=("screen", chat_id, message_id)
+                )
+                encoder.record(len(data), upload_seconds)
+                stats["sent"] += 1
+                interval = min(SCREEN_MAX_INTERVAL, max(SCREEN_MIN_INTERVAL, 2 * upload_seconds))
+            stats["interval"] = interval
     except asyncio.CancelledError:
         return
     except Exception as e:
         logger.error(f"Error en actualización de pantalla: {e}")
         return
+    finally:
+        if SCREENSHOT_TASKS.get(chat_id) is asyncio.current_task():
+            del SCREENSHOT_TASKS[chat_id]
+        # stop_screen ya saca la tarea de SCREENSHOT_TASKS; los contadores se quitan si siguen siendo los nuestros
+        if SCREEN_STATS.get(chat_id) is stats:
+            del SCREEN_STATS[chat_id]
 
 
 
@@ -508,7 +3101,7 @@ async def stop_screen_callback(client: Client, query: CallbackQuery):
         SCREENSHOT_TASKS[chat_id].cancel()
         del SCREENSHOT_TASKS[chat_id]
     try:
-        await query.message.delete()
+        await outbound(query.message.delete)
     except Exception as e:
         logger.warning(f"Error al borrar mensaje de pantalla: {e}")
 
@@ -520,11 +3113,116 @@ async def start_handler(client: Client, message: Message):
     logger.info(f"Comando /start recibido de {message.chat.id}")
     await main_panel(client, message)
 
+def collect_stats() -> str:
+    """Reúne los contadores internos del bot en un texto legible."""
+    lines = [
+        "📊 Estadísticas internas",
+        f"📁 Carpetas: {FOLDER_MAP.stats()}",
+        f"📄 Archivos: {FILE_MAP.stats()}",
+        f"🗂️ Instantáneas de directorio: {len(DIR_SNAPSHOTS)}/{DIR_CACHE_MAX}",
+        f"🖼️ Miniaturas: {THUMB_CACHE.stats()}",
+        f"🆔 file_id reutilizables: {FILE_IDS.stats()}",
+        f"♻️ Archivos recibidos: {RECEIVED.stats()}",
+        f"🧵 Pool E/S: {IO_POOL.stats()}",
+        f"⚙️ Pool CPU: {CPU_POOL.stats()}",
+        f"📤 Salida: {OUTBOUND.stats()}",
+        f"🧹 Mensajes de navegación: {NAV_LIFECYCLE.stats()}",
+        f"📸 Hilo de captura: {CAPTURE.stats()}",
+        f"📋 Procesos: {PROCESSES.stats()}",
+        f"📈 Historial de recursos: {RESOURCES.stats()}",
+        f"🔎 Índice de archivos: {FILE_INDEX.stats()}",
+        f"📊 Tamaños de carpetas: {FOLDER_SIZES.stats()}, pool {FOLDER_SIZES.pool.stats()}",
+        f"⏳ Progreso: {PROGRESS.stats()}",
+        f"🚚 Transferencias: {TRANSFERS.stats()}",
+        f"🎬 FFmpeg: ejecuciones {FFMPEG_STATS['runs']}, tiempos agotados {FFMPEG_STATS['timeouts']}, "
+        f"errores {FFMPEG_STATS['errors']}",
+    ]
+    for chat_id, st in SCREEN_STATS.items():
+        lines.append(
+            f"🖥️ Pantalla {chat_id}: capturas {st['captured']}, enviadas {st['sent']}, "
+            f"omitidas {st['skipped']}, intervalo {st['interval']:.1f}s, último {st['encoder'].describe()}"
+        )
+    return "\n".join(lines)
+
+@app.on_message(filters.command("stats"))
+@owner_only
+async def stats_handler(client: Client, message: Message):
+    msg = await outbound(message.reply, collect_stats())
+    record_nav_message(message.chat.id, msg.id)
+
+@app.on_message(filters.command("transfers"))
+@owner_only
+async def transfers_handler(client: Client, message: Message):
+    text, markup = TRANSFERS.render()
+    msg = await outbound(message.reply, text, reply_markup=markup)
+    record_nav_message(message.chat.id, msg.id)
+
+@app.on_callback_query(filters.regex("^transfers$"))
+@owner_only
+async def transfers_refresh_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    text, markup = TRANSFERS.render()
+    try:
+        await outbound(query.edit_message_text, text, reply_markup=markup)
+    except Exception as e:
+        # Telegram rechaza la edición si el contenido no ha cambiado
+        logger.debug(f"Vista de transferencias sin cambios: {e}")
+
+async def render_find_page(query_id: str, pattern: str, page: int):
+    """Texto y teclado de una página de resultados de /find."""
+    rows = await IO_POOL.run(FILE_INDEX.search, pattern, FIND_PER_PAGE + 1, page * FIND_PER_PAGE)
+    has_more = len(rows) > FIND_PER_PAGE
+    rows = rows[:FIND_PER_PAGE]
+    lines = [f"🔎 Resultados para «{pattern}» (página {page + 1}):"]
+    if FILE_INDEX.scanning or FILE_INDEX.last_scan is None:
+        lines.append("⏳ El índice se está actualizando; puede haber resultados incompletos.")
+    if not rows:
+        lines.append("\n❌ No se encontraron archivos.")
+    folder_buttons = []
+    for n, (folder, name, size, mtime) in enumerate(rows, start=page * FIND_PER_PAGE + 1):
+        lines.append(f"\n{n}. 📄 {name}\n    📁 {folder} · 💾 {format_size(size)}")
+        folder_buttons.append(InlineKeyboardButton(f"📁 {n}", callback_data=f"folder|{FOLDER_MAP.register(folder)}"))
+    keyboard = [folder_buttons[i:i + 5] for i in range(0, len(folder_buttons), 5)]
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("◀️ Anteriores", callback_data=f"find|{query_id}|{page - 1}"))
+    if has_more:
+        nav_row.append(InlineKeyboardButton("▶️ Siguientes", callback_data=f"find|{query_id}|{page + 1}"))
+    if nav_row:
+        keyboard.append(nav_row)
+    keyboard.append([InlineKeyboardButton("🏠 Inicio", callback_data="home")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+@app.on_message(filters.command("find"))
+@owner_only
+async def find_handler(client: Client, message: Message):
+    chat_id = message.chat.id
+    pattern = message.text.split(maxsplit=1)[1].strip() if len(message.text.split(maxsplit=1)) > 1 else ""
+    if not pattern:
+        msg = await outbound(message.reply, "Uso: /find <patrón>  (admite comodines, p. ej. /find *.iso)")
+        record_nav_message(chat_id, msg.id)
+        return
+    query_id = FIND_QUERIES.register(pattern)
+    text, markup = await render_find_page(query_id, pattern, 0)
+    msg = await outbound(message.reply, text, reply_markup=markup)
+    record_nav_message(chat_id, msg.id)
+
+@app.on_callback_query(filters.regex(r"^find\|"))
+@owner_only
+async def find_page_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, query_id, page_str = query.data.split("|")
+    pattern = FIND_QUERIES.get(query_id)
+    if pattern is None:
+        await outbound(query.edit_message_text, "❌ La búsqueda ha caducado. Vuelve a lanzar /find.")
+        return
+    text, markup = await render_find_page(query_id, pattern, int(page_str))
+    await outbound(query.edit_message_text, text, reply_markup=markup)
+
 @app.on_callback_query(filters.regex("^home$"))
 @owner_only
 async def home_callback(client: Client, query: CallbackQuery):
     await query.answer()
-    await clear_nav_messages(client, query.message.chat.id)
     await main_panel(client, query.message)
 
 @app.on_callback_query(filters.regex(r"^drive\|"))
@@ -534,16 +3232,16 @@ async def drive_callback(client: Client, query: CallbackQuery):
     _, drive = query.data.split("|", 1)
     chat_id = query.message.chat.id
     try:
-        entries = os.listdir(drive)
+        snapshot = await IO_POOL.run(get_dir_snapshot, drive)
     except Exception as e:
-        await query.edit_message_text(text=f"❌ Error al acceder a la unidad {drive}: {e}")
+        await outbound(query.edit_message_text, text=f"❌ Error al acceder a la unidad {drive}: {e}")
         return
 
-    folders = [d for d in entries if os.path.isdir(os.path.join(drive, d))]
-    files = [f for f in entries if os.path.isfile(os.path.join(drive, f))]
+    folders = snapshot.folders
+    files = snapshot.files
 
     if not folders and not files:
-        await query.edit_message_text(text=f"❌ La unidad {drive} está vacía.")
+        await outbound(query.edit_message_text, text=f"❌ La unidad {drive} está vacía.")
         return
 
     # Actualizamos el estado de navegación con la unidad seleccionada
@@ -552,13 +3250,11 @@ async def drive_callback(client: Client, query: CallbackQuery):
     # Agregamos los botones para las carpetas (si existen)
     for d in folders:
         full_path = os.path.join(drive, d)
-        folder_id = str(uuid.uuid4())
-        FOLDER_MAP[folder_id] = full_path
+        folder_id = FOLDER_MAP.register(full_path)
         buttons.append([InlineKeyboardButton(f"📁 {d}", callback_data=f"folder|{folder_id}")])
     # Si existen archivos, agregamos un botón para listarlos
     if files:
-        drive_id = str(uuid.uuid4())
-        FOLDER_MAP[drive_id] = drive  # Usamos la unidad misma como "carpeta" para listar archivos
+        drive_id = FOLDER_MAP.register(drive)  # Usamos la unidad misma como "carpeta" para listar archivos
         buttons.append([InlineKeyboardButton("📄 Listar archivos", callback_data=f"list_files|{drive_id}|0")])
     reply_markup = InlineKeyboardMarkup(buttons)
     text = f"📂 Unidad: {drive}\nSelecciona una carpeta o lista los archivos disponibles."
@@ -577,139 +3273,516 @@ async def folder_callback(client: Client, query: CallbackQuery):
     # Actualizamos el estado de navegación con la carpeta seleccionada
     CURRENT_NAV_STATE[chat_id] = folder_path
     try:
-        items = os.listdir(folder_path)
+        snapshot = await IO_POOL.run(get_dir_snapshot, folder_path)
+    except Exception as e:
+        await update_menu(client, chat_id, f"❌ Error al acceder a la carpeta {folder_path}: {e}", navigation_markup(folder_id))
+        return
+    subfolders = snapshot.folders
+    files = snapshot.files
+    msg = (
+        f"📁 Carpeta: {folder_path}\n"
+        f"📂 Subcarpetas: {len(subfolders)}\n"
+        f"📄 Archivos: {len(files)}"
+    )
+    other_buttons = []
+    if subfolders:
+        other_buttons.append([InlineKeyboardButton("📂 Listar subcarpetas", callback_data=f"list_subfolders|{folder_id}|0")])
+        other_buttons.append([InlineKeyboardButton("📊 Subcarpetas por tamaño", callback_data=f"sizes|{folder_id}")])
+    if files:
+        other_buttons.append([InlineKeyboardButton("📄 Listar archivos", callback_data=f"list_files|{folder_id}|0")])
+    if subfolders or files:
+        other_buttons.append([InlineKeyboardButton("🗜️ Enviar carpeta como archivo", callback_data=f"archive|{folder_id}")])
+    nav_markup = navigation_markup(folder_id)
+    combined_buttons = nav_markup.inline_keyboard + other_buttons
+    full_markup = InlineKeyboardMarkup(combined_buttons)
+    await update_menu(client, chat_id, msg, full_markup)
+
+THUMB_CONCURRENCY = 4  # Miniaturas generadas en paralelo al mostrar una página
+
+def file_caption(entry: FileEntry) -> str:
+    """Texto descriptivo de un archivo del listado."""
+    try:
+        creation_date = datetime.datetime.fromtimestamp(entry.ctime).strftime("%d/%m/%Y %H:%M:%S")
+    except Exception:
+        creation_date = "N/A"
+    return (
+        f"📄 Archivo: {entry.name}\n"
+        f"📅 Creación: {creation_date}\n"
+        f"💾 Tamaño: {format_size(entry.size)}"
+    )
+
+def file_action_buttons(file_id: str, entry: FileEntry, label: str = None):
+    """
+    Botones de acción de un archivo: subir (por partes si es muy grande), eliminar y ejecutar/abrir.
+    Con 'label' se usan textos cortos, pensados para el teclado que acompaña a un álbum.
+    """
+    buttons = []
+    upload_text = "⬆️ Subir a Telegram" if entry.size <= UPLOAD_SINGLE_LIMIT else "⬆️ Subir por partes"
+    buttons.append(InlineKeyboardButton(f"⬆️ {label}" if label else upload_text, callback_data=f"upload|{file_id}"))
+    buttons.append(InlineKeyboardButton(f"🗑️ {label}" if label else "🗑️ Eliminar", callback_data=f"delete|{file_id}"))
+    if is_openable(entry.path):
+        buttons.append(InlineKeyboardButton(f"⚙️ {label}" if label else "Ejecutar/Abrir", callback_data=f"execute|{file_id}"))
+    return buttons
+
+def render_folder_sizes(folder_path: str, results, done: int, total: int, own, final: bool, folder_id: str = None):
+    """Texto y teclado con las subcarpetas ordenadas por tamaño (parcial mientras se calcula)."""
+    results = sorted(results, key=lambda item: item[1], reverse=True)
+    total_bytes = own[0] + sum(size for _, size, _ in results)
+    total_files = own[1] + sum(files for _, _, files in results)
+    state = "" if final else f" ⏳ {done}/{total} subcarpetas"
+    lines = [
+        f"📊 {folder_path}",
+        f"💾 Total: {format_size(total_bytes)} en {total_files} archivos{state}",
+        f"📄 Archivos sueltos: {format_size(own[0])} ({own[1]})",
+        "",
+    ]
+    buttons = []
+    for n, (path, size, files) in enumerate(results[:FOLDER_SIZE_MAX_LISTED], start=1):
+        name = os.path.basename(path)
+        share = size / total_bytes * 100 if total_bytes else 0
+        lines.append(f"{n}. 📁 {name} — {format_size(size)} ({share:.0f}%, {files} archivos)")
+        buttons.append([InlineKeyboardButton(f"📁 {name} · {format_size(size)}", callback_data=f"folder|{FOLDER_MAP.register(path)}")])
+    if len(results) > FOLDER_SIZE_MAX_LISTED:
+        lines.append(f"… y {len(results) - FOLDER_SIZE_MAX_LISTED} subcarpetas más")
+    if final and folder_id:
+        buttons.append([InlineKeyboardButton("🔄 Recalcular", callback_data=f"sizes|{folder_id}|r")])
+    buttons.append([InlineKeyboardButton("🏠 Inicio", callback_data="home")])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+@app.on_callback_query(filters.regex(r"^sizes\|"))
+@owner_only
+async def folder_sizes_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    parts = query.data.split("|")
+    folder_id = parts[1]
+    refresh = len(parts) > 2 and parts[2] == "r"
+    chat_id = query.message.chat.id
+    folder_path = FOLDER_MAP.get(folder_id)
+    if not folder_path:
+        await update_menu(client, chat_id, "❌ Carpeta no encontrada.", navigation_markup())
+        return
+    action = "Recalculando" if refresh else "Calculando"
+    msg = await outbound(client.send_message, chat_id=chat_id, text=f"⏳ {action} tamaños en {folder_path}...")
+    record_nav_message(chat_id, msg.id)
+    last_update = [0.0]
+
+    async def on_progress(results, done, total, own):
+        now = time.monotonic()
+        if done < total and now - last_update[0] < FOLDER_SIZE_UPDATE_INTERVAL:
+            return
+        last_update[0] = now
+        text, markup = render_folder_sizes(folder_path, results, done, total, own, final=False)
+        await update_message_text(msg, text, reply_markup=markup)
+
+    try:
+        results, own = await FOLDER_SIZES.subfolder_sizes(folder_path, on_progress, refresh)
+    except Exception as e:
+        await update_message_text(msg, f"❌ Error al calcular tamaños en {folder_path}: {e}")
+        return
+    text, markup = render_folder_sizes(folder_path, results, len(results), len(results), own, final=True, folder_id=folder_id)
+    await outbound(msg.edit_text, text, reply_markup=markup, key=("edit", chat_id, msg.id))
+
+@app.on_callback_query(filters.regex(r"^archive\|"))
+@owner_only
+async def archive_folder_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, folder_id = query.data.split("|", 1)
+    chat_id = query.message.chat.id
+    folder_path = FOLDER_MAP.get(folder_id)
+    if not folder_path:
+        await update_menu(client, chat_id, "❌ Carpeta no encontrada.", navigation_markup())
+        return
+    archive_id = uuid.uuid4().hex[:16]
+    cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data=f"cancel|{archive_id}")]])
+    progress_msg = await outbound(client.send_message, chat_id=chat_id, text=f"🗜️ Preparando el archivo de {folder_path}...", reply_markup=cancel_markup)
+    record_nav_message(chat_id, progress_msg.id)
+    try:
+        layout = await IO_POOL.run(TarLayout, folder_path)
+    except Exception as e:
+        await update_message_text(progress_msg, f"❌ Error al recorrer la carpeta {folder_path}: {e}")
+        return
+    volumes = layout.volumes()
+    await update_message_text(
+        progress_msg,
+        f"🗜️ {layout.name}.tar: {layout.files} archivos, {format_size(layout.size)} en {len(volumes)} volumen(es)",
+        reply_markup=cancel_markup,
+    )
+    cancel_flag = threading.Event()
+    CANCEL_FLAGS[archive_id] = cancel_flag
+    transfer = Transfer(archive_id, "upload", f"{layout.name}.tar", layout.size, cancel_flag, f"cancel|{archive_id}",
+                        priority=TRANSFER_PRIORITY_NORMAL)
+    loop = asyncio.get_running_loop()
+    progress_hook = make_upload_progress_hook(progress_msg, loop, cancel_markup, cancel_flag, transfer=transfer)
+
+    async def send():
+        for n, (start, end, name) in enumerate(volumes, start=1):
+            caption = f"🗜️ {name}" if len(volumes) == 1 else f"🗜️ {name} (parte {n}/{len(volumes)})"
+            await outbound(client.send_document,
+                chat_id=chat_id,
+                document=TarVolume(layout, start, end, name),
+                file_name=name,
+                caption=caption,
+                progress=lambda current, total, base=start: progress_hook(base + current, layout.size),
+                priority=PRIORITY_BULK
+            )
+            # Pyrogram devuelve None en vez de propagar la cancelación del hook de progreso
+            if cancel_flag.is_set():
+                raise Exception(UPLOAD_CANCELLED)
+
+    async def deliver():
+        try:
+            await TRANSFERS.run(transfer, send, progress_msg, cancel_markup)
+        except Exception as e:
+            if cancel_flag.is_set():
+                try:
+                    PROGRESS.discard(progress_msg)
+                    await outbound(progress_msg.delete, priority=PRIORITY_BULK)
+                except Exception as delete_err:
+                    logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
+                await outbound(client.send_message, chat_id=chat_id, text="Subida cancelada")
+            else:
+                await outbound(client.send_message, chat_id=chat_id, text=f"❌ Error al enviar la carpeta:\n{folder_path}\n{e}")
+                logger.error(f"Error al enviar la carpeta {folder_path} como archivo: {e}")
+            return
+        finally:
+            CANCEL_FLAGS.pop(archive_id, None)
+            PROGRESS.finish(progress_msg)
+        try:
+            PROGRESS.discard(progress_msg)
+            await outbound(progress_msg.delete, priority=PRIORITY_BULK)
+        except Exception as e_del:
+            logger.warning(f"Error borrando mensaje de progreso: {e_del}")
+        text = f"✅ Carpeta enviada como {layout.name}.tar ({layout.files} archivos, {format_size(layout.size)})."
+        if len(volumes) > 1:
+            text += (
+                f"\nPara unir los volúmenes:\n"
+                f"Windows: copy /b {layout.name}.tar.0* {layout.name}.tar\n"
+                f"Linux/macOS: cat {layout.name}.tar.0* > {layout.name}.tar"
+            )
+        msg = await outbound(client.send_message, chat_id=chat_id, text=text)
+        record_nav_message(chat_id, msg.id)
+
+    TRANSFERS.submit(transfer, deliver())
+
+async def resolve_cached_thumbnails(items):
+    """
+    Tras un rechazo de Telegram, sustituye los file_id de miniaturas en caché por la miniatura
+    real (y los olvida); las que ya eran bytes se rebobinan para reenviarlas.
+    """
+    resolved = []
+    for number, entry, file_id, msg, thumbnail, thumb_key in items:
+        if isinstance(thumbnail, str):
+            await IO_POOL.run(FILE_IDS.forget, thumb_key)
+            thumbnail = await get_thumbnail(entry)
+            if thumbnail is None:
+                continue
+        else:
+            thumbnail.seek(0)
+        resolved.append((number, entry, file_id, msg, thumbnail, thumb_key))
+    return resolved
+
+def listing_markup(listing: FileListing, listing_id: str, page: int, files=None) -> InlineKeyboardMarkup:
+    """
+    Teclado de navegación de un listado: páginas, orden, tamaño de página, filtro por extensión
+    y modo. En modo compacto ('files' con los archivos de la página) lleva además un botón por archivo.
+    """
+    rows = []
+    for index, entry in enumerate(files or [], start=page * listing.page_size):
+        label = f"{index + 1}. {file_icon(entry.path)} {entry.name[:40]}"
+        rows.append([InlineKeyboardButton(label, callback_data=f"fs|{listing_id}|{index}")])
+    pages = []
+    if page > 0:
+        pages.append(InlineKeyboardButton("◀️ Anteriores", callback_data=f"lf|{listing_id}|{page - 1}"))
+    if page + 1 < listing.page_count:
+        pages.append(InlineKeyboardButton(f"▶️ Siguientes {listing.page_size}", callback_data=f"lf|{listing_id}|{page + 1}"))
+    if pages:
+        rows.append(pages)
+    rows.append([
+        InlineKeyboardButton(("✅ " if key == listing.sort else "") + LISTING_SORTS[key][2], callback_data=f"lo|{listing_id}|s|{key}")
+        for key in LISTING_SORTS
+    ])
+    rows.append([
+        InlineKeyboardButton(("✅ " if size == listing.page_size else "") + f"{size}/pág", callback_data=f"lo|{listing_id}|n|{size}")
+        for size in LISTING_PAGE_SIZES
+    ])
+    filters_row = [InlineKeyboardButton(("✅ " if not listing.pattern else "") + "Todos", callback_data=f"lo|{listing_id}|e|")]
+    for ext in listing.top_extensions():
+        label = ("✅ " if listing.pattern == f"*{ext}" else "") + ext
+        filters_row.append(InlineKeyboardButton(label, callback_data=f"lo|{listing_id}|e|{ext}"))
+    rows.append(filters_row)
+    mode = "🗂️ Modo compacto" if not listing.compact else "🖼️ Modo con miniaturas"
+    rows.append([
+        InlineKeyboardButton(mode, callback_data=f"lo|{listing_id}|m|{0 if listing.compact else 1}"),
+        InlineKeyboardButton("🏠 Inicio", callback_data="home"),
+    ])
+    return InlineKeyboardMarkup(rows)
+
+def file_icon(path: str) -> str:
+    return "🖼️" if is_image(path) else "🎬" if is_video(path) else "📄"
+
+def render_compact_page(listing: FileListing, listing_id: str, page: int, files):
+    """Página completa en un solo mensaje: una línea por archivo y un botón para seleccionarlo."""
+    lines = [f"📁 {listing.path}", f"📄 {listing.describe(page)}", ""]
+    for index, entry in enumerate(files, start=page * listing.page_size):
+        modified = datetime.datetime.fromtimestamp(entry.mtime).strftime("%Y-%m-%d %H:%M")
+        name = entry.name if len(entry.name) <= 80 else entry.name[:77] + "..."
+        lines.append(f"{index + 1}. {file_icon(entry.path)} {name} — {format_size(entry.size)} — {modified}")
+    return "\n".join(lines), listing_markup(listing, listing_id, page, files)
+
+async def show_compact_page(client: Client, chat_id: int, listing: FileListing, listing_id: str, page: int,
+                            message: Message = None):
+    """Muestra una página en modo compacto editando 'message' en el sitio, o en un mensaje nuevo."""
+    files = await IO_POOL.run(listing.page, page)
+    text, markup = render_compact_page(listing, listing_id, page, files)
+    if message is not None:
+        try:
+            await outbound(message.edit_text, text, reply_markup=markup, key=("edit", chat_id, message.id))
+            return
+        except BadRequest as e:
+            # Mismo contenido (MESSAGE_NOT_MODIFIED) o mensaje ya no editable
+            if "MESSAGE_NOT_MODIFIED" in str(e):
+                return
+            logger.info(f"No se pudo editar el listado compacto, se envía de nuevo: {e}")
+    sent = await outbound(client.send_message, chat_id=chat_id, text=text, reply_markup=markup)
+    record_nav_message(chat_id, sent.id)
+
+async def send_file_preview(client: Client, chat_id: int, entry: FileEntry):
+    """Vista previa de un archivo seleccionado en el listado compacto: miniatura (si la hay) y acciones."""
+    file_id = FILE_MAP.register(entry.path)
+    caption = file_caption(entry)
+    markup = InlineKeyboardMarkup([[button] for button in file_action_buttons(file_id, entry)])
+    if is_image(entry.path) or is_video(entry.path):
+        thumb_key = FileIdCache.make_key("thumb", entry.path, entry.size, entry.mtime)
+        cached = await IO_POOL.run(FILE_IDS.get, thumb_key)
+        if cached:
+            try:
+                sent = await outbound(client.send_photo, chat_id=chat_id, photo=cached, caption=caption, reply_markup=markup)
+                record_nav_message(chat_id, sent.id)
+                return
+            except (BadRequest, ValueError) as e:
+                logger.info(f"file_id de miniatura rechazado, se vuelve a subir: {e}")
+                await IO_POOL.run(FILE_IDS.forget, thumb_key)
+        thumbnail = await get_thumbnail(entry)
+        if thumbnail is not None:
+            sent = await outbound(client.send_photo, chat_id=chat_id, photo=thumbnail, caption=caption, reply_markup=markup)
+            thumbnail.close()
+            record_nav_message(chat_id, sent.id)
+            if sent_file_id(sent):
+                await IO_POOL.run(FILE_IDS.put, thumb_key, sent_file_id(sent))
+            return
+        caption += "\n❌ No se pudo generar la miniatura."
+    sent = await outbound(client.send_message, chat_id=chat_id, text=caption, reply_markup=markup)
+    record_nav_message(chat_id, sent.id)
+
+async def open_listing(client: Client, chat_id: int, folder_path: str, sort: str = None, pattern: str = "",
+                       page_size: int = None, compact: bool = None, message: Message = None):
+    """
+    Crea un listado nuevo (instantánea ordenada y filtrada) y muestra su primera página.
+    En modo compacto, si se pasa 'message', se edita ese mensaje en lugar de enviar otro.
+    """
+    prefs = LISTING_PREFS.get(chat_id, {})
+    sort = sort or prefs.get("sort", LISTING_DEFAULT_SORT)
+    page_size = page_size or prefs.get("page_size", LISTING_DEFAULT_PAGE_SIZE)
+    compact = prefs.get("compact", LISTING_DEFAULT_COMPACT) if compact is None else compact
+    LISTING_PREFS[chat_id] = {"sort": sort, "page_size": page_size, "compact": compact}
+    folder_id = FOLDER_MAP.register(folder_path)
+    try:
+        snapshot = await IO_POOL.run(get_dir_snapshot, folder_path)
     except Exception as e:
-        await update_menu(client, chat_id, f"❌ Error al acceder a la carpeta {folder_path}: {e}", navigation_markup(folder_id))
+        await update_menu(client, chat_id, f"❌ Error al listar archivos en {folder_path}: {e}", navigation_markup(folder_id))
         return
-    subfolders = [d for d in items if os.path.isdir(os.path.join(folder_path, d))]
-    files = [f for f in items if os.path.isfile(os.path.join(folder_path, f))]
-    msg = (
-        f"📁 Carpeta: {folder_path}\n"
-        f"📂 Subcarpetas: {len(subfolders)}\n"
-        f"📄 Archivos: {len(files)}"
+    # Filtrar y preparar el listado recorre toda la carpeta: fuera del bucle
+    listing = await IO_POOL.run(FileListing, snapshot, sort, pattern, page_size, compact)
+    await IO_POOL.run(snapshot.top_extensions)
+    if not listing.files:
+        detail = f" que coincidan con {pattern}" if pattern else ""
+        await update_menu(client, chat_id, f"❌ No hay archivos{detail} en la carpeta {folder_path}.", navigation_markup(folder_id))
+        return
+    listing_id = LISTINGS.register(listing)
+    if compact:
+        await show_compact_page(client, chat_id, listing, listing_id, 0, message)
+    else:
+        await send_file_page(client, chat_id, listing, listing_id, 0)
+
+async def send_file_page(client: Client, chat_id: int, listing: FileListing, listing_id: str, page: int):
+    """Envía una página de un listado: miniaturas (en álbumes) o texto, acciones y navegación."""
+    page_files = await IO_POOL.run(listing.page, page)
+    start_index = page * listing.page_size
+
+    # Todas las miniaturas de la página se generan a la vez (con un límite de concurrencia)
+    semaphore = asyncio.Semaphore(THUMB_CONCURRENCY)
+
+    async def page_thumbnail(entry: FileEntry):
+        if not (is_image(entry.path) or is_video(entry.path)):
+            return None
+        # Miniatura ya enviada antes: basta su file_id de Telegram
+        cached = await IO_POOL.run(FILE_IDS.get, FileIdCache.make_key("thumb", entry.path, entry.size, entry.mtime))
+        if cached:
+            return cached
+        async with semaphore:
+            return await get_thumbnail(entry)
+
+    thumbnails = await asyncio.gather(*(page_thumbnail(entry) for entry in page_files))
+
+    media_items = []  # [(número, entry, file_id, caption, miniatura o file_id de Telegram, clave de caché)]
+    for number, (entry, thumbnail) in enumerate(zip(page_files, thumbnails), start=start_index + 1):
+        file_id = FILE_MAP.register(entry.path)
+        msg = file_caption(entry)
+        if thumbnail:
+            thumb_key = FileIdCache.make_key("thumb", entry.path, entry.size, entry.mtime)
+            media_items.append((number, entry, file_id, msg, thumbnail, thumb_key))
+            continue
+        if is_image(entry.path):
+            msg += "\n❌ No se pudo generar la miniatura."
+        elif is_video(entry.path):
+            msg += "\n❌ No se pudo generar la miniatura del video."
+        markup = InlineKeyboardMarkup([[button] for button in file_action_buttons(file_id, entry)])
+        sent = await outbound(client.send_message, chat_id=chat_id, text=msg, reply_markup=markup, priority=PRIORITY_BULK)
+        record_nav_message(chat_id, sent.id)
+
+    single = len(media_items) == 1
+
+    async def send_media_chunk(chunk):
+        if single:
+            _, entry, file_id, msg, thumbnail, _ = chunk[0]
+            markup = InlineKeyboardMarkup([[button] for button in file_action_buttons(file_id, entry)])
+            sent = await outbound(
+                client.send_photo, chat_id=chat_id, photo=thumbnail, caption=msg, reply_markup=markup, priority=PRIORITY_BULK
+            )
+            return [sent]
+        # Los álbumes no admiten teclado: las acciones van en un mensaje aparte, numeradas
+        album = [
+            InputMediaPhoto(media=thumbnail, caption=f"#{number} {msg}")
+            for number, _, _, msg, thumbnail, _ in chunk
+        ]
+        if len(album) == 1:
+            return [await outbound(
+                client.send_photo, chat_id=chat_id, photo=album[0].media, caption=album[0].caption, priority=PRIORITY_BULK
+            )]
+        return await outbound(client.send_media_group, chat_id=chat_id, media=album, priority=PRIORITY_BULK)
+
+    # Telegram admite como mucho MEDIA_GROUP_MAX fotos por álbum. Si rechaza un file_id en caché
+    # solo se reenvía ese álbum: los anteriores ya están en el chat y no deben duplicarse.
+    delivered = []  # [(elemento, mensaje enviado)]
+    for first in range(0, len(media_items), MEDIA_GROUP_MAX):
+        chunk = media_items[first:first + MEDIA_GROUP_MAX]
+        try:
+            sent_chunk = await send_media_chunk(chunk)
+        except (BadRequest, ValueError) as e:
+            if not any(isinstance(item[4], str) for item in chunk):
+                raise
+            logger.info(f"file_id de miniatura rechazado, se vuelven a subir: {e}")
+            chunk = await resolve_cached_thumbnails(chunk)
+            sent_chunk = await send_media_chunk(chunk) if chunk else []
+        # Se anotan en cuanto salen: si falla un álbum posterior, estos también se limpian
+        for sent in sent_chunk:
+            record_nav_message(chat_id, sent.id)
+        delivered += zip(chunk, sent_chunk)
+    media_items = [item for item, _ in delivered]
+    for item, sent in delivered:
+        if not isinstance(item[4], str) and sent_file_id(sent):
+            await IO_POOL.run(FILE_IDS.put, item[5], sent_file_id(sent))
+    if len(media_items) > 1:
+        action_rows = [
+            file_action_buttons(file_id, entry, label=f"#{number}")
+            for number, entry, file_id, *_ in media_items
+        ]
+        sent = await outbound(client.send_message,
+            chat_id=chat_id,
+            text="Acciones (⬆️ subir, 🗑️ eliminar, ⚙️ ejecutar/abrir):",
+            reply_markup=InlineKeyboardMarkup(action_rows),
+            priority=PRIORITY_BULK
+        )
+        record_nav_message(chat_id, sent.id)
+    for item in media_items:
+        if not isinstance(item[4], str):
+            item[4].close()
+
+    nav_msg = await outbound(client.send_message,
+        chat_id=chat_id,
+        text=f"Navegación: {listing.describe(page)}",
+        reply_markup=listing_markup(listing, listing_id, page),
+        priority=PRIORITY_BULK
     )
-    other_buttons = []
-    if subfolders:
-        other_buttons.append([InlineKeyboardButton("📂 Listar subcarpetas", callback_data=f"list_subfolders|{folder_id}|0")])
-    if files:
-        other_buttons.append([InlineKeyboardButton("📄 Listar archivos", callback_data=f"list_files|{folder_id}|0")])
-    nav_markup = navigation_markup(folder_id)
-    combined_buttons = nav_markup.inline_keyboard + other_buttons
-    full_markup = InlineKeyboardMarkup(combined_buttons)
-    await update_menu(client, chat_id, msg, full_markup)
+    record_nav_message(chat_id, nav_msg.id)
 
 @app.on_callback_query(filters.regex(r"^list_files\|"))
 @owner_only
 async def list_files_callback(client: Client, query: CallbackQuery):
     await query.answer()
     parts = query.data.split("|")
-    if len(parts) < 3:
+    if len(parts) < 2:
         await update_menu(client, query.message.chat.id, "❌ Parámetros inválidos.", navigation_markup())
         return
-    _, folder_id, page_str = parts
     chat_id = query.message.chat.id
-    folder_path = FOLDER_MAP.get(folder_id)
+    folder_path = FOLDER_MAP.get(parts[1])
     if not folder_path:
         await update_menu(client, chat_id, "❌ Carpeta no encontrada.", navigation_markup())
         return
-    try:
-        files = sorted(
-            [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))],
-            key=lambda f: os.path.getctime(os.path.join(folder_path, f)),
-            reverse=True,
-        )
-    except Exception as e:
-        await update_menu(client, chat_id, f"❌ Error al listar archivos en {folder_path}: {e}", navigation_markup(folder_id))
+    await open_listing(client, chat_id, folder_path)
+
+@app.on_callback_query(filters.regex(r"^lf\|"))
+@owner_only
+async def listing_page_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, listing_id, page_str = query.data.split("|")
+    listing = LISTINGS.get(listing_id)
+    if listing is None:
+        await outbound(query.edit_message_text, "⌛ Este listado ha caducado. Vuelve a abrir la carpeta.")
         return
-    if not files:
-        await update_menu(client, chat_id, f"❌ No hay archivos en la carpeta {folder_path}.", navigation_markup(folder_id))
+    if listing.compact:
+        await show_compact_page(client, query.message.chat.id, listing, listing_id, int(page_str), query.message)
+    else:
+        await send_file_page(client, query.message.chat.id, listing, listing_id, int(page_str))
+
+@app.on_callback_query(filters.regex(r"^lo\|"))
+@owner_only
+async def listing_option_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, listing_id, option, value = query.data.split("|", 3)
+    listing = LISTINGS.get(listing_id)
+    if listing is None:
+        await outbound(query.edit_message_text, "⌛ Este listado ha caducado. Vuelve a abrir la carpeta.")
         return
-    page = int(page_str)
-    per_page = 10
-    start_index = page * per_page
-    end_index = start_index + per_page
-    page_files = files[start_index:end_index]
-    for f in page_files:
-        full_path = os.path.join(folder_path, f)
-        try:
-            file_stat = os.stat(full_path)
-            creation_date = datetime.datetime.fromtimestamp(file_stat.st_ctime).strftime("%d/%m/%Y %H:%M:%S")
-            size = format_size(file_stat.st_size)
-        except Exception:
-            creation_date = "N/A"
-            size = "N/A"
-        msg = (
-            f"📄 Archivo: {f}\n"
-            f"📅 Creación: {creation_date}\n"
-            f"💾 Tamaño: {size}"
-        )
-        file_id = str(uuid.uuid4())
-        FILE_MAP[file_id] = full_path
-        # Botón de subir
-        markup = None
-        if file_stat.st_size < 2 * 1024 * 1024 * 1024:
-            markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬆️ Subir a Telegram", callback_data=f"upload|{file_id}")]])
-        # Botón de eliminar
-        delete_button = InlineKeyboardButton("🗑️ Eliminar", callback_data=f"delete|{file_id}")
-        if markup:
-            markup.inline_keyboard.append([delete_button])
-        else:
-            markup = InlineKeyboardMarkup([[delete_button]])
-        # Botón de ejecutar para archivos ejecutables
-        if is_openable(full_path):
-            exec_button = InlineKeyboardButton("Ejecutar/Abrir", callback_data=f"execute|{file_id}")
-            markup.inline_keyboard.append([exec_button])
-
-        # Envío según tipo de archivo
-        if is_image(full_path):
-            thumbnail = generate_thumbnail(full_path)
-            if thumbnail:
-                sent = await client.send_photo(
-                    chat_id=chat_id,
-                    photo=thumbnail,
-                    caption=msg,
-                    reply_markup=markup
-                )
-                record_nav_message(chat_id, sent.id)
-                thumbnail.close()
-            else:
-                sent = await client.send_message(
-                    chat_id=chat_id,
-                    text=msg + "\n❌ No se pudo generar la miniatura.",
-                    reply_markup=markup
-                )
-                record_nav_message(chat_id, sent.id)
-        elif is_video(full_path):
-            thumbnail = generate_video_thumbnail(full_path)
-            if thumbnail:
-                sent = await client.send_photo(
-                    chat_id=chat_id,
-                    photo=thumbnail,
-                    caption=msg,
-                    reply_markup=markup
-                )
-                record_nav_message(chat_id, sent.id)
-                thumbnail.close()
-            else:
-                sent = await client.send_message(
-                    chat_id=chat_id,
-                    text=msg + "\n❌ No se pudo generar la miniatura del video.",
-                    reply_markup=markup
-                )
-                record_nav_message(chat_id, sent.id)
-        else:
-            sent = await client.send_message(
-                chat_id=chat_id,
-                text=msg,
-                reply_markup=markup
-            )
-            record_nav_message(chat_id, sent.id)
-    nav_buttons = [InlineKeyboardButton("🏠 Inicio", callback_data="home")]
-    if end_index < len(files):
-        nav_buttons.append(InlineKeyboardButton("▶️ Siguientes 10", callback_data=f"list_files|{folder_id}|{page+1}"))
-    nav_markup = InlineKeyboardMarkup([nav_buttons])
-    nav_msg = await client.send_message(chat_id=chat_id, text="Navegación:", reply_markup=nav_markup)
-    record_nav_message(chat_id, nav_msg.id)
+    sort, pattern, page_size, compact = listing.sort, listing.pattern, listing.page_size, listing.compact
+    if option == "s" and value in LISTING_SORTS:
+        sort = value
+    elif option == "n" and value.isdigit() and int(value) in LISTING_PAGE_SIZES:
+        page_size = int(value)
+    elif option == "e":
+        pattern = f"*{value}" if value else ""
+    elif option == "m":
+        compact = value == "1"
+    # En modo compacto el mismo mensaje pasa a mostrar el listado con las nuevas opciones
+    edit = query.message if listing.compact and compact else None
+    await open_listing(client, query.message.chat.id, listing.path, sort, pattern, page_size, compact, edit)
+
+@app.on_callback_query(filters.regex(r"^fs\|"))
+@owner_only
+async def listing_select_callback(client: Client, query: CallbackQuery):
+    _, listing_id, index_str = query.data.split("|")
+    listing = LISTINGS.get(listing_id)
+    if listing is None:
+        await query.answer()
+        await outbound(query.edit_message_text, "⌛ Este listado ha caducado. Vuelve a abrir la carpeta.")
+        return
+    entry = await IO_POOL.run(listing.entry, int(index_str))
+    if entry is None:
+        await query.answer("Archivo no encontrado en el listado", show_alert=True)
+        return
+    await query.answer()
+    await send_file_preview(client, query.message.chat.id, entry)
+
+@app.on_message(filters.command("ls"))
+@owner_only
+async def ls_handler(client: Client, message: Message):
+    chat_id = message.chat.id
+    current_path = CURRENT_NAV_STATE.get(chat_id)
+    if not current_path:
+        await outbound(message.reply, "No estás en ninguna carpeta activa. Navega a una unidad o carpeta primero.")
+        return
+    pattern = " ".join(message.command[1:]).strip()
+    await open_listing(client, chat_id, current_path, pattern=pattern)
 
 @app.on_callback_query(filters.regex(r"^list_subfolders\|"))
 @owner_only
@@ -726,7 +3799,7 @@ async def list_subfolders_callback(client: Client, query: CallbackQuery):
         await update_menu(client, chat_id, "❌ Carpeta no encontrada.", navigation_markup())
         return
     try:
-        subfolders = [d for d in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, d))]
+        subfolders = (await IO_POOL.run(get_dir_snapshot, folder_path)).folders
     except Exception as e:
         await update_menu(client, chat_id, f"❌ Error al acceder a la carpeta {folder_path}: {e}", navigation_markup(folder_id))
         return
@@ -736,8 +3809,7 @@ async def list_subfolders_callback(client: Client, query: CallbackQuery):
     buttons = []
     for d in subfolders:
         full_path = os.path.join(folder_path, d)
-        subfolder_id = str(uuid.uuid4())
-        FOLDER_MAP[subfolder_id] = full_path
+        subfolder_id = FOLDER_MAP.register(full_path)
         buttons.append([InlineKeyboardButton(f"📁 {d}", callback_data=f"folder|{subfolder_id}")])
     nav_markup = navigation_markup(folder_id)
     combined_buttons = nav_markup.inline_keyboard + buttons
@@ -752,58 +3824,249 @@ async def upload_callback(client: Client, query: CallbackQuery):
     _, file_key = query.data.split("|", 1)
     file_path = FILE_MAP.get(file_key)
     if not file_path:
-        await query.edit_message_text(text="❌ Referencia inválida para el archivo.")
+        await outbound(query.edit_message_text, text="❌ Referencia inválida para el archivo.")
+        return
+    try:
+        st = await IO_POOL.run(os.stat, file_path)
+    except OSError:
+        await outbound(query.edit_message_text, text="❌ El archivo no existe en el servidor.")
         return
-    if not os.path.exists(file_path):
-        await query.edit_message_text(text="❌ El archivo no existe en el servidor.")
+    if TRANSFERS.active(file_key):
+        await outbound(client.send_message, chat_id=chat_id, text="ℹ️ Este archivo ya se está subiendo o está en cola. Consulta /transfers.")
         return
+    if st.st_size > UPLOAD_SINGLE_LIMIT:
+        await start_split_upload(client, chat_id, file_path)
+        return
+    kind = "photo" if is_image(file_path) else "video" if is_video(file_path) else "document"
+    cache_key = FileIdCache.make_key(kind, file_path, st.st_size, st.st_mtime)
+    cached_id = await IO_POOL.run(FILE_IDS.get, cache_key)
+    if cached_id:
+        # El archivo no ha cambiado desde la última subida: se reenvía por file_id, sin subir bytes
+        try:
+            await outbound(client.send_cached_media, chat_id=chat_id, file_id=cached_id)
+            return
+        except (BadRequest, ValueError) as e:
+            logger.info(f"file_id en caché rechazado para {file_path}, se sube de nuevo: {e}")
+            await IO_POOL.run(FILE_IDS.forget, cache_key)
     cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data=f"cancel|{file_key}")]])
-    upload_msg = await client.send_message(chat_id=chat_id, text="⏳ Subiendo archivo, por favor espere...", reply_markup=cancel_markup)
+    upload_msg = await outbound(client.send_message, chat_id=chat_id, text="⏳ Subiendo archivo, por favor espere...", reply_markup=cancel_markup)
     record_nav_message(chat_id, upload_msg.id)
     cancel_flag = threading.Event()
     CANCEL_FLAGS[file_key] = cancel_flag
-    try:
-        # Dentro del try en el handler "upload_callback"
-        file_size = os.path.getsize(file_path)
-        if file_size > 2 * 1024 * 1024 * 1024:
-            await client.send_message(chat_id=chat_id, text="❌ El archivo supera el límite permitido de tamaño.")
-            return
-        loop = asyncio.get_running_loop()
-        progress_hook = make_upload_progress_hook(upload_msg, loop, cancel_markup, cancel_flag)
-        if is_image(file_path):
-            await client.send_photo(
+    transfer = Transfer(file_key, "upload", os.path.basename(file_path), st.st_size, cancel_flag, f"cancel|{file_key}")
+    loop = asyncio.get_running_loop()
+    progress_hook = make_upload_progress_hook(upload_msg, loop, cancel_markup, cancel_flag, transfer=transfer)
+
+    async def send():
+        # Al llegar el turno se comprueba que el archivo no haya crecido mientras esperaba en cola
+        file_size = await IO_POOL.run(os.path.getsize, file_path)
+        if file_size > UPLOAD_SINGLE_LIMIT:
+            raise IOError("El archivo ha crecido por encima del límite; vuelve a pulsar subir para enviarlo por partes.")
+        transfer.total = file_size
+        if kind == "photo":
+            sent = await outbound(client.send_photo,
                 chat_id=chat_id,
                 photo=file_path,
-                progress=progress_hook
+                progress=progress_hook,
+                priority=PRIORITY_BULK
             )
-        elif is_video(file_path):
-            await client.send_video(
+        elif kind == "video":
+            sent = await outbound(client.send_video,
                 chat_id=chat_id,
                 video=file_path,
-                progress=progress_hook
+                progress=progress_hook,
+                priority=PRIORITY_BULK
             )
         else:
-            await client.send_document(
+            sent = await outbound(client.send_document,
                 chat_id=chat_id,
                 document=file_path,
-                progress=progress_hook
+                progress=progress_hook,
+                priority=PRIORITY_BULK
             )
+        if sent_file_id(sent) and file_size == st.st_size:
+            await IO_POOL.run(FILE_IDS.put, cache_key, sent_file_id(sent))
 
-    except Exception as e:
-        err_msg = str(e)
-        if "Subida cancelada por el usuario" in err_msg or "NoneType" in err_msg:
-            try:
-                await upload_msg.delete()
-            except Exception as delete_err:
-                logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
-            await query.answer("Subida cancelada", show_alert=True)
+    async def deliver():
+        try:
+            await TRANSFERS.run(transfer, send, upload_msg, cancel_markup)
+        except Exception as e:
+            err_msg = str(e)
+            if "Subida cancelada por el usuario" in err_msg or "NoneType" in err_msg:
+                try:
+                    PROGRESS.discard(upload_msg)
+                    await outbound(upload_msg.delete, priority=PRIORITY_BULK)
+                except Exception as delete_err:
+                    logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
+                # El handler ya ha respondido al callback: se avisa con un mensaje
+                await outbound(client.send_message, chat_id=chat_id, text="Subida cancelada")
+            else:
+                await outbound(query.edit_message_text, text=f"❌ Error al subir el archivo:\n{file_path}\n{e}")
+                logger.error(f"Error al subir el archivo: {e}")
+        finally:
+            CANCEL_FLAGS.pop(file_key, None)
+            PROGRESS.finish(upload_msg)
+
+    TRANSFERS.submit(transfer, deliver())
+
+async def start_split_upload(client: Client, chat_id: int, file_path: str):
+    """Sube un archivo grande por partes, continuando un diario previo si el archivo no ha cambiado."""
+    st = await IO_POOL.run(os.stat, file_path)
+    journal = next(
+        (j for j in await IO_POOL.run(UPLOAD_JOURNALS.all)
+         if j["path"] == file_path and j["size"] == st.st_size and j["mtime_ns"] == st.st_mtime_ns),
+        None,
+    )
+    if journal is None:
+        journal = {
+            "id": uuid.uuid4().hex[:16],
+            "chat_id": chat_id,
+            "path": file_path,
+            "name": os.path.basename(file_path),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "part_size": UPLOAD_PART_SIZE,
+            "parts": [],
+        }
+        await IO_POOL.run(UPLOAD_JOURNALS.save, journal)
+    await run_split_upload(client, journal)
+
+async def run_split_upload(client: Client, journal: dict):
+    """
+    Envía las partes pendientes de un diario de subida. Cada parte se lee directamente del
+    archivo original y, al terminar, su SHA-256 y su mensaje quedan anotados en el diario.
+    """
+    upload_id = journal["id"]
+    chat_id = journal["chat_id"]
+    name = journal["name"]
+    size = journal["size"]
+    if TRANSFERS.active(upload_id):
+        await outbound(client.send_message, chat_id=chat_id, text="ℹ️ Este archivo ya se está subiendo o está en cola. Consulta /transfers.")
+        return
+    ranges = split_parts(size, journal["part_size"])
+    first = len(journal["parts"])
+    cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data=f"cancel|{upload_id}")]])
+    status = f"⏳ Subiendo {name} en {len(ranges)} partes"
+    if first:
+        status += f" (reanudando desde la parte {first + 1})"
+    progress_msg = await outbound(client.send_message, chat_id=chat_id, text=status + "...", reply_markup=cancel_markup)
+    record_nav_message(chat_id, progress_msg.id)
+    cancel_flag = threading.Event()
+    CANCEL_FLAGS[upload_id] = cancel_flag
+    transfer = Transfer(upload_id, "upload", name, size, cancel_flag, f"cancel|{upload_id}",
+                        priority=TRANSFER_PRIORITY_NORMAL, resumed_from=ranges[first][0] if first < len(ranges) else size)
+    loop = asyncio.get_running_loop()
+    progress_hook = make_upload_progress_hook(progress_msg, loop, cancel_markup, cancel_flag, transfer=transfer)
+
+    async def send():
+        for n in range(len(journal["parts"]), len(ranges)):
+            start, end = ranges[n]
+            st = await IO_POOL.run(os.stat, journal["path"])
+            if st.st_size != size or st.st_mtime_ns != journal["mtime_ns"]:
+                raise IOError(f"El archivo {journal['path']} ha cambiado desde que empezó la subida")
+            part = FileRange(journal["path"], start, end, f"{name}.{n + 1:03d}")
+            sent = await outbound(client.send_document,
+                chat_id=chat_id,
+                document=part,
+                file_name=part.name,
+                caption=f"📦 {part.name} (parte {n + 1}/{len(ranges)})",
+                progress=lambda current, total, base=start: progress_hook(base + current, size),
+                priority=PRIORITY_BULK
+            )
+            if cancel_flag.is_set():
+                raise Exception(UPLOAD_CANCELLED)
+            if sent is None:
+                raise IOError(f"Telegram no confirmó el envío de la parte {n + 1}")
+            digest = part.digest() or await IO_POOL.run(part.compute_digest)
+            journal["parts"].append({"sha256": digest, "message_id": sent.id})
+            await IO_POOL.run(UPLOAD_JOURNALS.save, journal)
+
+    async def deliver():
+        try:
+            await TRANSFERS.run(transfer, send, progress_msg, cancel_markup)
+        except Exception as e:
+            # Pyrogram se traga la excepción del hook de progreso y devuelve None, así que el
+            # mensaje de error no sirve para reconocer una cancelación: manda el flag
+            if cancel_flag.is_set():
+                await IO_POOL.run(UPLOAD_JOURNALS.remove, upload_id)
+                try:
+                    PROGRESS.discard(progress_msg)
+                    await outbound(progress_msg.delete, priority=PRIORITY_BULK)
+                except Exception as delete_err:
+                    logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
+                await outbound(client.send_message, chat_id=chat_id, text="Subida cancelada")
+            else:
+                logger.error(f"Error en la subida por partes de {journal['path']}: {e}")
+                resume_markup = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("▶️ Reanudar", callback_data=f"resume_upload|{upload_id}")],
+                    [InlineKeyboardButton("✖️ Descartar", callback_data=f"drop_upload|{upload_id}")],
+                ])
+                await outbound(client.send_message,
+                    chat_id=chat_id,
+                    text=f"❌ Error al subir {name} ({len(journal['parts'])}/{len(ranges)} partes enviadas):\n{e}",
+                    reply_markup=resume_markup
+                )
+            return
+        finally:
+            CANCEL_FLAGS.pop(upload_id, None)
+            PROGRESS.finish(progress_msg)
+        try:
+            PROGRESS.discard(progress_msg)
+            await outbound(progress_msg.delete, priority=PRIORITY_BULK)
+        except Exception as e_del:
+            logger.warning(f"Error borrando mensaje de progreso: {e_del}")
+        manifest = render_manifest(journal)
+        if len(manifest) <= MANIFEST_MAX_TEXT:
+            await outbound(client.send_message, chat_id=chat_id, text=manifest)
         else:
-            await query.edit_message_text(text=f"❌ Error al subir el archivo:\n{file_path}\n{e}")
-            logger.error(f"Error al subir el archivo: {e}")
+            checksums = io.BytesIO(manifest.encode("utf-8"))
+            checksums.name = f"{name}.manifest.txt"
+            await outbound(client.send_document,
+                chat_id=chat_id,
+                document=checksums,
+                caption=f"📦 Manifiesto de {name}: {len(ranges)} partes, checksums e instrucciones para reconstruirlo."
+            )
+        await IO_POOL.run(UPLOAD_JOURNALS.remove, upload_id)
+
+    TRANSFERS.submit(transfer, deliver())
+
+async def resume_pending_uploads(client: Client):
+    """Al arrancar, continúa las subidas por partes interrumpidas cuyo archivo no ha cambiado."""
+    for journal in await IO_POOL.run(UPLOAD_JOURNALS.all):
+        try:
+            st = await IO_POOL.run(os.stat, journal["path"])
+            unchanged = st.st_size == journal["size"] and st.st_mtime_ns == journal["mtime_ns"]
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            await IO_POOL.run(UPLOAD_JOURNALS.remove, journal["id"])
+            await outbound(client.send_message,
+                chat_id=journal["chat_id"],
+                text=f"⚠️ La subida por partes de {journal['name']} no se puede reanudar: el archivo ha cambiado o ya no existe."
+            )
+            continue
+        logger.info(f"Reanudando la subida por partes de {journal['path']}")
+        await run_split_upload(client, journal)
+
+@app.on_callback_query(filters.regex(r"^resume_upload\|"))
+@owner_only
+async def resume_upload_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, upload_id = query.data.split("|", 1)
+    journal = await IO_POOL.run(UPLOAD_JOURNALS.load, upload_id)
+    if journal is None:
+        await outbound(query.edit_message_text, "❌ Ya no hay una subida pendiente con esa referencia.")
         return
-    finally:
-        CANCEL_FLAGS.pop(file_key, None)
+    await outbound(query.message.delete)
+    await start_split_upload(client, journal["chat_id"], journal["path"])
 
+@app.on_callback_query(filters.regex(r"^drop_upload\|"))
+@owner_only
+async def drop_upload_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, upload_id = query.data.split("|", 1)
+    await IO_POOL.run(UPLOAD_JOURNALS.remove, upload_id)
+    await outbound(query.edit_message_text, "🗑️ Subida pendiente descartada.")
 
 # Handler para eliminar archivos: muestra mensaje de confirmación
 @app.on_callback_query(filters.regex(r"^delete\|"))
@@ -815,7 +4078,7 @@ async def delete_file_prompt(client: Client, query: CallbackQuery):
         [InlineKeyboardButton("Sí", callback_data=f"confirm_delete|{file_id}")],
         [InlineKeyboardButton("No", callback_data=f"cancel_delete|{file_id}")]
     ])
-    confirm_msg = await client.send_message(query.message.chat.id, "¿Estás seguro de eliminar este archivo?", reply_markup=confirm_markup)
+    confirm_msg = await outbound(client.send_message, query.message.chat.id, "¿Estás seguro de eliminar este archivo?", reply_markup=confirm_markup)
     record_nav_message(query.message.chat.id, confirm_msg.id)
 
 # Handler para confirmar la eliminación
@@ -826,14 +4089,14 @@ async def confirm_delete_handler(client: Client, query: CallbackQuery):
     _, file_id = query.data.split("|", 1)
     file_path = FILE_MAP.get(file_id)
     if not file_path:
-        await query.edit_message_text("❌ Archivo no encontrado.")
+        await outbound(query.edit_message_text, "❌ Archivo no encontrado.")
         return
     try:
-        os.remove(file_path)
-        del FILE_MAP[file_id]
-        await query.edit_message_text("✅ Archivo eliminado.")
+        await IO_POOL.run(os.remove, file_path)
+        FILE_MAP.discard(file_id)
+        await outbound(query.edit_message_text, "✅ Archivo eliminado.")
     except Exception as e:
-        await query.edit_message_text(f"❌ Error al eliminar el archivo: {e}")
+        await outbound(query.edit_message_text, f"❌ Error al eliminar el archivo: {e}")
 
 # Handler para cancelar la eliminación
 @app.on_callback_query(filters.regex(r"^cancel_delete\|"))
@@ -841,7 +4104,7 @@ async def confirm_delete_handler(client: Client, query: CallbackQuery):
 async def cancel_delete_handler(client: Client, query: CallbackQuery):
     await query.answer("Operación cancelada", show_alert=True)
     try:
-        await query.message.delete()
+        await outbound(query.message.delete)
     except Exception as e:
         logger.warning(f"Error borrando mensaje de confirmación: {e}")
 
@@ -855,7 +4118,7 @@ async def execute_file_prompt(client: Client, query: CallbackQuery):
         [InlineKeyboardButton("Sí", callback_data=f"confirm_execute|{file_id}")],
         [InlineKeyboardButton("No", callback_data=f"cancel_execute|{file_id}")]
     ])
-    confirm_msg = await client.send_message(query.message.chat.id, "¿Estás seguro de ejecutar este archivo?", reply_markup=confirm_markup)
+    confirm_msg = await outbound(client.send_message, query.message.chat.id, "¿Estás seguro de ejecutar este archivo?", reply_markup=confirm_markup)
     record_nav_message(query.message.chat.id, confirm_msg.id)
 
 # Handler para confirmar la ejecución
@@ -866,14 +4129,14 @@ async def confirm_execute_handler(client: Client, query: CallbackQuery):
     _, file_id = query.data.split("|", 1)
     file_path = FILE_MAP.get(file_id)
     if not file_path:
-        await query.edit_message_text("❌ Archivo no encontrado.")
+        await outbound(query.edit_message_text, "❌ Archivo no encontrado.")
         return
     try:
         # Ejecutar el archivo. Se utiliza shell=True para archivos .bat o .cmd.
         subprocess.Popen([file_path], shell=True)
-        await query.edit_message_text("✅ Archivo ejecutado.")
+        await outbound(query.edit_message_text, "✅ Archivo ejecutado.")
     except Exception as e:
-        await query.edit_message_text(f"❌ Error al ejecutar el archivo: {e}")
+        await outbound(query.edit_message_text, f"❌ Error al ejecutar el archivo: {e}")
 
 # Handler para cancelar la ejecución
 @app.on_callback_query(filters.regex(r"^cancel_execute\|"))
@@ -881,7 +4144,7 @@ async def confirm_execute_handler(client: Client, query: CallbackQuery):
 async def cancel_execute_handler(client: Client, query: CallbackQuery):
     await query.answer("Operación cancelada", show_alert=True)
     try:
-        await query.message.delete()
+        await outbound(query.message.delete)
     except Exception as e:
         logger.warning(f"Error borrando mensaje de confirmación de ejecución: {e}")
 
@@ -890,8 +4153,9 @@ async def cancel_execute_handler(client: Client, query: CallbackQuery):
 async def cancel_upload_callback(client: Client, query: CallbackQuery):
     _, file_key = query.data.split("|", 1)
     cancel_flag = CANCEL_FLAGS.get(file_key)
-    if cancel_flag:
-        cancel_flag.set()
+    if TRANSFERS.cancel(file_key) or cancel_flag:
+        if cancel_flag:
+            cancel_flag.set()
         await query.answer("Subida cancelada", show_alert=True)
     else:
         await query.answer("No hay una subida activa para cancelar", show_alert=True)
@@ -903,60 +4167,46 @@ async def handle_photo_upload(client: Client, message: Message):
     chat_id = message.chat.id
     current_path = CURRENT_NAV_STATE.get(chat_id)
     if not current_path:
-        await message.reply("No estás en ninguna carpeta activa. Navega a una unidad o carpeta primero.")
+        await outbound(message.reply, "No estás en ninguna carpeta activa. Navega a una unidad o carpeta primero.")
         return
     file_name = f"{message.photo.file_id}.jpg"
     dest_path = os.path.join(current_path, file_name)
-    
-    download_id = str(uuid.uuid4())
-    cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data=f"cancel_download|{download_id}")]])
-    progress_msg = await message.reply("⏳ Descargando foto, por favor espere...", reply_markup=cancel_markup)
-    record_nav_message(chat_id, progress_msg.id)
-    
-    cancel_flag = threading.Event()
-    CANCEL_FLAGS[download_id] = cancel_flag
-
-    loop = asyncio.get_running_loop()
-    progress_hook = make_download_progress_hook(progress_msg, loop, cancel_markup, cancel_flag)
-    
-    try:
-        await message.download(file_name=dest_path, progress=progress_hook)
-    except Exception as e:
-        if "Descarga cancelada por el usuario" in str(e):
-            try:
-                await progress_msg.delete()
-            except Exception as delete_err:
-                logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
-            await message.reply("Descarga cancelada")
-        else:
-            await message.reply(f"❌ Error al descargar la foto: {e}")
-        return
-    finally:
-        CANCEL_FLAGS.pop(download_id, None)
-    try:
-        await progress_msg.delete()
-    except Exception as e_del:
-        logger.warning(f"Error borrando mensaje de progreso: {e_del}")
-    await message.reply(f"✅ Foto descargada en:\n{dest_path}")
+    journal = new_download_journal(chat_id, message, message.photo, dest_path)
+    await run_download(client, journal, message, "foto")
 
 @app.on_callback_query(filters.regex(r"^cancel_download\|"))
 @owner_only
 async def cancel_download_callback(client: Client, query: CallbackQuery):
     _, short_id = query.data.split("|", 1)
     cancel_flag = CANCEL_FLAGS.get(short_id)
-    if cancel_flag:
-        cancel_flag.set()
+    if TRANSFERS.cancel(short_id) or cancel_flag:
+        if cancel_flag:
+            cancel_flag.set()
         await query.answer("Descarga cancelada", show_alert=True)
     else:
         await query.answer("No hay una descarga activa para cancelar", show_alert=True)
 
+def dedup_offer(doc_key: str, source: str, dest_path: str, document):
+    """Registra la oferta de crear 'dest_path' desde la copia local 'source'; devuelve (texto, teclado)."""
+    DEDUP_OFFERS[doc_key] = (source, dest_path)
+    markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔗 Enlace duro a la copia local", callback_data=f"dedup|link|{doc_key}")],
+        [InlineKeyboardButton("📋 Copiar la copia local", callback_data=f"dedup|copy|{doc_key}")],
+        [InlineKeyboardButton("⬇️ Descargar igualmente", callback_data=f"dedup|download|{doc_key}")],
+    ])
+    text = (
+        f"♻️ Este archivo ya se recibió antes y sigue en:\n{source}\n"
+        f"¿Crear '{os.path.basename(dest_path)}' desde esa copia en lugar de descargar {format_size(document.file_size)}?"
+    )
+    return text, markup
+
 @app.on_message(filters.document)
 @owner_only
 async def handle_file_upload(client: Client, message: Message):
     chat_id = message.chat.id
     current_path = CURRENT_NAV_STATE.get(chat_id)
     if not current_path:
-        await message.reply("No estás en ninguna carpeta activa. Navega a una unidad o carpeta primero.")
+        await outbound(message.reply, "No estás en ninguna carpeta activa. Navega a una unidad o carpeta primero.")
         return
     file_name = message.document.file_name
     dest_path = os.path.join(current_path, file_name)
@@ -965,44 +4215,33 @@ async def handle_file_upload(client: Client, message: Message):
     doc_key = str(uuid.uuid4())
     FILE_MESSAGES[doc_key] = message
     
-    # Verificar si el archivo ya existe
-    if os.path.exists(dest_path):
+    # ¿Ya se recibió antes este mismo archivo de Telegram? Entonces no hace falta descargarlo
+    document = message.document
+    existing = await IO_POOL.run(RECEIVED.find, document.file_unique_id, document.file_size)
+    if existing and os.path.abspath(existing[0]) == os.path.abspath(dest_path):
+        RECEIVED.hits += 1
+        RECEIVED.saved_bytes += document.file_size
+        del FILE_MESSAGES[doc_key]
+        await outbound(message.reply, f"✅ El archivo ya está en:\n{dest_path}\nEs idéntico, no se vuelve a descargar.")
+        return
+    dest_exists = await IO_POOL.run(os.path.exists, dest_path)
+    if existing and not dest_exists:
+        text, dedup_markup = dedup_offer(doc_key, existing[0], dest_path, document)
+        await outbound(message.reply, text, reply_markup=dedup_markup)
+        return
+
+    # Verificar si el archivo ya existe (si hay copia local, se ofrecerá tras elegir destino)
+    if dest_exists:
         confirm_markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("Sobreescribir", callback_data=f"overwrite|{doc_key}|{file_name}")],
             [InlineKeyboardButton("Renombrar", callback_data=f"rename|{doc_key}|{file_name}")]
         ])
-        await message.reply(f"El archivo '{file_name}' ya existe. ¿Deseas sobreescribirlo o renombrarlo?", reply_markup=confirm_markup)
+        await outbound(message.reply, f"El archivo '{file_name}' ya existe. ¿Deseas sobreescribirlo o renombrarlo?", reply_markup=confirm_markup)
         return
     
     # Si no existe, proceder normalmente con la descarga
-    download_id = str(uuid.uuid4())
-    cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data=f"cancel_download|{download_id}")]])
-    progress_msg = await message.reply("⏳ Descargando archivo, por favor espere...", reply_markup=cancel_markup)
-    record_nav_message(chat_id, progress_msg.id)
-    cancel_flag = threading.Event()
-    CANCEL_FLAGS[download_id] = cancel_flag
-
-    loop = asyncio.get_running_loop()
-    progress_hook = make_download_progress_hook(progress_msg, loop, cancel_markup, cancel_flag)
-    try:
-        await message.download(file_name=dest_path, progress=progress_hook)
-    except Exception as e:
-        if "Descarga cancelada por el usuario" in str(e):
-            try:
-                await progress_msg.delete()
-            except Exception as delete_err:
-                logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
-            await message.reply("Descarga cancelada")
-        else:
-            await message.reply(f"❌ Error al descargar el archivo: {e}")
-        return
-    finally:
-        CANCEL_FLAGS.pop(download_id, None)
-    try:
-        await progress_msg.delete()
-    except Exception as e_del:
-        logger.warning(f"Error borrando mensaje de progreso: {e_del}")
-    await message.reply(f"✅ Archivo descargado en:\n{dest_path}")
+    journal = new_download_journal(chat_id, message, message.document, dest_path)
+    await run_download(client, journal, message)
     # Elimina la referencia, ya que se usó
     if doc_key in FILE_MESSAGES:
         del FILE_MESSAGES[doc_key]
@@ -1014,7 +4253,7 @@ async def handle_overwrite_rename(client: Client, query: CallbackQuery):
     await query.answer()
     parts = query.data.split("|")
     if len(parts) < 3:
-        await query.edit_message_text("Datos incompletos.")
+        await outbound(query.edit_message_text, "Datos incompletos.")
         return
     action = parts[0]  # "overwrite" o "rename"
     doc_key = parts[1]
@@ -1022,65 +4261,313 @@ async def handle_overwrite_rename(client: Client, query: CallbackQuery):
     chat_id = query.message.chat.id
     current_path = CURRENT_NAV_STATE.get(chat_id)
     if not current_path:
-        await query.edit_message_text("No estás en ninguna carpeta activa.")
+        await outbound(query.edit_message_text, "No estás en ninguna carpeta activa.")
         return
     dest_path = os.path.join(current_path, file_name)
     
     # Obtén el mensaje original que contiene el archivo
     original_message = FILE_MESSAGES.get(doc_key)
     if not original_message:
-        await query.edit_message_text("❌ No se encontró la referencia del archivo original.")
+        await outbound(query.edit_message_text, "❌ No se encontró la referencia del archivo original.")
         return
 
-    if action == "overwrite":
-        try:
-            os.remove(dest_path)
-        except Exception as e:
-            await query.edit_message_text(f"❌ Error al eliminar el archivo existente: {e}")
-            return
-    elif action == "rename":
+    if action == "rename":
         base, ext = os.path.splitext(file_name)
         timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
         new_file_name = f"{base}_{timestamp}{ext}"
         dest_path = os.path.join(current_path, new_file_name)
+    # Al sobreescribir no hace falta borrar antes: el archivo descargado sustituye al
+    # existente de forma atómica al terminar, y si la descarga falla el original sigue intacto.
+    document = original_message.document
+    current = await IO_POOL.run(RECEIVED.lookup, dest_path) if action == "overwrite" else None
+    unchanged = bool(current and current[0] == document.file_unique_id)
+    existing = None if unchanged else await IO_POOL.run(RECEIVED.find, document.file_unique_id, document.file_size)
+    if unchanged:
+        RECEIVED.hits += 1
+        RECEIVED.saved_bytes += document.file_size
+        await outbound(client.send_message, chat_id, f"✅ {dest_path} ya tiene exactamente este contenido; no se vuelve a descargar.")
+    elif existing:
+        # Hay una copia local válida: en vez de descargar, se ofrece enlazarla o copiarla al destino
+        # elegido. El mensaje de confirmación pasa a ser la oferta y la referencia se conserva.
+        text, dedup_markup = dedup_offer(doc_key, existing[0], dest_path, document)
+        await outbound(query.edit_message_text, text, reply_markup=dedup_markup)
+        return
+    else:
+        # Proceder a descargar usando el mensaje original
+        journal = new_download_journal(chat_id, original_message, document, dest_path)
+        await run_download(client, journal, original_message)
+    # Elimina el mensaje de confirmación y la referencia original
+    try:
+        await outbound(query.message.delete)
+    except Exception as e:
+        logger.warning(f"Error borrando mensaje de confirmación: {e}")
+    if doc_key in FILE_MESSAGES:
+        del FILE_MESSAGES[doc_key]
+
+@app.on_callback_query(filters.regex(r"^dedup\|"))
+@owner_only
+async def dedup_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, mode, doc_key = query.data.split("|", 2)
+    message = FILE_MESSAGES.pop(doc_key, None)
+    offer = DEDUP_OFFERS.pop(doc_key, None)
+    if message is None or offer is None:
+        await outbound(query.edit_message_text, "❌ No se encontró la referencia del archivo original.")
+        return
+    source, dest_path = offer
+    document = message.document
+    if mode == "download":
+        await outbound(query.message.delete)
+        journal = new_download_journal(query.message.chat.id, message, document, dest_path)
+        await run_download(client, journal, message)
+        return
+    valid = await IO_POOL.run(RECEIVED.find, document.file_unique_id, document.file_size)
+    if not valid or valid[0] != source:
+        await outbound(query.edit_message_text, "❌ La copia local ha cambiado o ya no existe; envía el archivo de nuevo para descargarlo.")
+        return
+    try:
+        used = await IO_POOL.run(link_or_copy, source, dest_path, mode)
+        await IO_POOL.run(RECEIVED.add, dest_path, document.file_unique_id, valid[1])
+    except Exception as e:
+        await outbound(query.edit_message_text, f"❌ Error al crear {dest_path} desde la copia local: {e}")
+        return
+    RECEIVED.hits += 1
+    RECEIVED.saved_bytes += document.file_size
+    how = "Enlace duro creado" if used == "link" else "Copiado desde la copia local"
+    await outbound(query.edit_message_text, f"✅ {how}:\n{dest_path}\n(sin descargar {format_size(document.file_size)})")
 
-    # Proceder a descargar usando el mensaje original
+def new_download_journal(chat_id: int, message: Message, media, dest_path: str) -> dict:
+    """
+    Diario de una descarga nueva: se escribe en '<destino>.<id>.part' y se renombra al terminar.
+    El id en el nombre evita que dos descargas al mismo destino compartan el archivo parcial.
+    """
     download_id = str(uuid.uuid4())
+    return {
+        "id": download_id,
+        "chat_id": chat_id,
+        "message_id": message.id,
+        "unique_id": media.file_unique_id,
+        "dest_path": dest_path,
+        "part_path": f"{dest_path}.{download_id[:8]}.part",
+        "size": media.file_size or 0,
+        "received": 0,
+    }
+
+def _open_part_file(journal: dict):
+    """
+    Abre el archivo .part para continuar donde indica el diario. Solo se confía en los bytes
+    anotados en el diario (escritos con fsync) y se redondea al tamaño de trozo de Telegram.
+    """
+    part_path = journal["part_path"]
+    try:
+        on_disk = os.path.getsize(part_path)
+    except FileNotFoundError:
+        on_disk = 0
+    received = min(journal["received"], on_disk) // DOWNLOAD_CHUNK * DOWNLOAD_CHUNK
+    fh = open(part_path, "r+b" if on_disk else "wb")
+    fh.truncate(received)
+    # El SHA-256 se calcula mientras se descarga; al reanudar se recupera leyendo lo ya recibido
+    hasher = hashlib.sha256()
+    fh.seek(0)
+    while fh.tell() < received:
+        hasher.update(fh.read(min(received - fh.tell(), 1024 * 1024)))
+    fh.seek(received)
+    return fh, received, hasher
+
+def _write_chunk(fh, hasher, chunk: bytes):
+    fh.write(chunk)
+    hasher.update(chunk)
+
+def _checkpoint_part_file(fh, journal: dict, received: int):
+    fh.flush()
+    os.fsync(fh.fileno())
+    journal["received"] = received
+    DOWNLOAD_JOURNALS.save(journal)
+
+def _finish_part_file(fh, journal: dict):
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+    os.replace(journal["part_path"], journal["dest_path"])
+    DOWNLOAD_JOURNALS.remove(journal["id"])
+
+def discard_download(journal: dict):
+    """Borra el .part y el diario de una descarga cancelada (bloqueante)."""
+    try:
+        os.remove(journal["part_path"])
+    except FileNotFoundError:
+        pass
+    DOWNLOAD_JOURNALS.remove(journal["id"])
+
+async def resumable_download(client: Client, journal: dict, message: Message, progress_hook):
+    """
+    Descarga el medio de 'message' por trozos en el archivo .part, anotando en el diario los
+    bytes ya asegurados en disco cada DOWNLOAD_CHECKPOINT_CHUNKS trozos. Devuelve el SHA-256.
+    """
+    fh, received, hasher = await IO_POOL.run(_open_part_file, journal)
+    try:
+        await IO_POOL.run(_checkpoint_part_file, fh, journal, received)
+        unsaved = 0
+        async for chunk in client.stream_media(message, offset=received // DOWNLOAD_CHUNK):
+            await IO_POOL.run(_write_chunk, fh, hasher, chunk)
+            received += len(chunk)
+            progress_hook(received, journal["size"])
+            unsaved += 1
+            if unsaved >= DOWNLOAD_CHECKPOINT_CHUNKS:
+                await IO_POOL.run(_checkpoint_part_file, fh, journal, received)
+                unsaved = 0
+        if journal["size"] and received != journal["size"]:
+            raise IOError(f"Descarga incompleta: {format_size(received)} de {format_size(journal['size'])}")
+        await IO_POOL.run(_finish_part_file, fh, journal)
+        return hasher.hexdigest()
+    finally:
+        if not fh.closed:
+            await IO_POOL.run(fh.close)
+
+async def run_download(client: Client, journal: dict, message: Message, what: str = "archivo"):
+    """
+    Descarga (o reanuda) el archivo de un diario mostrando progreso y botón de cancelar.
+    Solo publica el mensaje de progreso y encola la transferencia: vuelve sin esperar a la descarga.
+    Si falla por otro motivo que la cancelación, el .part y el diario se conservan para reanudar.
+    """
+    download_id = journal["id"]
+    chat_id = journal["chat_id"]
+    dest_path = journal["dest_path"]
     cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data=f"cancel_download|{download_id}")]])
-    progress_msg = await client.send_message(chat_id, "⏳ Descargando archivo, por favor espere...", reply_markup=cancel_markup)
+    if journal["received"]:
+        text = f"⏳ Reanudando la descarga de {os.path.basename(dest_path)} desde {format_size(journal['received'])}..."
+    else:
+        text = f"⏳ Descargando {what}, por favor espere..."
+    progress_msg = await outbound(message.reply, text, reply_markup=cancel_markup)
     record_nav_message(chat_id, progress_msg.id)
     cancel_flag = threading.Event()
     CANCEL_FLAGS[download_id] = cancel_flag
+    transfer = Transfer(download_id, "download", os.path.basename(dest_path), journal["size"], cancel_flag,
+                        f"cancel_download|{download_id}", resumed_from=journal["received"])
     loop = asyncio.get_running_loop()
-    progress_hook = make_download_progress_hook(progress_msg, loop, cancel_markup, cancel_flag)
+    progress_hook = make_download_progress_hook(progress_msg, loop, cancel_markup, cancel_flag, transfer=transfer)
+
+    async def deliver():
+        try:
+            sha256 = await TRANSFERS.run(transfer, lambda: resumable_download(client, journal, message, progress_hook),
+                                         progress_msg, cancel_markup)
+        except Exception as e:
+            if DOWNLOAD_CANCELLED in str(e):
+                await IO_POOL.run(discard_download, journal)
+                try:
+                    PROGRESS.discard(progress_msg)
+                    await outbound(progress_msg.delete, priority=PRIORITY_BULK)
+                except Exception as delete_err:
+                    logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
+                await outbound(message.reply, "Descarga cancelada")
+            else:
+                logger.error(f"Error al descargar {dest_path}: {e}")
+                resume_markup = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("▶️ Reanudar descarga", callback_data=f"resume_download|{download_id}")],
+                    [InlineKeyboardButton("✖️ Descartar", callback_data=f"drop_download|{download_id}")],
+                ])
+                await outbound(message.reply, f"❌ Error al descargar el {what}: {e}", reply_markup=resume_markup)
+            return
+        finally:
+            CANCEL_FLAGS.pop(download_id, None)
+            PROGRESS.finish(progress_msg)
+        try:
+            PROGRESS.discard(progress_msg)
+            await outbound(progress_msg.delete, priority=PRIORITY_BULK)
+        except Exception as e_del:
+            logger.warning(f"Error borrando mensaje de progreso: {e_del}")
+        done = "✅ Foto descargada en:" if what == "foto" else "✅ Archivo descargado en:"
+        text = f"{done}\n{dest_path}"
+        try:
+            await IO_POOL.run(RECEIVED.add, dest_path, journal.get("unique_id"), sha256)
+            twin = await IO_POOL.run(RECEIVED.find_content, sha256, journal["size"], dest_path)
+            if twin:
+                text += f"\nℹ️ Tiene el mismo contenido que {twin[0]}"
+        except Exception as e:
+            logger.warning(f"No se pudo registrar {dest_path} en el índice de recibidos: {e}")
+        await outbound(message.reply, text)
+
+    TRANSFERS.submit(transfer, deliver())
+
+async def resume_download_journal(client: Client, journal: dict) -> bool:
+    """Recupera el mensaje original de un diario y reanuda la descarga; False si ya no existe."""
     try:
-        await original_message.download(file_name=dest_path, progress=progress_hook)
+        message = await client.get_messages(journal["chat_id"], journal["message_id"])
     except Exception as e:
-        if "Descarga cancelada por el usuario" in str(e):
-            try:
-                await progress_msg.delete()
-            except Exception as delete_err:
-                logger.warning(f"Error borrando mensaje de progreso cancelado: {delete_err}")
-            await client.send_message(chat_id, "Descarga cancelada")
-        else:
-            await client.send_message(chat_id, f"❌ Error al descargar el archivo: {e}")
+        logger.warning(f"No se pudo recuperar el mensaje de la descarga {journal['id']}: {e}")
+        return False
+    if message is None or getattr(message, "empty", False) or not message.media:
+        await IO_POOL.run(discard_download, journal)
+        await outbound(client.send_message,
+            chat_id=journal["chat_id"],
+            text=f"⚠️ No se puede reanudar la descarga de {os.path.basename(journal['dest_path'])}: el mensaje original ya no existe."
+        )
+        return False
+    await run_download(client, journal, message)
+    return True
+
+async def resume_pending_downloads(client: Client):
+    """Al arrancar, reanuda las descargas que quedaron a medias."""
+    for journal in await IO_POOL.run(DOWNLOAD_JOURNALS.all):
+        logger.info(f"Reanudando la descarga de {journal['dest_path']}")
+        await resume_download_journal(client, journal)
+
+@app.on_callback_query(filters.regex(r"^resume_download\|"))
+@owner_only
+async def resume_download_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, download_id = query.data.split("|", 1)
+    journal = await IO_POOL.run(DOWNLOAD_JOURNALS.load, download_id)
+    if journal is None or TRANSFERS.active(download_id):
+        await outbound(query.edit_message_text, "❌ No hay una descarga pendiente con esa referencia.")
         return
-    finally:
-        CANCEL_FLAGS.pop(download_id, None)
-    try:
-        await progress_msg.delete()
-    except Exception as e_del:
-        logger.warning(f"Error borrando mensaje de progreso: {e_del}")
-    await client.send_message(chat_id, f"✅ Archivo descargado en:\n{dest_path}")
-    # Elimina el mensaje de confirmación y la referencia original
-    try:
-        await query.message.delete()
-    except Exception as e:
-        logger.warning(f"Error borrando mensaje de confirmación: {e}")
-    if doc_key in FILE_MESSAGES:
-        del FILE_MESSAGES[doc_key]
+    await outbound(query.message.delete)
+    await resume_download_journal(client, journal)
 
+@app.on_callback_query(filters.regex(r"^drop_download\|"))
+@owner_only
+async def drop_download_callback(client: Client, query: CallbackQuery):
+    await query.answer()
+    _, download_id = query.data.split("|", 1)
+    journal = await IO_POOL.run(DOWNLOAD_JOURNALS.load, download_id)
+    if journal is not None and not TRANSFERS.active(download_id):
+        await IO_POOL.run(discard_download, journal)
+    await outbound(query.edit_message_text, "🗑️ Descarga pendiente descartada.")
+
+
+def open_stores():
+    """Crea las cachés e índices persistentes en DATA_DIR (bloqueante, una vez al arrancar)."""
+    global THUMB_CACHE, UPLOAD_JOURNALS, DOWNLOAD_JOURNALS, FILE_INDEX, FILE_IDS, RECEIVED
+    THUMB_CACHE = ThumbnailCache(os.path.join(DATA_DIR, "thumbs"))
+    UPLOAD_JOURNALS = JournalStore(os.path.join(DATA_DIR, "uploads"))
+    DOWNLOAD_JOURNALS = JournalStore(os.path.join(DATA_DIR, "downloads"))
+    FILE_INDEX = FileIndex(os.path.join(DATA_DIR, "index.sqlite3"))
+    FILE_IDS = FileIdCache(os.path.join(DATA_DIR, "file_ids.sqlite3"))
+    RECEIVED = ReceivedIndex(os.path.join(DATA_DIR, "received.sqlite3"))
+
+def start_background_services():
+    """Arranca las tareas de fondo que deben vivir mientras el bot esté conectado."""
+    SYSINFO.start()
+    RESOURCES.start()
+    FILE_INDEX.start(list_drives)
+
+async def main():
+    # Antes de conectar: ningún handler debe encontrarse los almacenes sin abrir
+    await IO_POOL.run(open_stores)
+    async with app:
+        start_background_services()
+        await resume_pending_uploads(app)
+        await resume_pending_downloads(app)
+        logger.info("Bot en ejecución...")
+        await idle()
 
 if __name__ == "__main__":
-    logger.info("Bot en ejecución...")
-    app.run()
+    try:
+        app.run(main())
+    finally:
+        IO_POOL.shutdown()
+        FOLDER_SIZES.pool.shutdown()
+        CPU_POOL.shutdown()
+        CAPTURE.stop()
+        if FILE_INDEX is not None:
+            FILE_INDEX.stop()